@@ -35,7 +35,7 @@ def create_app():
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
 
-    from .models import ProviderKey, UsageLog, UserKey, CorsSettings, User, Conversation, CollabRoom, CollabMembership, CollabMessage
+    from .models import ProviderKey, UsageLog, UserKey, CorsSettings, User, Conversation, ConversationMessage, CollabRoom, CollabMembership, CollabMessage
     with app.app_context():
         backup_database()
         db.create_all()
@@ -52,12 +52,31 @@ def create_app():
         if 'cost' not in usage_columns:
             db.session.execute(text('ALTER TABLE usage_logs ADD COLUMN cost FLOAT NOT NULL DEFAULT 0.0'))
             db.session.commit()
+        if 'cached_tokens' not in usage_columns:
+            db.session.execute(text('ALTER TABLE usage_logs ADD COLUMN cached_tokens INTEGER NOT NULL DEFAULT 0'))
+            db.session.commit()
+        if 'cache_hit' not in usage_columns:
+            db.session.execute(text('ALTER TABLE usage_logs ADD COLUMN cache_hit BOOLEAN NOT NULL DEFAULT 0'))
+            db.session.commit()
         
+        from .conversation_store import migrate_conversation_blobs, migrate_inline_blobs
+        migrate_conversation_blobs()
+        migrate_inline_blobs()
+
         if not CorsSettings.query.first():
             default_cors = CorsSettings()
             db.session.add(default_cors)
             db.session.commit()
 
+        from .quota import warm_quota
+        warm_quota()
+
+    from .key_cache import start_last_used_flusher
+    start_last_used_flusher(app)
+
+    from .usage_writer import usage_writer
+    usage_writer.start(app)
+
     from .routes_admin import admin_bp
     from .routes_proxy import api_bp
     from .routes_chat import chat_bp, init_oauth
@@ -0,0 +1,155 @@
+import base64
+import binascii
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+BLOB_PREFIX = '/api/chat/blobs/'
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]{1,10}$')
+SAFE_INLINE_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/avif', 'image/bmp')
+
+
+def _extension(mime):
+    ext = mimetypes.guess_extension(mime or '') or '.bin'
+    return {'.jpe': '.jpg', '.jpeg': '.jpg'}.get(ext, ext).lstrip('.')
+
+
+def blob_mime(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class BlobStore:
+    def __init__(self, root=None, inline_cache_bytes=None):
+        self.root = root or os.getenv('BLOB_DIR', os.path.join('instance', 'blobs'))
+        self.inline_cache_bytes = inline_cache_bytes or int(os.getenv('BLOB_INLINE_CACHE_BYTES', str(32 * 1024 * 1024)))
+        self._lock = threading.Lock()
+        self._inline = OrderedDict()
+        self._inline_size = 0
+        self.stored = 0
+        self.deduped = 0
+        self.bytes_written = 0
+        self.inlined = 0
+        self.inline_hits = 0
+        self.missing = 0
+
+    def path(self, name):
+        if not BLOB_NAME.match(name):
+            return None
+        return os.path.join(self.root, name[:2], name)
+
+    def put(self, data, mime):
+        name = f'{hashlib.sha256(data).hexdigest()}.{_extension(mime)}'
+        path = self.path(name)
+        if os.path.exists(path):
+            self.deduped += 1
+            return name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.stored += 1
+        self.bytes_written += len(data)
+        return name
+
+    def put_data_url(self, url):
+        header, sep, payload = url.partition(',')
+        if not sep or not header.startswith('data:') or not header.endswith(';base64'):
+            return url
+        mime = header[5:-7].split(';', 1)[0].strip().lower() or 'application/octet-stream'
+        try:
+            data = base64.b64decode(payload, validate=False)
+        except (binascii.Error, ValueError):
+            return url
+        name = self.put(data, mime)
+        self._remember(BLOB_PREFIX + name, url)
+        return BLOB_PREFIX + name
+
+    def _remember(self, ref, data_url):
+        size = len(data_url)
+        if size > self.inline_cache_bytes // 4:
+            return
+        with self._lock:
+            if ref in self._inline:
+                self._inline.move_to_end(ref)
+                return
+            self._inline[ref] = data_url
+            self._inline_size += size
+            while self._inline_size > self.inline_cache_bytes:
+                _, old = self._inline.popitem(last=False)
+                self._inline_size -= len(old)
+
+    def data_url(self, ref):
+        with self._lock:
+            cached = self._inline.get(ref)
+            if cached is not None:
+                self._inline.move_to_end(ref)
+                self.inline_hits += 1
+                return cached
+        name = ref[len(BLOB_PREFIX):]
+        path = self.path(name)
+        if path is None or not os.path.exists(path):
+            self.missing += 1
+            return None
+        with open(path, 'rb') as f:
+            encoded = base64.b64encode(f.read()).decode('ascii')
+        url = f'data:{blob_mime(name)};base64,{encoded}'
+        self.inlined += 1
+        self._remember(ref, url)
+        return url
+
+    def externalize(self, value):
+        if isinstance(value, str):
+            return self.put_data_url(value) if value.startswith('data:') else value
+        if isinstance(value, list):
+            return [self.externalize(item) for item in value]
+        if isinstance(value, dict):
+            return {k: self.externalize(v) for k, v in value.items()}
+        return value
+
+    def inline(self, value):
+        if isinstance(value, str):
+            return (self.data_url(value) or value) if value.startswith(BLOB_PREFIX) else value
+        if isinstance(value, list):
+            return [self.inline(item) for item in value]
+        if isinstance(value, dict):
+            return {k: self.inline(v) for k, v in value.items()}
+        return value
+
+    def externalize_message(self, message):
+        message = dict(message)
+        if isinstance(message.get('content'), list):
+            message['content'] = [
+                part if isinstance(part, dict) and part.get('type') == 'text' else self.externalize(part)
+                for part in message['content']
+            ]
+        if message.get('images'):
+            message['images'] = self.externalize(message['images'])
+        return message
+
+    def stats(self):
+        with self._lock:
+            cached = len(self._inline)
+            cached_bytes = self._inline_size
+        return {
+            'stored': self.stored,
+            'deduped': self.deduped,
+            'bytes_written': self.bytes_written,
+            'inlined': self.inlined,
+            'inline_hits': self.inline_hits,
+            'inline_cache_entries': cached,
+            'inline_cache_bytes': cached_bytes,
+            'missing': self.missing
+        }
+
+
+blob_store = BlobStore()
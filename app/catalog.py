@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+ZERO_PRICING = {'prompt': 0, 'completion': 0, 'image': 0}
+
+
+def _price(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ModelCatalog:
+    def __init__(self, path, check_interval=None):
+        self.path = path
+        self.check_interval = check_interval if check_interval is not None else float(os.getenv('CATALOG_CHECK_INTERVAL', '2'))
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0
+        self.error = None
+        self.loads = 0
+        self.entries = []
+        self.by_id = {}
+        self.body = b''
+        self.etag = ''
+
+    def _build(self, raw):
+        data = json.loads(raw)
+        entries = []
+        by_id = {}
+        for model in data.get('data', []):
+            if not isinstance(model, dict):
+                continue
+            architecture = model.get('architecture') or {}
+            pricing = model.get('pricing') or {}
+            entry = {
+                'id': model.get('id', ''),
+                'name': model.get('name', ''),
+                'description': model.get('description', ''),
+                'modality': architecture.get('modality', ''),
+                'input_modalities': architecture.get('input_modalities') or [],
+                'output_modalities': architecture.get('output_modalities') or [],
+                'context_length': int(model.get('context_length') or 0),
+                'pricing': {
+                    'prompt': _price(pricing.get('prompt')),
+                    'completion': _price(pricing.get('completion')),
+                    'image': _price(pricing.get('image'))
+                }
+            }
+            entries.append(entry)
+            if entry['id']:
+                by_id.setdefault(entry['id'], entry)
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        return entries, by_id, body
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self._mtime is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if not force and self._mtime is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if not force and mtime == self._mtime:
+                    return
+                with open(self.path, 'rb') as f:
+                    raw = f.read()
+                entries, by_id, body = self._build(raw)
+            except Exception as exc:
+                self.error = str(exc)
+                if self._mtime is None:
+                    self._mtime = 0
+                return
+            self.entries = entries
+            self.by_id = by_id
+            self.body = body
+            self.etag = hashlib.sha1(raw).hexdigest()
+            self._mtime = mtime
+            self.error = None
+            self.loads += 1
+
+    def get(self, model_id):
+        self.refresh()
+        return self.by_id.get(model_id)
+
+    def pricing(self, model_id):
+        entry = self.get(model_id)
+        return entry['pricing'] if entry else ZERO_PRICING
+
+    def models(self):
+        self.refresh()
+        return self.entries
+
+    def payload(self):
+        self.refresh()
+        return self.body, self.etag
+
+    def stats(self):
+        return {
+            'models': len(self.entries),
+            'loads': self.loads,
+            'etag': self.etag,
+            'error': self.error
+        }
+
+
+catalog = ModelCatalog(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'available_models.json'))
+
+
+def calculate_cost(model_id, prompt_tokens, completion_tokens):
+    pricing = catalog.pricing(model_id)
+    cost = (prompt_tokens * pricing['prompt']) + (completion_tokens * pricing['completion'])
+    return round(cost, 6)
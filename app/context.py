@@ -0,0 +1,252 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from . import db
+from .catalog import calculate_cost, catalog
+from .models import CollabMessage, ContextSummary, ConversationMessage
+from .providers import upstream_request
+from .utils import extract_cached_tokens, extract_tokens, log_usage
+
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', '0'))
+CONTEXT_WINDOW_FRACTION = float(os.getenv('CONTEXT_WINDOW_FRACTION', '0.75'))
+CONTEXT_DEFAULT_WINDOW = int(os.getenv('CONTEXT_DEFAULT_WINDOW', '32768'))
+CONTEXT_RESERVE_TOKENS = int(os.getenv('CONTEXT_RESERVE_TOKENS', '4096'))
+CONTEXT_KEEP_MESSAGES = int(os.getenv('CONTEXT_KEEP_MESSAGES', '6'))
+CONTEXT_IMAGE_TOKENS = int(os.getenv('CONTEXT_IMAGE_TOKENS', '800'))
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'google/gemini-2.5-flash')
+SUMMARY_MAX_CHARS = int(os.getenv('CONTEXT_SUMMARY_CHARS', '2400'))
+SUMMARY_CHUNK_CHARS = 16000
+MESSAGE_OVERHEAD = 4
+
+_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='summary')
+_pending = set()
+_pending_lock = threading.Lock()
+_stats = {'assembled': 0, 'trimmed': 0, 'dropped_messages': 0, 'saved_tokens': 0, 'summaries': 0, 'summary_failures': 0}
+
+
+def estimate_tokens(content):
+    if content is None:
+        return 0
+    if isinstance(content, str):
+        return len(content.encode('utf-8')) // 4 + 1
+    if isinstance(content, list):
+        total = 0
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get('type') == 'text':
+                total += estimate_tokens(part.get('text'))
+            else:
+                total += CONTEXT_IMAGE_TOKENS
+        return total
+    return estimate_tokens(str(content))
+
+
+def message_tokens(message):
+    return estimate_tokens(message.get('content')) + MESSAGE_OVERHEAD
+
+
+def context_budget(models=None):
+    windows = []
+    for model_id in models or ():
+        entry = catalog.get(model_id)
+        if entry and entry['context_length']:
+            windows.append(entry['context_length'])
+    window = min(windows) if windows else CONTEXT_DEFAULT_WINDOW
+    budget = min(window - CONTEXT_RESERVE_TOKENS, int(window * CONTEXT_WINDOW_FRACTION))
+    if CONTEXT_MAX_TOKENS > 0:
+        budget = min(budget, CONTEXT_MAX_TOKENS)
+    return max(budget, 1024)
+
+
+def message_text(message):
+    content = message.get('content')
+    if isinstance(content, list):
+        text = ' '.join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+        images = sum(1 for part in content if isinstance(part, dict) and part.get('type') == 'image_url')
+        if images:
+            text += f' [{images} image(s)]'
+        return text.strip()
+    return str(content or '').strip()
+
+
+def _digest(messages, limit):
+    lines = []
+    size = 0
+    for message in reversed(messages):
+        text = message_text(message)
+        if not text:
+            continue
+        line = f"{message.get('role', 'user')}: {text[:300]}"
+        if size + len(line) > limit:
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return '\n'.join(reversed(lines))
+
+
+def _load_range(scope, ref_id, after, upto):
+    if scope == 'room':
+        rows = CollabMessage.query.filter(
+            CollabMessage.room_id == ref_id, CollabMessage.id > after, CollabMessage.id <= upto
+        ).order_by(CollabMessage.id.asc()).all()
+        return [{'role': 'assistant' if r.role == 'assistant' else 'user', 'content': r.content} for r in rows]
+    rows = db.session.query(ConversationMessage.role, ConversationMessage.content).filter(
+        ConversationMessage.conversation_id == ref_id, ConversationMessage.seq > after, ConversationMessage.seq <= upto
+    ).order_by(ConversationMessage.seq.asc()).all()
+    return [{'role': role, 'content': content} for role, content in rows]
+
+
+def _summarize(summary, messages):
+    transcript = '\n'.join(f"{m['role']}: {message_text(m)[:2000]}" for m in messages if message_text(m))
+    resp = upstream_request(
+        '/chat/completions',
+        {
+            'model': SUMMARY_MODEL,
+            'messages': [
+                {
+                    'role': 'system',
+                    'content': (
+                        'You maintain a running summary of a chat so it can continue without the full transcript. '
+                        'Merge the new messages into the existing summary. Keep names, decisions, facts, code identifiers, '
+                        'open questions and user preferences. Write compact prose or bullets, at most 400 words.'
+                    )
+                },
+                {'role': 'user', 'content': f'Existing summary:\n{summary or "(none)"}\n\nNew messages:\n{transcript}'}
+            ],
+            'temperature': 0.2,
+            'max_tokens': 700
+        },
+        timeout=60
+    )
+    try:
+        if resp.status_code != 200:
+            raise RuntimeError(f'summary request returned {resp.status_code}')
+        data = resp.json()
+    finally:
+        resp.close()
+    content = (data.get('choices') or [{}])[0].get('message', {}).get('content') or ''
+    prompt_tokens, completion_tokens, total_tokens = extract_tokens(data)
+    log_usage(
+        resp.provider_id,
+        None,
+        request_tokens=prompt_tokens,
+        response_tokens=completion_tokens,
+        total_tokens=total_tokens,
+        model=SUMMARY_MODEL,
+        cost=calculate_cost(SUMMARY_MODEL, prompt_tokens, completion_tokens),
+        cached_tokens=extract_cached_tokens(data)
+    )
+    return content.strip()
+
+
+def _refresh(app, scope, ref_id, upto):
+    with app.app_context():
+        try:
+            row = ContextSummary.query.filter_by(scope=scope, ref_id=ref_id).first()
+            after = row.upto if row else -1
+            if after >= upto:
+                return
+            summary = row.summary if row else ''
+            pending = _load_range(scope, ref_id, after, upto)
+            chunk = []
+            size = 0
+            for message in pending + [None]:
+                if message is not None:
+                    text_size = len(message_text(message))
+                    if not chunk or size + text_size <= SUMMARY_CHUNK_CHARS:
+                        chunk.append(message)
+                        size += text_size
+                        continue
+                if chunk:
+                    summary = _summarize(summary, chunk) or summary
+                if message is not None:
+                    chunk = [message]
+                    size = len(message_text(message))
+            if row is None:
+                row = ContextSummary(scope=scope, ref_id=ref_id, upto=upto, summary=summary, model=SUMMARY_MODEL)
+                db.session.add(row)
+            else:
+                row.upto = upto
+                row.summary = summary
+                row.model = SUMMARY_MODEL
+            db.session.commit()
+            _stats['summaries'] += 1
+        except Exception as exc:
+            db.session.rollback()
+            _stats['summary_failures'] += 1
+            app.logger.warning('context summary refresh failed for %s %s: %s', scope, ref_id, exc)
+        finally:
+            with _pending_lock:
+                _pending.discard((scope, ref_id))
+
+
+def _schedule_refresh(scope, ref_id, upto):
+    with _pending_lock:
+        if (scope, ref_id) in _pending:
+            return
+        _pending.add((scope, ref_id))
+    _pool.submit(_refresh, current_app._get_current_object(), scope, ref_id, upto)
+
+
+def _summary_for(scope, ref_id, dropped, keys):
+    upto = next((k for k in reversed(keys) if k is not None), None)
+    if upto is None:
+        return ''
+    row = ContextSummary.query.filter_by(scope=scope, ref_id=ref_id).first()
+    if row and row.upto >= upto:
+        return row.summary
+    _schedule_refresh(scope, ref_id, upto)
+    covered = row.upto if row else -1
+    gap = [m for m, k in zip(dropped, keys) if k is None or k > covered]
+    base = row.summary if row else ''
+    recent = _digest(gap, max(SUMMARY_MAX_CHARS - len(base), SUMMARY_MAX_CHARS // 2))
+    return '\n'.join(part for part in (base, recent) if part)
+
+
+def assemble_context(messages, keys, scope, ref_id, models=None, system=None):
+    system = list(system or [])
+    budget = context_budget(models)
+    counts = [message_tokens(m) for m in messages]
+    used = sum(message_tokens(m) for m in system)
+    full = used + sum(counts)
+    _stats['assembled'] += 1
+    if full <= budget:
+        return system + list(messages), {'estimated_tokens': full, 'budget': budget}
+    summary_reserve = SUMMARY_MAX_CHARS // 4 + MESSAGE_OVERHEAD
+    cut = len(messages)
+    for idx in range(len(messages) - 1, -1, -1):
+        keep_anyway = len(messages) - idx <= CONTEXT_KEEP_MESSAGES
+        if not keep_anyway and used + counts[idx] > budget - summary_reserve:
+            break
+        used += counts[idx]
+        cut = idx
+    if cut == 0:
+        return system + list(messages), {'estimated_tokens': full, 'budget': budget}
+    assembled = list(system)
+    summary = ''
+    if ref_id is not None:
+        summary = _summary_for(scope, ref_id, messages[:cut], keys[:cut])
+    if not summary:
+        summary = _digest(messages[:cut], SUMMARY_MAX_CHARS)
+    summary_message = {'role': 'system', 'content': 'Summary of the earlier conversation:\n' + summary}
+    assembled.append(summary_message)
+    assembled.extend(messages[cut:])
+    estimated = used + message_tokens(summary_message)
+    _stats['trimmed'] += 1
+    _stats['dropped_messages'] += cut
+    _stats['saved_tokens'] += max(full - estimated, 0)
+    return assembled, {'estimated_tokens': estimated, 'budget': budget, 'summarized_messages': cut}
+
+
+def forget_summary(scope, ref_id):
+    ContextSummary.query.filter_by(scope=scope, ref_id=ref_id).delete(synchronize_session=False)
+
+
+def context_stats():
+    with _pending_lock:
+        pending = len(_pending)
+    return dict(_stats, pending_summaries=pending)
@@ -0,0 +1,147 @@
+import datetime
+
+from sqlalchemy import Text, cast, func, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .blob_store import blob_store
+from .models import Conversation, ConversationMessage
+
+MESSAGE_FIELDS = ('model', 'images', 'sources', 'meta')
+MIGRATION_BATCH = 100
+SEQ_RETRIES = 5
+
+
+def to_row(conversation_id, seq, message, created_at=None):
+    message = blob_store.externalize_message(message)
+    row = {
+        'conversation_id': conversation_id,
+        'seq': seq,
+        'role': message.get('role') or 'user',
+        'content': message.get('content'),
+        'created_at': created_at or datetime.datetime.utcnow()
+    }
+    for field in MESSAGE_FIELDS:
+        row[field] = message.get(field)
+    return row
+
+
+def to_message(row):
+    message = {'role': row.role, 'content': row.content}
+    for field in MESSAGE_FIELDS:
+        value = getattr(row, field)
+        if value is not None:
+            message[field] = value
+    return message
+
+
+def next_seq(conversation_id):
+    last = db.session.query(func.max(ConversationMessage.seq)).filter(ConversationMessage.conversation_id == conversation_id).scalar()
+    return 0 if last is None else last + 1
+
+
+def append_messages(conversation_id, messages):
+    if not messages:
+        return
+    rows = [to_row(conversation_id, None, m) for m in messages]
+    for attempt in range(SEQ_RETRIES):
+        start = next_seq(conversation_id)
+        for i, row in enumerate(rows):
+            row['seq'] = start + i
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(ConversationMessage), rows)
+            return
+        except IntegrityError:
+            if attempt == SEQ_RETRIES - 1:
+                raise
+
+
+def load_rows(conversation_id, after=None, last=None):
+    query = ConversationMessage.query.filter(ConversationMessage.conversation_id == conversation_id)
+    if after is not None:
+        query = query.filter(ConversationMessage.seq > after)
+    if last:
+        return list(reversed(query.order_by(ConversationMessage.seq.desc()).limit(last).all()))
+    return query.order_by(ConversationMessage.seq.asc()).all()
+
+
+def load_messages(conversation_id, after=None, last=None):
+    return [to_message(row) for row in load_rows(conversation_id, after, last)]
+
+
+def first_messages(conversation_ids):
+    rows = db.session.query(ConversationMessage.conversation_id, ConversationMessage.content).filter(
+        ConversationMessage.conversation_id.in_(conversation_ids),
+        ConversationMessage.seq == 0
+    ).all()
+    return {cid: {'role': 'user', 'content': content} for cid, content in rows}
+
+
+def assistant_usage(user_id=None):
+    query = db.session.query(ConversationMessage.model, ConversationMessage.meta).filter(
+        ConversationMessage.role == 'assistant',
+        ConversationMessage.model.isnot(None)
+    )
+    if user_id is not None:
+        query = query.join(Conversation, Conversation.id == ConversationMessage.conversation_id).filter(Conversation.user_id == user_id)
+    return query.all()
+
+
+def delete_messages(conversation_id):
+    ConversationMessage.query.filter(ConversationMessage.conversation_id == conversation_id).delete(synchronize_session=False)
+
+
+def migrate_conversation_blobs():
+    migrated = 0
+    last_id = 0
+    while True:
+        convs = db.session.query(Conversation.id, Conversation.messages, Conversation.updated_at).filter(
+            Conversation.id > last_id
+        ).order_by(Conversation.id.asc()).limit(MIGRATION_BATCH).all()
+        if not convs:
+            break
+        last_id = convs[-1].id
+        done = []
+        for conv_id, blob, updated_at in convs:
+            if not blob:
+                continue
+            start = next_seq(conv_id)
+            rows = [to_row(conv_id, start + i, m, updated_at) for i, m in enumerate(blob) if isinstance(m, dict)]
+            if rows:
+                db.session.execute(insert(ConversationMessage), rows)
+            done.append(conv_id)
+        if done:
+            db.session.execute(
+                update(Conversation).where(Conversation.id.in_(done)).values(messages=[], updated_at=Conversation.updated_at)
+            )
+            db.session.commit()
+            migrated += len(done)
+    return migrated
+
+
+def migrate_inline_blobs():
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = ConversationMessage.query.filter(
+            ConversationMessage.id > last_id,
+            or_(
+                cast(ConversationMessage.content, Text).like('%"url": "data:%'),
+                cast(ConversationMessage.content, Text).like('%"url":"data:%'),
+                cast(ConversationMessage.images, Text).like('%"data:image/%')
+            )
+        ).order_by(ConversationMessage.id.asc()).limit(MIGRATION_BATCH).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        for row in rows:
+            message = blob_store.externalize_message({'content': row.content, 'images': row.images})
+            if isinstance(row.content, list):
+                row.content = message['content']
+            if row.images:
+                row.images = message['images']
+            migrated += 1
+        db.session.commit()
+        db.session.expunge_all()
+    return migrated
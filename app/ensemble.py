@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+from queue import Queue, Empty
+
+from .sse_parser import iter_batches
+
+ULTIMATE_CANDIDATE_TIMEOUT_MS = float(os.getenv('ULTIMATE_CANDIDATE_TIMEOUT_MS', '60000'))
+ULTIMATE_QUORUM = int(os.getenv('ULTIMATE_QUORUM', '2'))
+ULTIMATE_QUORUM_GRACE_MS = float(os.getenv('ULTIMATE_QUORUM_GRACE_MS', '2000'))
+ULTIMATE_PROGRESS_MS = float(os.getenv('ULTIMATE_PROGRESS_MS', '500'))
+
+_lock = threading.Lock()
+_stats = {
+    'runs': 0,
+    'exits': {'all': 0, 'quorum': 0, 'deadline': 0, 'aborted': 0},
+    'candidates': {'done': 0, 'failed': 0, 'timeout': 0, 'cancelled': 0},
+    'wait_ms': 0.0,
+    'max_wait_ms': 0.0
+}
+
+
+def _run_candidate(model, open_stream, events, stop, settle):
+    resp = None
+    parts = []
+    images = []
+    usage = None
+    size = 0
+    try:
+        resp = open_stream(model)
+        for batch in iter_batches(resp):
+            for kind, value in batch:
+                if kind == 'content':
+                    parts.append(value)
+                    size += len(value)
+                elif kind == 'images':
+                    images.extend(value)
+                elif kind == 'usage':
+                    usage = value
+                elif kind == 'error':
+                    events.put((model, 'failed', value))
+                    return
+            if stop.is_set():
+                break
+            events.put((model, 'progress', size))
+    except Exception as exc:
+        if not stop.is_set():
+            events.put((model, 'failed', str(exc)))
+            return
+    finally:
+        if resp is not None:
+            resp.close()
+    if resp is not None:
+        settle(model, {
+            'model': model,
+            'content': ''.join(parts),
+            'images': images,
+            'usage': usage,
+            'provider_id': getattr(resp, 'provider_id', None)
+        })
+
+
+def collect_candidates(models, open_stream, on_progress=None, on_dropped=None, should_stop=None, quorum=None, timeout_ms=None, grace_ms=None):
+    quorum = max(1, min(quorum or ULTIMATE_QUORUM, len(models)))
+    timeout = (timeout_ms if timeout_ms is not None else ULTIMATE_CANDIDATE_TIMEOUT_MS) / 1000.0
+    grace = (grace_ms if grace_ms is not None else ULTIMATE_QUORUM_GRACE_MS) / 1000.0
+    interval = ULTIMATE_PROGRESS_MS / 1000.0
+    events = Queue()
+    stop = threading.Event()
+    settle_lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + timeout
+
+    def report(model, status, chars=0):
+        if on_progress is not None:
+            on_progress({'type': 'candidate', 'model': model, 'status': status, 'chars': chars})
+
+    def settle(model, result):
+        with settle_lock:
+            if not stop.is_set():
+                events.put((model, 'done', result))
+                return
+        if on_dropped is not None:
+            on_dropped(result)
+
+    pending = list(models)
+    for model in models:
+        report(model, 'running')
+        threading.Thread(target=_run_candidate, args=(model, open_stream, events, stop, settle), daemon=True).start()
+
+    reported = {}
+    results = []
+    failed = []
+    quorum_at = None
+    aborted = False
+    while pending:
+        if should_stop is not None and should_stop():
+            aborted = True
+            break
+        now = time.monotonic()
+        limit = deadline if quorum_at is None else min(deadline, quorum_at + grace)
+        if now >= limit:
+            break
+        try:
+            model, kind, value = events.get(timeout=min(limit - now, 0.25))
+        except Empty:
+            continue
+        if kind == 'progress':
+            now = time.monotonic()
+            if model in pending and now - reported.get(model, 0) >= interval:
+                reported[model] = now
+                report(model, 'running', value)
+        elif kind == 'done':
+            pending.remove(model)
+            results.append(value)
+            report(model, 'done', len(value['content']))
+            if quorum_at is None and len(results) >= quorum:
+                quorum_at = time.monotonic()
+        elif kind == 'failed':
+            pending.remove(model)
+            failed.append({'model': model, 'error': value})
+            report(model, 'failed')
+
+    with settle_lock:
+        stop.set()
+    late = []
+    while True:
+        try:
+            model, kind, value = events.get_nowait()
+        except Empty:
+            break
+        if kind == 'done' and model in pending:
+            late.append(value)
+    if on_dropped is not None:
+        for item in late:
+            on_dropped(item)
+    waited = time.monotonic() - started
+    if aborted:
+        exit_reason = 'aborted'
+    elif not pending:
+        exit_reason = 'all'
+    elif quorum_at is not None and time.monotonic() < deadline:
+        exit_reason = 'quorum'
+    else:
+        exit_reason = 'deadline'
+    dropped_status = 'timeout' if exit_reason == 'deadline' else 'cancelled'
+    for model in pending:
+        report(model, dropped_status)
+
+    with _lock:
+        _stats['runs'] += 1
+        _stats['exits'][exit_reason] += 1
+        _stats['candidates']['done'] += len(results)
+        _stats['candidates']['failed'] += len(failed)
+        _stats['candidates'][dropped_status] += len(pending)
+        _stats['wait_ms'] += waited * 1000
+        _stats['max_wait_ms'] = max(_stats['max_wait_ms'], round(waited * 1000, 1))
+    return {
+        'results': results,
+        'failed': failed,
+        'dropped': list(pending),
+        'aborted': aborted,
+        'waited_ms': round(waited * 1000, 1)
+    }
+
+
+def ensemble_stats():
+    with _lock:
+        stats = dict(_stats, exits=dict(_stats['exits']), candidates=dict(_stats['candidates']))
+    stats['avg_wait_ms'] = round(stats.pop('wait_ms') / stats['runs'], 1) if stats['runs'] else 0
+    stats['quorum'] = ULTIMATE_QUORUM
+    stats['candidate_timeout_ms'] = ULTIMATE_CANDIDATE_TIMEOUT_MS
+    stats['quorum_grace_ms'] = ULTIMATE_QUORUM_GRACE_MS
+    return stats
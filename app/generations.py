@@ -0,0 +1,202 @@
+import os
+import secrets
+import threading
+import time
+from collections import deque
+
+from .sse_writer import StreamWriter, sse_frame
+
+STREAM_REPLAY_BYTES = int(os.getenv('STREAM_REPLAY_BYTES', str(512 * 1024)))
+STREAM_RESUME_GRACE_MS = float(os.getenv('STREAM_RESUME_GRACE_MS', '10000'))
+STREAM_RETAIN_MS = float(os.getenv('STREAM_RETAIN_MS', '60000'))
+STREAM_KEEPALIVE_S = float(os.getenv('STREAM_KEEPALIVE_S', '15'))
+
+
+class Generation:
+    def __init__(self, owner, replay_bytes=None):
+        self.id = secrets.token_urlsafe(12)
+        self.owner = owner
+        self.replay_bytes = replay_bytes or STREAM_REPLAY_BYTES
+        self.writer = StreamWriter()
+        self.frames = deque()
+        self.size = 0
+        self.seq = 0
+        self.head = None
+        self.texts = []
+        self.evicted_seq = 0
+        self.evicted_text = 0
+        self.clients = 0
+        self.detached_at = time.monotonic()
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def _publish(self, chunk, text=None):
+        if not chunk:
+            return
+        parts = chunk.split(b'\n\n')
+        parts.pop()
+        for part in parts:
+            self.seq += 1
+            frame = b'id: %d\n%s\n\n' % (self.seq, part)
+            if self.head is None:
+                self.head = frame
+                continue
+            if text is not None:
+                self.texts.append(text)
+                entry = (self.seq, frame, len(self.texts))
+                text = None
+            else:
+                entry = (self.seq, frame, None)
+            self.frames.append(entry)
+            self.size += len(frame)
+        while self.size > self.replay_bytes and len(self.frames) > 1:
+            seq, frame, upto = self.frames.popleft()
+            self.size -= len(frame)
+            self.evicted_seq = seq
+            if upto is not None:
+                self.evicted_text = upto
+        self._cond.notify_all()
+
+    def _pending_text(self):
+        return ''.join(self.writer.pending)
+
+    def content(self, text):
+        with self._cond:
+            pending = self._pending_text() + text
+            frame = self.writer.content(text)
+            if frame:
+                self._publish(frame, pending)
+
+    def event(self, payload):
+        with self._cond:
+            pending = self._pending_text()
+            self._publish(self.writer.event(payload), pending or None)
+
+    def tick(self):
+        with self._cond:
+            pending = self._pending_text()
+            frame = self.writer.tick()
+            if frame:
+                self._publish(frame, pending)
+
+    def flush(self):
+        with self._cond:
+            pending = self._pending_text()
+            frame = self.writer.flush()
+            if frame:
+                self._publish(frame, pending)
+
+    @property
+    def text(self):
+        with self._cond:
+            return self.writer.text
+
+    def finish(self):
+        with self._cond:
+            self.finished_at = time.monotonic()
+            self.writer.close()
+            self._cond.notify_all()
+
+    def attach(self):
+        with self._cond:
+            self.clients += 1
+
+    def detach(self):
+        with self._cond:
+            self.clients -= 1
+            if self.clients <= 0:
+                self.clients = 0
+                self.detached_at = time.monotonic()
+
+    def idle_ms(self):
+        with self._cond:
+            if self.clients:
+                return 0.0
+            return (time.monotonic() - self.detached_at) * 1000
+
+    def _snapshot(self):
+        text = ''.join(self.texts[:self.evicted_text])
+        return b'id: %d\n' % self.evicted_seq + sse_frame({'type': 'snapshot', 'content': text})
+
+    def read(self, after, timeout):
+        with self._cond:
+            if after >= self.seq and not self.finished:
+                self._cond.wait(timeout)
+            out = []
+            if after < 1 and self.head is not None:
+                out.append(self.head)
+                after = 1
+            snapshot = False
+            if self.frames and after < self.frames[0][0] - 1:
+                out.append(self._snapshot())
+                snapshot = True
+            for seq, frame, _ in self.frames:
+                if seq > after:
+                    out.append(frame)
+            return out, self.seq, self.finished, snapshot
+
+    def stream(self, after=0, client_gone=None):
+        self.attach()
+        try:
+            while True:
+                frames, last, done, snapshot = self.read(after, STREAM_KEEPALIVE_S)
+                if snapshot:
+                    registry.note('snapshots')
+                if frames:
+                    after = last
+                    yield b''.join(frames)
+                elif not done:
+                    yield b': ping\n\n'
+                if done and after >= last:
+                    return
+                if client_gone is not None and client_gone():
+                    return
+        finally:
+            self.detach()
+
+
+class GenerationRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._stats = {'started': 0, 'resumed': 0, 'snapshots': 0, 'expired': 0}
+
+    def note(self, name):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + 1
+
+    def _purge(self):
+        now = time.monotonic()
+        for gen_id, gen in list(self._items.items()):
+            if gen.finished and (now - gen.finished_at) * 1000 >= STREAM_RETAIN_MS:
+                del self._items[gen_id]
+                self._stats['expired'] += 1
+
+    def create(self, owner):
+        gen = Generation(owner)
+        with self._lock:
+            self._purge()
+            self._items[gen.id] = gen
+            self._stats['started'] += 1
+        return gen
+
+    def get(self, gen_id, owner):
+        with self._lock:
+            self._purge()
+            gen = self._items.get(gen_id)
+        if gen is None or gen.owner != owner:
+            return None
+        return gen
+
+    def stats(self):
+        with self._lock:
+            self._purge()
+            active = sum(1 for gen in self._items.values() if not gen.finished)
+            return dict(self._stats, active=active, retained=len(self._items))
+
+
+registry = GenerationRegistry()
@@ -0,0 +1,125 @@
+import os
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_lock = threading.Lock()
+_session = None
+_adapters = {}
+_counters = {'requests': 0, 'errors': 0}
+
+
+class _NoCookies(DefaultCookiePolicy):
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+def _int_env(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def pool_size():
+    threads = _int_env('THREADS', 4)
+    return _int_env('HTTP_POOL_MAXSIZE', max(10, threads * 2))
+
+
+def connect_timeout():
+    try:
+        return float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+    except ValueError:
+        return 5.0
+
+
+def _host_limits():
+    out = {}
+    raw = os.getenv('HTTP_HOST_LIMITS', '')
+    for item in raw.split(','):
+        host, _, value = item.partition('=')
+        host = host.strip().lower()
+        if host and value.strip().isdigit():
+            out[host] = int(value.strip())
+    return out
+
+
+def _adapter(maxsize):
+    return HTTPAdapter(
+        pool_connections=_int_env('HTTP_POOL_CONNECTIONS', 10),
+        pool_maxsize=maxsize,
+        pool_block=os.getenv('HTTP_POOL_BLOCK', '0') == '1'
+    )
+
+
+def get_session():
+    global _session
+    if _session is not None:
+        return _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            session.cookies.set_policy(_NoCookies())
+            default = _adapter(pool_size())
+            session.mount('https://', default)
+            session.mount('http://', default)
+            _adapters['*'] = default
+            for host, limit in _host_limits().items():
+                adapter = _adapter(limit)
+                session.mount(f'https://{host}', adapter)
+                session.mount(f'http://{host}', adapter)
+                _adapters[host] = adapter
+            _session = session
+    return _session
+
+
+def request(method, url, timeout=120, **kwargs):
+    if not isinstance(timeout, tuple):
+        timeout = (connect_timeout(), timeout)
+    with _lock:
+        _counters['requests'] += 1
+    try:
+        return get_session().request(method, url, timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException:
+        with _lock:
+            _counters['errors'] += 1
+        raise
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def stats():
+    hosts = {}
+    with _lock:
+        adapters = list(_adapters.items())
+        totals = dict(_counters)
+    for name, adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f'{pool.host}:{pool.port}'
+            entry = hosts.setdefault(host, {'connections': 0, 'requests': 0, 'maxsize': adapter._pool_maxsize})
+            entry['connections'] += pool.num_connections
+            entry['requests'] += pool.num_requests
+    for entry in hosts.values():
+        entry['reused'] = max(entry['requests'] - entry['connections'], 0)
+    return {
+        'requests': totals['requests'],
+        'errors': totals['errors'],
+        'pool_maxsize': pool_size(),
+        'connect_timeout': connect_timeout(),
+        'hosts': hosts
+    }
@@ -0,0 +1,124 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import bindparam, update
+
+from . import db
+from .models import UserKey
+
+KEY_FIELDS = (
+    'id', 'name',
+    'rate_limit_enabled', 'rate_limit_value', 'rate_limit_period',
+    'token_limit_enabled', 'token_limit_value', 'token_limit_period',
+    'rate_limit_per_min', 'token_limit_per_day'
+)
+
+
+class CachedKey:
+    __slots__ = KEY_FIELDS
+
+    def __init__(self, row):
+        for field in KEY_FIELDS:
+            setattr(self, field, getattr(row, field))
+
+
+class KeyCache:
+    def __init__(self, size=None, ttl=None):
+        self.size = size or int(os.getenv('KEY_CACHE_SIZE', '1024'))
+        self.ttl = ttl if ttl is not None else float(os.getenv('KEY_CACHE_TTL', '60'))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._ids = {}
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def authenticate(self, token):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        row = UserKey.query.filter_by(key=token, enabled=True).first()
+        if not row:
+            return None
+        cached = CachedKey(row)
+        with self._lock:
+            self._entries[token] = (cached, now)
+            self._entries.move_to_end(token)
+            self._ids[cached.id] = token
+            while len(self._entries) > self.size:
+                _, (old, _) = self._entries.popitem(last=False)
+                self._ids.pop(old.id, None)
+        return cached
+
+    def invalidate(self, key_id):
+        with self._lock:
+            self._touched.pop(key_id, None)
+            token = self._ids.pop(key_id, None)
+            if token is not None:
+                self._entries.pop(token, None)
+
+    def touch(self, key_id, when=None):
+        with self._lock:
+            self._touched[key_id] = when or datetime.utcnow()
+
+    def flush(self):
+        with self._lock:
+            pending = self._touched
+            self._touched = {}
+        if not pending:
+            return 0
+        try:
+            table = UserKey.__table__
+            stmt = update(table).where(table.c.id == bindparam('kid')).values(last_used_at=bindparam('ts'))
+            db.session.execute(stmt, [{'kid': kid, 'ts': ts} for kid, ts in pending.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for kid, ts in pending.items():
+                    self._touched.setdefault(kid, ts)
+            raise
+        self.flushes += 1
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'pending_last_used': len(self._touched),
+                'flushes': self.flushes
+            }
+
+
+key_cache = KeyCache()
+
+
+def start_last_used_flusher(app):
+    interval = float(os.getenv('LAST_USED_FLUSH_INTERVAL', '30'))
+
+    def flush():
+        with app.app_context():
+            try:
+                key_cache.flush()
+            except Exception as exc:
+                app.logger.warning('last_used_at flush failed: %s', exc)
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            flush()
+
+    threading.Thread(target=loop, daemon=True).start()
+    atexit.register(flush)
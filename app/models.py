@@ -39,6 +39,8 @@ class UsageLog(db.Model):
     total_tokens = db.Column(db.Integer, default=0, nullable=False)
     model = db.Column(db.String(256), nullable=True)
     cost = db.Column(db.Float, default=0.0, nullable=False)
+    cached_tokens = db.Column(db.Integer, default=0, nullable=False)
+    cache_hit = db.Column(db.Boolean, default=False, nullable=False)
 
 class CorsSettings(db.Model):
     __tablename__ = 'cors_settings'
@@ -84,6 +86,22 @@ class Conversation(db.Model):
     user = db.relationship('User', backref='conversations')
 
 
+class ConversationMessage(db.Model):
+    __tablename__ = 'conversation_messages'
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    role = db.Column(db.String(20), nullable=False)
+    content = db.Column(db.JSON, nullable=True)
+    model = db.Column(db.String(256), nullable=True)
+    images = db.Column(db.JSON, nullable=True)
+    sources = db.Column(db.JSON, nullable=True)
+    meta = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('conversation_id', 'seq', name='uq_conversation_message_seq'),)
+
+
 class CollabRoom(db.Model):
     __tablename__ = 'collab_rooms'
     id = db.Column(db.Integer, primary_key=True)
@@ -122,3 +140,16 @@ class CollabMessage(db.Model):
 
     room = db.relationship('CollabRoom', backref='messages')
     user = db.relationship('User')
+
+
+class ContextSummary(db.Model):
+    __tablename__ = 'context_summaries'
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(20), nullable=False)
+    ref_id = db.Column(db.Integer, nullable=False)
+    upto = db.Column(db.Integer, nullable=False)
+    summary = db.Column(db.Text, default='', nullable=False)
+    model = db.Column(db.String(256), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('scope', 'ref_id', name='uq_context_summary_scope_ref'),)
@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+TRACKING_PREFIXES = ('utm_', 'fbclid', 'gclid', 'mc_', 'ref_src')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    body TEXT,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+)
+'''
+
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.lower().startswith(TRACKING_PREFIXES))
+    return urlunsplit((scheme, host, parts.path or '/', urlencode(query), ''))
+
+
+class PageCache:
+    def __init__(self, path=None, ttl=None, negative_ttl=None, max_bytes=None):
+        self.path = path or os.getenv('PAGE_CACHE_PATH', os.path.join('instance', 'page_cache.db'))
+        self.ttl = ttl if ttl is not None else float(os.getenv('PAGE_CACHE_TTL', '21600'))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else float(os.getenv('PAGE_CACHE_NEGATIVE_TTL', '600'))
+        self.max_bytes = max_bytes or int(os.getenv('PAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+        self.touch_interval = 60
+        self._lock = threading.Lock()
+        self._conn = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(SCHEMA)
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_pages_accessed ON pages (accessed_at)')
+            self.total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get(self, url):
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute('SELECT body, expires_at, accessed_at FROM pages WHERE url = ?', (key,)).fetchone()
+                if row is None or row[1] <= now:
+                    self.misses += 1
+                    return False, None
+                if now - row[2] >= self.touch_interval:
+                    conn.execute('UPDATE pages SET accessed_at = ? WHERE url = ?', (now, key))
+            except sqlite3.Error:
+                self.errors += 1
+                return False, None
+            if row[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, row[0]
+
+    def put(self, url, body):
+        key = normalize_url(url)
+        now = time.time()
+        size = len(key) + (len(body.encode('utf-8')) if body else 0)
+        expires_at = now + (self.ttl if body is not None else self.negative_ttl)
+        with self._lock:
+            try:
+                conn = self._connect()
+                old = conn.execute('SELECT size FROM pages WHERE url = ?', (key,)).fetchone()
+                conn.execute(
+                    'INSERT OR REPLACE INTO pages (url, body, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                    (key, body, size, expires_at, now)
+                )
+                self.total_bytes += size - (old[0] if old else 0)
+                self.stores += 1
+                if self.total_bytes > self.max_bytes:
+                    self._evict(conn, now)
+            except sqlite3.Error:
+                self.errors += 1
+
+    def _evict(self, conn, now):
+        conn.execute('BEGIN')
+        try:
+            self._evict_rows(conn, now)
+        finally:
+            conn.execute('COMMIT')
+
+    def _evict_rows(self, conn, now):
+        target = int(self.max_bytes * 0.9)
+        freed = conn.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM pages WHERE expires_at <= ?', (now,)).fetchone()
+        conn.execute('DELETE FROM pages WHERE expires_at <= ?', (now,))
+        self.total_bytes -= freed[0]
+        self.evictions += freed[1]
+        while self.total_bytes > target:
+            rows = conn.execute('SELECT url, size FROM pages ORDER BY accessed_at ASC LIMIT 100').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for url, size in rows:
+                if self.total_bytes <= target:
+                    break
+                conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'errors': self.errors
+            }
+
+
+page_cache = PageCache()
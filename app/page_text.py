@@ -0,0 +1,133 @@
+import codecs
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+SKIP_TAGS = frozenset(('script', 'style', 'noscript', 'template', 'svg'))
+TEXT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+PARSER_BACKEND = 'lxml' if etree is not None else 'html.parser'
+
+
+def text_content_type(content_type):
+    content_type = (content_type or '').split(';', 1)[0].strip().lower()
+    return content_type if content_type in TEXT_TYPES else None
+
+
+def _codec(encoding):
+    try:
+        return codecs.lookup(encoding or 'utf-8').name
+    except LookupError:
+        return 'utf-8'
+
+
+def response_encoding(resp):
+    if 'charset=' in resp.headers.get('Content-Type', '').lower() and resp.encoding:
+        return _codec(resp.encoding)
+    return 'utf-8'
+
+
+def capped_chunks(resp, max_bytes, chunk_size=16384):
+    received = 0
+    for chunk in resp.iter_content(chunk_size):
+        if not chunk:
+            continue
+        if received + len(chunk) > max_bytes:
+            chunk = chunk[:max_bytes - received]
+        received += len(chunk)
+        yield chunk
+        if received >= max_bytes:
+            break
+
+
+class TextCollector:
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.skip = 0
+        self.glue = False
+
+    @property
+    def full(self):
+        return self.size >= self.limit
+
+    def start(self, tag, attrs=None):
+        self.glue = False
+        if tag in SKIP_TAGS:
+            self.skip += 1
+
+    def end(self, tag):
+        self.glue = False
+        if tag in SKIP_TAGS and self.skip:
+            self.skip -= 1
+
+    def data(self, text):
+        if self.skip or self.size >= self.limit or not text:
+            return
+        words = text.split()
+        if words and self.glue and not text[0].isspace():
+            self.parts[-1] += words[0]
+            self.size += len(words[0])
+            words = words[1:]
+        for word in words:
+            self.parts.append(word)
+            self.size += len(word) + 1
+        self.glue = bool(self.parts) and not text[-1].isspace()
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return ' '.join(self.parts)[:self.limit]
+
+
+class _StdlibParser(HTMLParser):
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def make_parser(target, backend=None):
+    backend = backend or PARSER_BACKEND
+    if backend == 'lxml':
+        return etree.HTMLParser(target=target, recover=True, no_network=True)
+    return _StdlibParser(target)
+
+
+def extract_text(chunks, limit, encoding='utf-8', html=True, backend=None):
+    collector = TextCollector(limit)
+    parser = make_parser(collector, backend) if html else None
+    decoder = codecs.getincrementaldecoder(_codec(encoding))(errors='replace')
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if not text:
+            continue
+        if parser is None:
+            collector.data(text)
+        else:
+            parser.feed(text)
+        if collector.full:
+            return collector.close()
+    tail = decoder.decode(b'', final=True)
+    if parser is None:
+        collector.data(tail)
+        return collector.close()
+    if tail:
+        parser.feed(tail)
+    try:
+        parser.close()
+    except Exception:
+        pass
+    return collector.close()
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+
+from flask import current_app
+
+_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PREFLIGHT_WORKERS', str(max(8, int(os.getenv('THREADS', '8')) * 2)))),
+    thread_name_prefix='preflight'
+)
+_stats_lock = threading.Lock()
+_stats = defaultdict(lambda: {'runs': 0, 'timeouts': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class Preflight:
+    def __init__(self, deadline_ms=None):
+        self.deadline = (deadline_ms if deadline_ms is not None else float(os.getenv('PREFLIGHT_DEADLINE_MS', '10000'))) / 1000.0
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.outcomes = {}
+        self._futures = {}
+        self._fallbacks = {}
+
+    def remaining(self):
+        return max(self.deadline - (time.perf_counter() - self.started), 0)
+
+    def submit(self, name, fn, *args, fallback=None, **kwargs):
+        app = current_app._get_current_object()
+
+        def call():
+            begun = time.perf_counter()
+            try:
+                with app.app_context():
+                    return fn(*args, **kwargs)
+            finally:
+                self.timings.setdefault(name, _ms(time.perf_counter() - begun))
+
+        self._fallbacks[name] = fallback
+        self._futures[name] = _pool.submit(call)
+
+    def result(self, name):
+        future = self._futures.get(name)
+        if future is None:
+            return self._fallbacks.get(name)
+        waited = time.perf_counter()
+        try:
+            value = future.result(timeout=self.remaining())
+            self.outcomes[name] = 'ok'
+            return value
+        except FutureTimeout:
+            self.outcomes[name] = 'timeout'
+            self.timings[name] = _ms(time.perf_counter() - self.started)
+            current_app.logger.info('preflight stage %s overran the %.0f ms deadline', name, self.deadline * 1000)
+        except Exception as exc:
+            self.outcomes[name] = 'error'
+            self.timings.setdefault(name, _ms(time.perf_counter() - waited))
+            current_app.logger.warning('preflight stage %s failed: %s', name, exc)
+        return self._fallbacks.get(name)
+
+    @contextmanager
+    def stage(self, name):
+        begun = time.perf_counter()
+        try:
+            yield
+            self.outcomes[name] = 'ok'
+        except Exception:
+            self.outcomes[name] = 'error'
+            raise
+        finally:
+            self.timings[name] = _ms(time.perf_counter() - begun)
+
+    def run(self, name, fn, *args, **kwargs):
+        with self.stage(name):
+            return fn(*args, **kwargs)
+
+    def finish(self):
+        self.timings['preflight'] = _ms(time.perf_counter() - self.started)
+        with _stats_lock:
+            for name, ms in list(self.timings.items()):
+                entry = _stats[name]
+                entry['runs'] += 1
+                entry['total_ms'] += ms
+                entry['max_ms'] = max(entry['max_ms'], ms)
+                outcome = self.outcomes.get(name)
+                if outcome == 'timeout':
+                    entry['timeouts'] += 1
+                elif outcome == 'error':
+                    entry['errors'] += 1
+        return self.timings
+
+    def server_timing(self):
+        return ', '.join(f'{name};dur={ms}' for name, ms in list(self.timings.items()))
+
+
+def preflight_stats():
+    with _stats_lock:
+        return {
+            name: {
+                'runs': entry['runs'],
+                'timeouts': entry['timeouts'],
+                'errors': entry['errors'],
+                'avg_ms': round(entry['total_ms'] / entry['runs'], 1) if entry['runs'] else 0,
+                'max_ms': entry['max_ms']
+            }
+            for name, entry in _stats.items()
+        }
@@ -0,0 +1,92 @@
+import os
+import threading
+
+PROMPT_CACHE_HINTS = os.getenv('PROMPT_CACHE_HINTS', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+PROMPT_CACHE_MODELS = tuple(p.strip() for p in os.getenv('PROMPT_CACHE_MODELS', 'anthropic/,google/gemini').split(',') if p.strip())
+PROMPT_CACHE_MIN_CHARS = int(os.getenv('PROMPT_CACHE_MIN_CHARS', '4096'))
+CACHE_CONTROL = {'type': 'ephemeral'}
+
+_lock = threading.Lock()
+_stats = {'prompts': 0, 'with_volatile': 0, 'hinted': 0, 'usage_reports': 0, 'prompt_tokens': 0, 'cached_tokens': 0}
+
+
+def wants_cache_hints(model):
+    return PROMPT_CACHE_HINTS and bool(model) and model.startswith(PROMPT_CACHE_MODELS)
+
+
+def _size(message):
+    content = message.get('content')
+    if isinstance(content, list):
+        return sum(len(part.get('text') or '') for part in content if isinstance(part, dict))
+    return len(content or '')
+
+
+def _parts(content):
+    if isinstance(content, list):
+        return [dict(part) for part in content if isinstance(part, dict)]
+    return [{'type': 'text', 'text': content or ''}]
+
+
+def _mark(message):
+    parts = _parts(message.get('content'))
+    if not parts:
+        return message
+    parts[-1]['cache_control'] = CACHE_CONTROL
+    return dict(message, content=parts)
+
+
+def _with_volatile(message, blocks):
+    parts = [{'type': 'text', 'text': block} for block in blocks]
+    return dict(message, content=parts + _parts(message.get('content')))
+
+
+def layout_prompt(messages, volatile=None, model=None):
+    messages = list(messages)
+    blocks = [block for block in (volatile or ()) if block]
+    if blocks:
+        if messages and messages[-1].get('role') == 'user':
+            messages[-1] = _with_volatile(messages[-1], blocks)
+        else:
+            messages.append({'role': 'system', 'content': '\n\n'.join(blocks)})
+    hinted = False
+    if wants_cache_hints(model) and len(messages) > 1:
+        prefix = 0
+        while prefix < len(messages) - 1 and messages[prefix].get('role') == 'system':
+            prefix += 1
+        breakpoints = []
+        if prefix:
+            breakpoints.append(prefix - 1)
+        if len(messages) - 2 >= prefix:
+            breakpoints.append(len(messages) - 2)
+        size = 0
+        marked = 0
+        for idx, message in enumerate(messages[:-1]):
+            size += _size(message)
+            if idx in breakpoints and size >= PROMPT_CACHE_MIN_CHARS:
+                messages[idx] = _mark(message)
+                marked += 1
+        hinted = marked > 0
+    with _lock:
+        _stats['prompts'] += 1
+        if blocks:
+            _stats['with_volatile'] += 1
+        if hinted:
+            _stats['hinted'] += 1
+    return messages
+
+
+def note_prompt_usage(prompt_tokens, cached_tokens):
+    if not prompt_tokens:
+        return
+    with _lock:
+        _stats['usage_reports'] += 1
+        _stats['prompt_tokens'] += prompt_tokens
+        _stats['cached_tokens'] += cached_tokens or 0
+
+
+def prompt_cache_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats['hit_rate'] = round(stats['cached_tokens'] / stats['prompt_tokens'], 4) if stats['prompt_tokens'] else 0.0
+    stats['hints_enabled'] = PROMPT_CACHE_HINTS
+    return stats
@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from flask import has_app_context
+
+from . import http_client
+from .models import ProviderKey
+from .quota import provider_usage
+
+ENV_PROVIDER_ID = 1
+
+
+class ProviderUnavailable(Exception):
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ProviderSlot:
+    __slots__ = ('id', 'api_key', 'rate_limit_per_min', 'token_limit_per_day')
+
+    def __init__(self, id, api_key, rate_limit_per_min=0, token_limit_per_day=0):
+        self.id = id
+        self.api_key = api_key
+        self.rate_limit_per_min = rate_limit_per_min or 0
+        self.token_limit_per_day = token_limit_per_day or 0
+
+
+def upstream_base_url():
+    return os.getenv('UPSTREAM_URL', 'https://ai.hackclub.com/proxy/v1').rstrip('/')
+
+
+def _retry_after(resp):
+    try:
+        return float(resp.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderScheduler:
+    def __init__(self):
+        self.refresh_interval = float(os.getenv('PROVIDER_REFRESH_INTERVAL', '30'))
+        self.cooldown_429 = float(os.getenv('PROVIDER_COOLDOWN_429', '30'))
+        self.cooldown_error = float(os.getenv('PROVIDER_COOLDOWN_ERROR', '5'))
+        self.max_attempts = int(os.getenv('PROVIDER_MAX_ATTEMPTS', '3'))
+        self._lock = threading.Lock()
+        self._slots = []
+        self._loaded_at = None
+        self._inflight = defaultdict(int)
+        self._cooldown = {}
+        self._turn = 0
+        self.picks = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.failovers = 0
+
+    def refresh(self, force=False):
+        env_key = os.getenv('UPSTREAM_API_KEY', '')
+        now = time.monotonic()
+        with self._lock:
+            current = self._slots
+            loaded_at = self._loaded_at
+        if env_key:
+            if len(current) == 1 and current[0].api_key == env_key:
+                return
+            slots = [ProviderSlot(ENV_PROVIDER_ID, env_key)]
+        elif force or loaded_at is None or now - loaded_at >= self.refresh_interval:
+            rows = ProviderKey.query.filter_by(enabled=True).order_by(ProviderKey.id.asc()).all()
+            slots = [ProviderSlot(r.id, r.api_key, r.rate_limit_per_min, r.token_limit_per_day) for r in rows]
+            for slot in slots:
+                provider_usage(slot.id, 60, seed=True)
+                provider_usage(slot.id, 86400, seed=True)
+        else:
+            return
+        with self._lock:
+            self._slots = slots
+            self._loaded_at = now
+
+    def _eligible(self, slot):
+        inflight = self._inflight[slot.id]
+        count, _ = provider_usage(slot.id, 60)
+        _, tokens = provider_usage(slot.id, 86400)
+        if slot.rate_limit_per_min and count + inflight >= slot.rate_limit_per_min:
+            return None
+        if slot.token_limit_per_day and tokens >= slot.token_limit_per_day:
+            return None
+        return inflight, count, tokens
+
+    def _choose(self, exclude=(), preferred_key=None):
+        now = time.monotonic()
+        slots = [s for s in self._slots if s.id not in exclude]
+        if not slots:
+            return None
+        ranked = []
+        cooling = []
+        for idx, slot in enumerate(slots):
+            until = self._cooldown.get(slot.id, 0)
+            if until > now:
+                cooling.append((until, slot))
+                continue
+            load = self._eligible(slot)
+            if load is None:
+                continue
+            if preferred_key and slot.api_key == preferred_key:
+                return slot
+            ranked.append((load + ((idx - self._turn) % len(slots),), slot))
+        if ranked:
+            return min(ranked, key=lambda item: item[0])[1]
+        if cooling:
+            return min(cooling, key=lambda item: item[0])[1]
+        return None
+
+    def acquire(self, exclude=(), preferred_key=None):
+        with self._lock:
+            chosen = self._choose(exclude, preferred_key)
+            if chosen is None:
+                return None
+            self._turn += 1
+            if exclude:
+                self.failovers += 1
+            self._inflight[chosen.id] += 1
+            self.picks[chosen.id] += 1
+            return chosen
+
+    def release(self, slot, status=None, failed=False, retry_after=None):
+        with self._lock:
+            self._inflight[slot.id] = max(self._inflight[slot.id] - 1, 0)
+            if status == 429:
+                self._cooldown[slot.id] = time.monotonic() + (retry_after or self.cooldown_429)
+            elif failed or (status is not None and status >= 500):
+                self._cooldown[slot.id] = time.monotonic() + self.cooldown_error
+            else:
+                if status is not None:
+                    self._cooldown.pop(slot.id, None)
+                return
+            self.failures[slot.id] += 1
+
+    def unavailable(self):
+        with self._lock:
+            empty = not self._slots
+        if empty:
+            return ProviderUnavailable('No upstream provider configured', 500)
+        return ProviderUnavailable('All upstream provider keys are at their limits', 429)
+
+    def pick(self):
+        if has_app_context():
+            self.refresh()
+        with self._lock:
+            slot = self._choose()
+        if slot is None:
+            raise self.unavailable()
+        return slot
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'providers': [
+                    {
+                        'id': s.id,
+                        'inflight': self._inflight[s.id],
+                        'picks': self.picks[s.id],
+                        'failures': self.failures[s.id],
+                        'cooldown': max(round(self._cooldown.get(s.id, 0) - now, 1), 0)
+                    }
+                    for s in self._slots
+                ],
+                'failovers': self.failovers
+            }
+
+
+scheduler = ProviderScheduler()
+
+
+def _release_on_close(resp, slot):
+    pending = [slot]
+    close = resp.close
+
+    def release_and_close():
+        try:
+            close()
+        finally:
+            try:
+                scheduler.release(pending.pop(), status=resp.status_code)
+            except IndexError:
+                pass
+
+    resp.close = release_and_close
+
+
+def upstream_request(path, payload=None, method='POST', timeout=120, stream=False, preferred_key=None, base_url=None, **kwargs):
+    if has_app_context():
+        scheduler.refresh()
+    url = (base_url or upstream_base_url()) + path
+    tried = set()
+    last = None
+    for attempt in range(max(scheduler.max_attempts, 1)):
+        slot = scheduler.acquire(exclude=tried, preferred_key=preferred_key if attempt == 0 else None)
+        if slot is None:
+            break
+        tried.add(slot.id)
+        headers = {'Authorization': f'Bearer {slot.api_key}'}
+        if payload is not None:
+            headers['Content-Type'] = 'application/json'
+            kwargs['data'] = json.dumps(payload)
+        try:
+            resp = http_client.request(method, url, headers=headers, timeout=timeout, stream=stream, **kwargs)
+        except requests.exceptions.RequestException as exc:
+            scheduler.release(slot, failed=True)
+            last = exc
+            continue
+        if resp.status_code == 429 or resp.status_code >= 500:
+            scheduler.release(slot, status=resp.status_code, retry_after=_retry_after(resp))
+            if isinstance(last, requests.Response):
+                last.close()
+            last = resp
+            resp.provider_id = slot.id
+            continue
+        if stream and resp.ok:
+            _release_on_close(resp, slot)
+        else:
+            scheduler.release(slot, status=resp.status_code)
+        resp.provider_id = slot.id
+        return resp
+    if isinstance(last, requests.Response):
+        return last
+    if last is not None:
+        raise last
+    raise scheduler.unavailable()
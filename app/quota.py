@@ -0,0 +1,233 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import or_
+
+from . import db
+from .models import UsageLog, UserKey
+from .usage_writer import usage_writer
+
+PERIOD_SECONDS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800, 'month': 2592000}
+QUOTA_SEED_WAIT = float(os.getenv('QUOTA_SEED_WAIT', '10'))
+
+
+class SlidingWindow:
+    def __init__(self, seconds, slots=60):
+        self.seconds = seconds
+        self.slots = slots
+        self.width = float(seconds) / slots
+        self.requests = [0] * slots
+        self.tokens = [0] * slots
+        self.request_total = 0
+        self.token_total = 0
+        self.head = None
+
+    def _advance(self, now):
+        idx = int(now // self.width)
+        if self.head is None:
+            self.head = idx
+        elif idx > self.head:
+            if idx - self.head >= self.slots:
+                self.requests = [0] * self.slots
+                self.tokens = [0] * self.slots
+                self.request_total = 0
+                self.token_total = 0
+            else:
+                for i in range(self.head + 1, idx + 1):
+                    slot = i % self.slots
+                    self.request_total -= self.requests[slot]
+                    self.token_total -= self.tokens[slot]
+                    self.requests[slot] = 0
+                    self.tokens[slot] = 0
+            self.head = idx
+        return self.head
+
+    def add(self, tokens=0, requests=1, at=None, now=None):
+        head = self._advance(time.time() if now is None else now)
+        idx = head if at is None else min(int(at // self.width), head)
+        if head - idx >= self.slots:
+            return
+        slot = idx % self.slots
+        self.requests[slot] += requests
+        self.tokens[slot] += tokens
+        self.request_total += requests
+        self.token_total += tokens
+
+    def totals(self, now=None):
+        self._advance(time.time() if now is None else now)
+        return self.request_total, self.token_total
+
+
+class _Seeding:
+    def __init__(self):
+        self.records = []
+        self.done = threading.Event()
+
+
+class QuotaEngine:
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or int(os.getenv('QUOTA_MAX_ENTRIES', '20000'))
+        self._lock = threading.Lock()
+        self._scopes = {}
+        self.seeds = 0
+
+    def _entry(self, scope, ident, create=True):
+        table = self._scopes.get(scope)
+        if table is None:
+            if not create:
+                return None
+            table = self._scopes[scope] = OrderedDict()
+        entry = table.get(ident)
+        if entry is None:
+            if not create:
+                return None
+            entry = table[ident] = {}
+            while len(table) > self.max_entries:
+                table.popitem(last=False)
+        else:
+            table.move_to_end(ident)
+        return entry
+
+    def usage(self, scope, ident, seconds, seed=None, guard=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entry(scope, ident, create=seed is None)
+            window = entry.get(seconds) if entry is not None else None
+            if window is None and seed is None:
+                window = entry[seconds] = SlidingWindow(seconds)
+            if isinstance(window, SlidingWindow):
+                return window.totals(now)
+        if window is None:
+            with guard() if guard is not None else nullcontext():
+                with self._lock:
+                    entry = self._entry(scope, ident)
+                    window = entry.get(seconds)
+                    if isinstance(window, SlidingWindow):
+                        return window.totals(now)
+                    if window is None:
+                        pending = entry[seconds] = _Seeding()
+                if window is None:
+                    return self._seed(scope, ident, seconds, seed, pending, now)
+        window.done.wait(QUOTA_SEED_WAIT)
+        with self._lock:
+            window = self._entry(scope, ident).get(seconds)
+            if isinstance(window, SlidingWindow):
+                return window.totals()
+            if window is None:
+                return 0, 0
+            return len(window.records), sum(tokens for _, tokens, _ in window.records)
+
+    def _seed(self, scope, ident, seconds, seed, pending, now):
+        try:
+            rows, queued = seed(seconds)
+        except Exception:
+            with self._lock:
+                entry = self._entry(scope, ident)
+                if entry.get(seconds) is pending:
+                    del entry[seconds]
+                pending.done.set()
+            raise
+        window = SlidingWindow(seconds)
+        for ts, tokens in rows:
+            window.add(tokens, at=ts, now=now)
+        seen = {id(row) for row in queued}
+        with self._lock:
+            now = time.time()
+            for at, tokens, ref in pending.records:
+                if ref is None or id(ref) not in seen:
+                    window.add(tokens, at=at, now=now)
+            self._entry(scope, ident)[seconds] = window
+            self.seeds += 1
+            pending.done.set()
+            return window.totals(now)
+
+    def record(self, scope, ident, tokens=0, ref=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entry(scope, ident, create=False)
+            if not entry:
+                return
+            for window in entry.values():
+                if isinstance(window, _Seeding):
+                    window.records.append((now, tokens, ref))
+                else:
+                    window.add(tokens, now=now)
+
+    def hit(self, scope, ident, seconds, limit):
+        now = time.time()
+        with self._lock:
+            entry = self._entry(scope, ident)
+            window = entry.get(seconds)
+            if window is None:
+                window = entry[seconds] = SlidingWindow(seconds)
+            count, _ = window.totals(now)
+            if count >= limit:
+                return False
+            window.add(now=now)
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': {scope: len(table) for scope, table in self._scopes.items()},
+                'seeds': self.seeds,
+                'max_entries': self.max_entries
+            }
+
+
+quota = QuotaEngine()
+
+
+def _epoch(ts):
+    return ts.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _usage_seed(field, ident):
+    column = getattr(UsageLog, field)
+
+    def seed(seconds):
+        start = datetime.utcnow() - timedelta(seconds=seconds)
+        queued = [row for row in usage_writer.queued() if row.get(field) == ident and row['ts'] >= start]
+        rows = db.session.query(UsageLog.ts, UsageLog.total_tokens).filter(column == ident, UsageLog.ts >= start).all()
+        entries = [(_epoch(ts), int(tokens or 0)) for ts, tokens in rows]
+        entries.extend((_epoch(row['ts']), int(row['total_tokens'] or 0)) for row in queued)
+        return entries, queued
+    return seed
+
+
+def key_usage(user_key_id, period, default=60):
+    seconds = PERIOD_SECONDS.get(period, default)
+    return quota.usage('user_key', user_key_id, seconds, seed=_usage_seed('user_key_id', user_key_id), guard=usage_writer.hold)
+
+
+def provider_usage(provider_id, seconds, seed=False):
+    return quota.usage('provider', provider_id, seconds, seed=_usage_seed('provider_key_id', provider_id) if seed else None, guard=usage_writer.hold)
+
+
+def check_key_limits(user_key, tokens=True):
+    if user_key.rate_limit_enabled and user_key.rate_limit_value > 0:
+        count, _ = key_usage(user_key.id, user_key.rate_limit_period, 60)
+        if count >= user_key.rate_limit_value:
+            return 'rate_limit_exceeded'
+    if tokens and user_key.token_limit_enabled and user_key.token_limit_value > 0:
+        _, used = key_usage(user_key.id, user_key.token_limit_period, 86400)
+        if used >= user_key.token_limit_value:
+            return 'token_limit_exceeded'
+    return None
+
+
+def record_usage(user_key_id, total_tokens, provider_key_id=None, row=None):
+    if user_key_id:
+        quota.record('user_key', user_key_id, int(total_tokens or 0), ref=row)
+    if provider_key_id:
+        quota.record('provider', provider_key_id, int(total_tokens or 0), ref=row)
+
+
+def warm_quota():
+    keys = UserKey.query.filter(UserKey.enabled == True, or_(UserKey.rate_limit_enabled == True, UserKey.token_limit_enabled == True)).all()
+    for k in keys:
+        check_key_limits(k)
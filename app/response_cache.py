@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_HEADER = 'X-Proxy-Cache'
+BYPASS_HEADER = 'X-Proxy-Cache-Bypass'
+IGNORED_FIELDS = ('stream', 'stream_options', 'user')
+TRUTHY = ('1', 'true', 'yes', 'on')
+
+
+def cache_requested(headers):
+    return (headers.get(CACHE_HEADER) or '').strip().lower() in TRUTHY
+
+
+def cache_bypassed(headers):
+    if (headers.get(BYPASS_HEADER) or '').strip().lower() in TRUTHY:
+        return True
+    return 'no-cache' in (headers.get('Cache-Control') or '').lower()
+
+
+def cacheable(endpoint, body):
+    if not isinstance(body, dict) or body.get('stream'):
+        return False
+    if endpoint == 'chat':
+        temperature = body.get('temperature')
+        return isinstance(temperature, (int, float)) and not isinstance(temperature, bool) and temperature == 0
+    return True
+
+
+def cache_key(endpoint, user_key_id, body):
+    canonical = {k: v for k, v in body.items() if k not in IGNORED_FIELDS}
+    raw = json.dumps([endpoint, user_key_id, canonical], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=None, max_entry_bytes=None, ttl=None):
+        self.max_bytes = max_bytes or int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+        self.max_entry_bytes = max_entry_bytes or int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(1024 * 1024)))
+        self.ttl = ttl if ttl is not None else float(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.saved_tokens = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] <= now:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_tokens += entry['tokens']
+            return entry
+
+    def put(self, key, body, content_type, provider_id, model, tokens=0):
+        size = len(body)
+        if size > self.max_entry_bytes:
+            return False
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = {
+                'body': body,
+                'content_type': content_type,
+                'provider_id': provider_id,
+                'model': model,
+                'tokens': tokens,
+                'size': size,
+                'expires_at': time.monotonic() + self.ttl
+            }
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, old = self._entries.popitem(last=False)
+                self.total_bytes -= old['size']
+                self.evictions += 1
+            self.stores += 1
+        return True
+
+    def note_bypass(self):
+        with self._lock:
+            self.bypasses += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'bypasses': self.bypasses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'saved_tokens': self.saved_tokens
+            }
+
+
+response_cache = ResponseCache()
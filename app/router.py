@@ -0,0 +1,232 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from flask import has_app_context
+
+from .catalog import catalog
+from .providers import scheduler, upstream_request
+
+ROUTER_MODEL = os.getenv('ROUTER_MODEL', 'google/gemini-2.5-flash')
+DEFAULT_ROUTE_MODEL = os.getenv('ROUTER_DEFAULT_MODEL', 'google/gemini-2.5-flash')
+IMAGE_ROUTE_MODEL = os.getenv('ROUTER_IMAGE_MODEL', 'google/gemini-2.5-flash-image')
+VISION_ROUTE_MODEL = os.getenv('ROUTER_VISION_MODEL', 'google/gemini-2.5-flash')
+CODE_ROUTE_MODEL = os.getenv('ROUTER_CODE_MODEL', 'openai/gpt-5.1')
+
+IMAGE_PATTERN = re.compile(
+    r'\b(draw|paint|sketch|illustrate|generate|create|make|design)\s+(me\s+)?((an?|some|\d+)\s+(\w+\s+){0,3}?)?'
+    r'(image|picture|photo|drawing|illustration|logo|icon|wallpaper|poster)s?\s*(of|for|showing|depicting|with|that|in|:|$)'
+    r'|\b(draw|paint|sketch)\s+me\s+(an?|some)\s+\w'
+    r'|\b(rajzolj|fess|generalj|keszits|csinalj)\b.{0,30}\b(kepet|rajzot|logot|fotot|ikont|plakatot|hatterkepet)\b'
+    r'|\b(rajzolj|fess)\s+(nekem\s+)?egy\s+\w',
+    re.MULTILINE
+)
+CODE_PATTERN = re.compile(
+    r'```|\btraceback \(most recent call last\)|\b\w{3,}(error|exception): |\bat [\w.$]+\([\w.]+:\d+\)'
+    r'|\b(def|fn|func)\s+\w+\s*\(|\bfunction\s*\w*\s*\([^)]*\)\s*\{|\bclass\s+\w+\s*(\([^)]*\))?\s*[:{]'
+    r'|^\s*(from\s+[\w.]+\s+import\s+\w|import\s+\w+(\.\w+)+\s*$|import\s+[\w.]+\s+as\s+\w+\s*$|#include\s*<)'
+    r'|\b(const|let|var)\s+\w+\s*=\s*[^=]|\w+\([^()]*\)\s*(\{|=>)|\w+\.\w+\([^()]*\);'
+    r'|\b[\w-]+\.(py|js|ts|tsx|jsx|java|rs|go|cpp|cs|php|rb|sh|html|css|json|yaml|yml|sql)\b',
+    re.MULTILINE
+)
+WHITESPACE = re.compile(r'\s+')
+DIGITS = re.compile(r'\d+')
+
+
+def _fold(text):
+    text = text.lower()
+    return text.translate(str.maketrans('áéíóöőúüű', 'aeiooouuu'))
+
+
+class ModelRouter:
+    def __init__(self):
+        self.budget = float(os.getenv('ROUTER_BUDGET_MS', '1200')) / 1000.0
+        self.timeout = float(os.getenv('ROUTER_TIMEOUT', '10'))
+        self.cache_size = int(os.getenv('ROUTER_CACHE_SIZE', '2048'))
+        self.cache_ttl = float(os.getenv('ROUTER_CACHE_TTL', '3600'))
+        self.short_chars = int(os.getenv('ROUTER_SHORT_CHARS', '40'))
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._pool = ThreadPoolExecutor(max_workers=int(os.getenv('ROUTER_WORKERS', '4')), thread_name_prefix='router')
+        self._prompt = (None, '')
+        self.counts = defaultdict(int)
+        self.last_ms = 0.0
+        self.last_error = None
+
+    def _known(self, model_id):
+        return not catalog.models() or catalog.get(model_id) is not None
+
+    def _capable(self, preferred, direction, modality):
+        if self._known(preferred):
+            return preferred
+        for entry in catalog.models():
+            if modality in entry[direction]:
+                return entry['id']
+        return None
+
+    def default_model(self):
+        return DEFAULT_ROUTE_MODEL
+
+    def classify(self, text, has_files):
+        folded = _fold(text)
+        if IMAGE_PATTERN.search(folded):
+            model = self._capable(IMAGE_ROUTE_MODEL, 'output_modalities', 'image')
+            if model:
+                return model, 'image'
+        if has_files:
+            model = self._capable(VISION_ROUTE_MODEL, 'input_modalities', 'image')
+            if model:
+                return model, 'files'
+        if CODE_PATTERN.search(folded) and self._known(CODE_ROUTE_MODEL):
+            return CODE_ROUTE_MODEL, 'code'
+        if len(folded.strip()) <= self.short_chars:
+            return self.default_model(), 'short'
+        return None
+
+    def _features(self, text, has_files):
+        normalized = DIGITS.sub('0', WHITESPACE.sub(' ', _fold(text)).strip())[:500]
+        return hashlib.sha1(f'{int(bool(has_files))}:{catalog.etag}:{normalized}'.encode('utf-8')).hexdigest()
+
+    def _cached(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if now - entry[1] >= self.cache_ttl:
+                self._cache.pop(key, None)
+                return None
+            self._cache.move_to_end(key)
+            return entry[0]
+
+    def _store(self, key, model):
+        with self._lock:
+            self._cache[key] = (model, time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _models_text(self):
+        etag, text = self._prompt
+        if etag == catalog.etag and text:
+            return text
+        lines = [
+            f"{m['id']} | in: {','.join(m['input_modalities'])} | out: {','.join(m['output_modalities'])}"
+            for m in catalog.models()
+        ]
+        text = 'Available models:\n' + '\n'.join(lines)
+        self._prompt = (catalog.etag, text)
+        return text
+
+    def _ask(self, text, has_files, upstream_key, upstream_url):
+        router_prompt = (
+            "You are an intelligent model router. Based on the user's request and available models, "
+            "select the BEST model for the task.\n\n"
+            f"{self._models_text()}\n\n"
+            "Selection Rules:\n"
+            "1. If user asks to generate/create/draw images: choose image-capable models (check modality for 'image' in output).\n"
+            "2. If user uploads files/images: choose multimodal models with 'image' in modality.\n"
+            "3. For coding/complex reasoning: prefer models with strong reasoning capabilities.\n"
+            "4. For general chat: prefer fast, efficient models.\n"
+            "5. For video/document analysis: prefer models with 'video' or 'file' in input modalities.\n\n"
+            "Return ONLY the model ID (e.g., 'google/gemini-3-pro-preview'), nothing else."
+        )
+        resp = upstream_request(
+            '/chat/completions',
+            {
+                'model': ROUTER_MODEL,
+                'messages': [
+                    {'role': 'system', 'content': router_prompt},
+                    {'role': 'user', 'content': f"Request: {text[:500]}\nUser has uploaded files: {has_files}"}
+                ],
+                'temperature': 0.0,
+                'max_tokens': 40
+            },
+            timeout=self.timeout,
+            preferred_key=upstream_key,
+            base_url=upstream_url
+        )
+        try:
+            if resp.status_code != 200:
+                raise RuntimeError(f'router returned {resp.status_code}')
+            model = (resp.json()['choices'][0]['message']['content'] or '').strip().strip('`\'" ')
+        finally:
+            resp.close()
+        if not model or not self._known(model):
+            raise RuntimeError(f'router picked unknown model {model!r}')
+        return model
+
+    def _settle(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+        try:
+            model = future.result()
+        except Exception as exc:
+            self.counts['failures'] += 1
+            self.last_error = str(exc)
+            return
+        self._store(key, model)
+
+    def _consult(self, key, text, has_files, upstream_key, upstream_url):
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                self.counts['coalesced'] += 1
+                return future
+            future = self._pool.submit(self._ask, text, has_files, upstream_key, upstream_url)
+            self._pending[key] = future
+            self.counts['llm_calls'] += 1
+        future.add_done_callback(lambda f: self._settle(key, f))
+        return future
+
+    def route(self, message, has_files, upstream_key=None, upstream_url=None, budget=None):
+        started = time.perf_counter()
+        text = message or ''
+        try:
+            decided = self.classify(text, has_files)
+            if decided:
+                self.counts[decided[1]] += 1
+                return decided[0]
+            if not catalog.models():
+                self.counts['no_catalog'] += 1
+                return self.default_model()
+            key = self._features(text, has_files)
+            model = self._cached(key)
+            if model:
+                self.counts['cache_hits'] += 1
+                return model
+            self.counts['cache_misses'] += 1
+            if has_app_context():
+                scheduler.refresh()
+            future = self._consult(key, text, has_files, upstream_key, upstream_url)
+            remaining = (self.budget if budget is None else budget) - (time.perf_counter() - started)
+            try:
+                return future.result(timeout=max(remaining, 0))
+            except FutureTimeout:
+                self.counts['budget_exceeded'] += 1
+            except Exception:
+                pass
+            return self.default_model()
+        finally:
+            self.last_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._cache)
+            pending = len(self._pending)
+        return {
+            'entries': entries,
+            'pending': pending,
+            'budget_ms': int(self.budget * 1000),
+            'last_ms': self.last_ms,
+            'last_error': self.last_error,
+            **self.counts
+        }
+
+
+router = ModelRouter()
@@ -1,13 +1,29 @@
 import os
 import secrets
 import requests
-import json
 from datetime import datetime, timedelta
 from flask import Blueprint, jsonify, request, session, current_app
-from sqlalchemy import func, cast, Date
-from .models import ProviderKey, UserKey, UsageLog, CorsSettings, User, EmailWhitelist
-from . import db
-from .utils import mask_key
+from sqlalchemy import func, cast, case, Date
+from .models import UserKey, UsageLog, CorsSettings, User, EmailWhitelist
+from . import db, http_client
+from .utils import mask_key, log_usage
+from .quota import quota
+from .catalog import catalog
+from .routes_proxy import invalidate_cors_cache, models_cache_stats
+from .key_cache import key_cache
+from .usage_writer import usage_writer
+from .providers import scheduler, upstream_request, ProviderUnavailable
+from .router import router
+from .preflight import preflight_stats
+from .page_cache import page_cache
+from .search_cache import search_cache
+from .blob_store import blob_store
+from .context import context_stats
+from .prompt_layout import layout_prompt, prompt_cache_stats
+from .sse_writer import sse_stats
+from .generations import registry as generations
+from .ensemble import ensemble_stats
+from .response_cache import response_cache
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -39,53 +55,31 @@ def admin_logout():
 def admin_me():
     return jsonify({'authenticated': 'admin' in session})
 
-def _get_upstream_provider():
-    upstream_key_env = os.getenv('UPSTREAM_API_KEY', '')
-    if upstream_key_env:
-        return upstream_key_env, 1
-    
-    provider = ProviderKey.query.filter_by(enabled=True).first()
-    if not provider:
-        return None, None
-    
-    return provider.api_key, provider.id
-
 def _make_upstream_request(url_path, payload, user_key):
-    upstream_key, provider_id = _get_upstream_provider()
-    if not upstream_key:
-        return jsonify({'error': 'No upstream provider configured'}), 500
-
-    upstream_url = os.getenv('UPSTREAM_URL', 'https://ai.hackclub.com/proxy/v1').rstrip('/') + url_path
-
     try:
-        resp = requests.post(
-            upstream_url,
-            headers={
-                'Authorization': f'Bearer {upstream_key}',
-                'Content-Type': 'application/json'
-            },
-            data=json.dumps(payload),
-            timeout=120
-        )
+        resp = upstream_request(url_path, payload, timeout=120)
+        provider_id = resp.provider_id
 
         if resp.status_code == 200:
             response_data = resp.json()
-            from .utils import extract_tokens
+            from .utils import extract_cached_tokens, extract_tokens
             pt, rt, tt = extract_tokens(response_data)
-            ul = UsageLog(
-                provider_key_id=provider_id,
-                user_key_id=user_key.id,
+            log_usage(
+                provider_id,
+                user_key.id,
                 request_tokens=pt,
                 response_tokens=rt,
-                total_tokens=tt
+                total_tokens=tt,
+                cached_tokens=extract_cached_tokens(response_data)
             )
-            db.session.add(ul)
             user_key.last_used_at = datetime.utcnow()
             db.session.commit()
             return jsonify(response_data)
         else:
             return jsonify({'error': 'Upstream request failed', 'status': resp.status_code}), resp.status_code
             
+    except ProviderUnavailable as e:
+        return jsonify({'error': str(e)}), e.status_code
     except requests.exceptions.RequestException as e:
         return jsonify({'error': str(e)}), 502
 
@@ -178,6 +172,7 @@ def update_user_key(kid):
     if 'token_limit_per_day' in data:
         r.token_limit_per_day = int(data['token_limit_per_day'] or 0)
     db.session.commit()
+    key_cache.invalidate(kid)
     return jsonify({'ok': True})
 
 @admin_bp.delete('/user-keys/<int:kid>')
@@ -187,6 +182,7 @@ def delete_user_key(kid):
     r = UserKey.query.get_or_404(kid)
     db.session.delete(r)
     db.session.commit()
+    key_cache.invalidate(kid)
     return jsonify({'ok': True})
 
 @admin_bp.get('/user-keys/<int:kid>/stats')
@@ -235,18 +231,56 @@ def get_usage():
     usage_data = db.session.query(
         cast(UsageLog.ts, Date).label('date'),
         func.count(UsageLog.id).label('requests'),
-        func.sum(UsageLog.total_tokens).label('tokens')
+        func.sum(UsageLog.total_tokens).label('tokens'),
+        func.sum(UsageLog.request_tokens).label('prompt_tokens'),
+        func.sum(UsageLog.cached_tokens).label('cached_tokens'),
+        func.sum(case((UsageLog.cache_hit == True, 1), else_=0)).label('cache_hits')
     ).group_by(cast(UsageLog.ts, Date)).order_by(cast(UsageLog.ts, Date).desc()).limit(30).all()
     
     return jsonify([
         {
             'date': row.date.isoformat(),
             'requests': row.requests,
-            'tokens': row.tokens or 0
+            'tokens': row.tokens or 0,
+            'prompt_tokens': row.prompt_tokens or 0,
+            'cached_tokens': row.cached_tokens or 0,
+            'cache_hits': row.cache_hits or 0
         }
         for row in usage_data
     ])
 
+@admin_bp.get('/metrics')
+def get_metrics():
+    if 'admin' not in session:
+        return jsonify({'error': 'unauthorized'}), 401
+    return jsonify({
+        'http': http_client.stats(),
+        'quota': quota.stats(),
+        'catalog': catalog.stats(),
+        'key_cache': key_cache.stats(),
+        'usage_writer': usage_writer.stats(),
+        'providers': scheduler.stats(),
+        'models': models_cache_stats(),
+        'router': router.stats(),
+        'preflight': preflight_stats(),
+        'page_cache': page_cache.stats(),
+        'search_cache': search_cache.stats(),
+        'blobs': blob_store.stats(),
+        'context': context_stats(),
+        'prompt_cache': prompt_cache_stats(),
+        'sse': sse_stats(),
+        'generations': generations.stats(),
+        'ensemble': ensemble_stats(),
+        'response_cache': response_cache.stats()
+    })
+
+@admin_bp.post('/providers/refresh')
+def refresh_providers():
+    if 'admin' not in session:
+        return jsonify({'error': 'unauthorized'}), 401
+    scheduler.refresh(force=True)
+    return jsonify({'ok': True, 'providers': scheduler.stats()['providers']})
+
 @admin_bp.get('/cors')
 def get_cors_settings():
     if 'admin' not in session:
@@ -257,6 +291,7 @@ def get_cors_settings():
         settings = CorsSettings()
         db.session.add(settings)
         db.session.commit()
+        invalidate_cors_cache()
     
     return jsonify({
         'id': settings.id,
@@ -292,6 +327,7 @@ def update_cors_settings():
         settings.max_age = int(data['max_age'])
     
     db.session.commit()
+    invalidate_cors_cache()
     return jsonify({'ok': True})
 
 @admin_bp.post('/playground/chat')
@@ -360,7 +396,7 @@ def playground_fetch_md():
         return jsonify({'error': 'url is required'}), 400
 
     try:
-        r = requests.get(url, timeout=10)
+        r = http_client.get(url, timeout=10)
         if r.status_code != 200:
             return jsonify({'error': f'Failed to fetch: {r.status_code}'}), 400
         content_type = r.headers.get('Content-Type', '')
@@ -469,12 +505,6 @@ def generate_agent_md():
     if not messages:
         return jsonify({'error': 'messages required'}), 400
 
-    upstream_key, _ = _get_upstream_provider()
-    if not upstream_key:
-        return jsonify({'error': 'No upstream provider configured'}), 500
-
-    upstream_url = os.getenv('UPSTREAM_URL', 'https://ai.hackclub.com/proxy/v1').rstrip('/') + '/chat/completions'
-
     system_prompt = (
         "You are an assistant that writes agent model.md files for an AI platform. "
         "Given a user's requirements in the conversation, produce a concise, structured markdown file that includes instructions and system role content. "
@@ -487,12 +517,7 @@ def generate_agent_md():
     }
 
     try:
-        resp = requests.post(
-            upstream_url,
-            headers={'Authorization': f'Bearer {upstream_key}', 'Content-Type': 'application/json'},
-            data=json.dumps(body),
-            timeout=120
-        )
+        resp = upstream_request('/chat/completions', body, timeout=120)
 
         if resp.status_code != 200:
             return jsonify({'error': 'Upstream request failed', 'status': resp.status_code}), resp.status_code
@@ -512,6 +537,8 @@ def generate_agent_md():
             fh.write(content)
 
         return jsonify({'content': content})
+    except ProviderUnavailable as e:
+        return jsonify({'error': str(e)}), e.status_code
     except requests.exceptions.RequestException as e:
         return jsonify({'error': str(e)}), 502
 
@@ -539,9 +566,8 @@ def agent_chat(agent):
         with open(path, 'r', encoding='utf-8') as fh:
             system_content = fh.read()
 
-    msgs = messages[:]
-    if system_content:
-        msgs.insert(0, {'role': 'system', 'content': system_content})
+    msgs = [{'role': 'system', 'content': system_content}] if system_content else []
+    msgs = layout_prompt(msgs + list(messages), model=model)
 
     user_key = UserKey.query.get(user_key_id)
     if not user_key:
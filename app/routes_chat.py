@@ -1,18 +1,30 @@
 import os
-import json
 import unicodedata
 import secrets
 import threading
-import requests
+import time
 from collections import defaultdict
 from queue import Queue, Empty
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from flask import Blueprint, session, redirect, url_for, request, jsonify, current_app, Response, stream_with_context
+from flask import Blueprint, session, redirect, url_for, request, jsonify, current_app, Response, stream_with_context, send_file
 from authlib.integrations.flask_client import OAuth
-from .models import User, UserKey, Conversation, UsageLog, ProviderKey, EmailWhitelist, CollabRoom, CollabMembership, CollabMessage
+from .models import User, UserKey, Conversation, UsageLog, EmailWhitelist, CollabRoom, CollabMembership, CollabMessage
 from . import db
-from .utils import generate_api_key, extract_tokens, gather_web_context
-from datetime import datetime, timedelta
+from .utils import generate_api_key, extract_cached_tokens, extract_tokens, gather_web_context, log_usage
+from .quota import check_key_limits
+from .catalog import calculate_cost, catalog
+from .providers import scheduler, upstream_request, upstream_base_url
+from .router import router
+from .preflight import Preflight
+from .blob_store import blob_store, blob_mime, SAFE_INLINE_TYPES
+from .context import assemble_context, estimate_tokens, forget_summary, message_tokens
+from .prompt_layout import layout_prompt
+from .ensemble import collect_candidates
+from .sse_parser import iter_batches
+from .sse_writer import disconnect_probe, note_abort, sse_frame
+from .generations import STREAM_RESUME_GRACE_MS, registry as generations
+from .key_cache import key_cache
+from .conversation_store import append_messages, assistant_usage, delete_messages, first_messages, load_messages, load_rows, to_message
+from datetime import datetime
 from sqlalchemy import func
 
 WEB_SEARCH_LIMIT_NORMAL = 25
@@ -23,6 +35,7 @@ oauth = OAuth()
 
 room_subscribers = defaultdict(list)
 room_subscribers_lock = threading.Lock()
+COLLAB_IDLE_ABORT_MS = float(os.getenv('COLLAB_IDLE_ABORT_MS', '5000'))
 
 class UpstreamError(Exception):
     def __init__(self, message, status_code=500):
@@ -64,28 +77,6 @@ def trim_text(value, limit=2000):
         return text[:limit] + '...'
     return text
 
-def get_model_pricing(model_id):
-    try:
-        models_path = os.path.join(current_app.root_path, 'available_models.json')
-        with open(models_path, 'r') as f:
-            data = json.load(f)
-        for model in data.get('data', []):
-            if model.get('id') == model_id:
-                pricing = model.get('pricing', {})
-                return {
-                    'prompt': float(pricing.get('prompt', 0)),
-                    'completion': float(pricing.get('completion', 0)),
-                    'image': float(pricing.get('image', 0))
-                }
-    except Exception:
-        pass
-    return {'prompt': 0, 'completion': 0, 'image': 0}
-
-def calculate_cost(model_id, prompt_tokens, completion_tokens):
-    pricing = get_model_pricing(model_id)
-    cost = (prompt_tokens * pricing['prompt']) + (completion_tokens * pricing['completion'])
-    return round(cost, 6)
-
 
 def generate_room_code():
     for _ in range(6):
@@ -136,6 +127,11 @@ def broadcast_room_event(room_code, payload):
             continue
 
 
+def room_has_subscribers(room_code):
+    with room_subscribers_lock:
+        return bool(room_subscribers.get(room_code))
+
+
 def subscribe_room(room_code):
     queue_obj = Queue()
     with room_subscribers_lock:
@@ -166,14 +162,17 @@ def build_history_digest(history, limit=4):
 
 def execute_completion(model_name, messages, upstream_key, upstream_url, temperature=None, stream=False):
     payload = {'model': model_name, 'messages': messages, 'stream': stream}
+    if stream:
+        payload['stream_options'] = {'include_usage': True}
     if temperature is not None:
         payload['temperature'] = temperature
-    resp = requests.post(
-        f"{upstream_url}/chat/completions",
-        headers={'Authorization': f'Bearer {upstream_key}', 'Content-Type': 'application/json'},
-        data=json.dumps(payload),
+    resp = upstream_request(
+        '/chat/completions',
+        payload,
         timeout=120,
-        stream=stream
+        stream=stream,
+        preferred_key=upstream_key,
+        base_url=upstream_url
     )
     if resp.status_code != 200:
         raise UpstreamError(resp.text or 'Upstream error', resp.status_code)
@@ -189,7 +188,7 @@ def execute_completion(model_name, messages, upstream_key, upstream_url, tempera
         response_images = choice['images']
     elif choice.get('image_url'):
         response_images = [choice['image_url']]
-    return content, response_images, data
+    return content, response_images, data, resp.provider_id
 
 def resolve_ultimate_models():
     configured = current_app.config.get('ULTIMATE_MODELS')
@@ -210,40 +209,82 @@ def resolve_fusion_model():
     fusion = current_app.config.get('ULTIMATE_FUSION_MODEL')
     return fusion or DEFAULT_ULTIMATE_FUSION_MODEL
 
-def run_ultimate_ensemble(upstream_messages, history_messages, upstream_key, upstream_url, original_prompt, web_context):
+def run_ultimate_ensemble(upstream_messages, history_messages, upstream_key, upstream_url, original_prompt, web_context, user_key_id, sink=None, should_stop=None):
     models = resolve_ultimate_models()
     fusion_model = resolve_fusion_model()
-    results = []
-    usage = {'prompt': 0, 'response': 0, 'total': 0}
-
-    def call_model(model_name):
-        content, images, data = execute_completion(model_name, upstream_messages, upstream_key, upstream_url)
-        return model_name, content, images, data
+    usage = {'prompt': 0, 'response': 0, 'total': 0, 'cached': 0}
+    candidate_prompt = sum(message_tokens(m) for m in upstream_messages)
 
-    with ThreadPoolExecutor(max_workers=len(models)) as executor:
-        futures = {executor.submit(call_model, m): m for m in models}
-        for future in as_completed(futures):
-            model_name = futures[future]
-            try:
-                name, content, images, data = future.result()
-                results.append({'model': name, 'content': content or '', 'images': images})
-                pt, rt, tt = extract_tokens(data)
-                usage['prompt'] += pt
-                usage['response'] += rt
-                usage['total'] += tt
-            except Exception as exc:
-                current_app.logger.warning('Ultimate candidate failed (%s): %s', model_name, exc)
+    def bill(model_name, provider_id, data, text, prompt_estimate):
+        if data:
+            pt, rt, tt = extract_tokens({'usage': data})
+            cached = extract_cached_tokens({'usage': data})
+        else:
+            pt = prompt_estimate
+            rt = estimate_tokens(text)
+            tt = pt + rt
+            cached = 0
+        log_usage(
+            provider_id,
+            user_key_id,
+            request_tokens=pt,
+            response_tokens=rt,
+            total_tokens=tt,
+            model=model_name,
+            cost=calculate_cost(model_name, pt, rt),
+            cached_tokens=cached
+        )
+        return pt, rt, tt, cached
+
+    def add_usage(model_name, provider_id, data, text, prompt_estimate):
+        pt, rt, tt, cached = bill(model_name, provider_id, data, text, prompt_estimate)
+        usage['prompt'] += pt
+        usage['response'] += rt
+        usage['total'] += tt
+        usage['cached'] += cached
+
+    def bill_dropped(item):
+        bill(item['model'], item['provider_id'], item['usage'], item['content'], candidate_prompt)
+
+    def open_stream(model_name):
+        return execute_completion(model_name, upstream_messages, upstream_key, upstream_url, stream=True)
+
+    outcome = collect_candidates(
+        models,
+        open_stream,
+        on_progress=sink.event if sink is not None else None,
+        on_dropped=bill_dropped,
+        should_stop=should_stop
+    )
+    for item in outcome['failed']:
+        current_app.logger.warning('Ultimate candidate failed (%s): %s', item['model'], item['error'])
+    results = outcome['results']
+    for item in results:
+        add_usage(item['model'], item['provider_id'], item['usage'], item['content'], candidate_prompt)
+    ensemble = {
+        'content': '',
+        'images': [],
+        'model': 'ultimate-ensemble',
+        'candidates': results,
+        'dropped': outcome['dropped'],
+        'usage': usage,
+        'aggregator_model': fusion_model,
+        'aborted': outcome['aborted']
+    }
+    if outcome['aborted']:
+        return ensemble
     if not results:
         raise UpstreamError('All ultimate candidate models failed', 502)
     if len(results) == 1:
-        return {
-            'content': results[0]['content'],
-            'images': results[0]['images'],
-            'model': results[0]['model'],
-            'candidates': results,
-            'usage': usage,
-            'aggregator_model': results[0]['model']
-        }
+        if sink is not None:
+            sink.content(results[0]['content'])
+        return dict(
+            ensemble,
+            content=results[0]['content'],
+            images=results[0]['images'],
+            model=results[0]['model'],
+            aggregator_model=results[0]['model']
+        )
     history_digest = build_history_digest(history_messages)
     candidate_sections = []
     for idx, item in enumerate(results, start=1):
@@ -275,19 +316,46 @@ def run_ultimate_ensemble(upstream_messages, history_messages, upstream_key, ups
             'content': '\n\n'.join(prompt_parts)
         }
     ]
-    content, images, fusion_data = execute_completion(fusion_model, fusion_messages, upstream_key, upstream_url, temperature=0.2)
-    pt, rt, tt = extract_tokens(fusion_data)
-    usage['prompt'] += pt
-    usage['response'] += rt
-    usage['total'] += tt
-    return {
-        'content': content or '',
-        'images': images,
-        'model': 'ultimate-ensemble',
-        'candidates': results,
-        'usage': usage,
-        'aggregator_model': fusion_model
-    }
+    if sink is not None:
+        sink.event({'type': 'fusion', 'model': fusion_model, 'candidates': [item['model'] for item in results]})
+    parts = []
+    images = []
+    fusion_usage = None
+    resp = execute_completion(fusion_model, fusion_messages, upstream_key, upstream_url, temperature=0.2, stream=True)
+    try:
+        for events in iter_batches(resp):
+            for kind, value in events:
+                if kind == 'content':
+                    parts.append(value)
+                    if sink is not None:
+                        sink.content(value)
+                elif kind == 'images':
+                    images.extend(value)
+                elif kind == 'usage':
+                    fusion_usage = value
+                elif kind == 'error':
+                    raise UpstreamError(value, 502)
+            if should_stop is not None and should_stop():
+                ensemble['aborted'] = True
+                break
+            if sink is not None:
+                sink.tick()
+    finally:
+        resp.close()
+        add_usage(fusion_model, resp.provider_id, fusion_usage, ''.join(parts), sum(message_tokens(m) for m in fusion_messages))
+    return dict(ensemble, content=''.join(parts), images=images)
+
+def describe_ensemble(meta, ensemble):
+    meta['ultimate_candidates'] = [
+        {
+            'model': item['model'],
+            'excerpt': trim_text(item['content'], 1200)
+        }
+        for item in ensemble['candidates']
+    ]
+    meta['aggregator_model'] = ensemble['aggregator_model']
+    if ensemble['dropped']:
+        meta['ultimate_dropped'] = ensemble['dropped']
 
 def init_oauth(app):
     oauth.init_app(app)
@@ -436,12 +504,14 @@ def get_chat_names_batch():
     if not conv_ids:
         return jsonify({'names': {}})
     
-    conversations = Conversation.query.filter(
+    conversations = Conversation.query.with_entities(Conversation.id, Conversation.title).filter(
         Conversation.id.in_(conv_ids),
         Conversation.user_id == user_id
     ).all()
     
     conv_map = {c.id: c for c in conversations}
+    untitled = [c.id for c in conversations if (c.title or '').strip() in ('', 'New Chat')]
+    first_map = first_messages(untitled) if untitled else {}
     result = {}
     
     for conv_id in conv_ids:
@@ -454,10 +524,9 @@ def get_chat_names_batch():
             result[conv_id] = current_title
             continue
         
-        history_messages = conv.messages or []
-        if history_messages:
-            first = history_messages[0]
-            content = first.get('content') if isinstance(first, dict) else None
+        first = first_map.get(conv_id)
+        if first:
+            content = first.get('content')
             text = ''
             if isinstance(content, list):
                 for part in content:
@@ -485,12 +554,13 @@ def get_chat_name(conv_id):
     if not conv:
         return jsonify({'error': 'not found'}), 404
 
-    history_messages = conv.messages or []
+    history_messages = load_messages(conv.id, last=6)
+    first_message = first_messages([conv.id]).get(conv.id)
 
     def initial_title_guess():
-        if not history_messages:
+        if not first_message:
             return None
-        first = history_messages[0]
+        first = first_message
         content = first.get('content') if isinstance(first, dict) else None
         text = ''
         if isinstance(content, list):
@@ -520,7 +590,7 @@ def get_chat_name(conv_id):
             "Keep it under 50 characters, no quotes, sentence case. "
             "Stay neutral and specific.\n\nConversation:\n" + digest
         )
-        content, _, _ = execute_completion(
+        content, _, _, _ = execute_completion(
             DEFAULT_PRECISE_MODEL,
             [
                 {'role': 'system', 'content': 'You write concise chat titles.'},
@@ -558,11 +628,15 @@ def get_conversation(conv_id):
     conv = Conversation.query.filter_by(id=conv_id, user_id=user_id).first()
     if not conv:
         return jsonify({'error': 'not found'}), 404
-        
+
+    after = request.args.get('after', type=int)
+    last = request.args.get('limit', type=int)
+    rows = load_rows(conv.id, after=after, last=last)
     return jsonify({
         'id': conv.id,
         'title': conv.title,
-        'messages': conv.messages
+        'messages': [to_message(row) for row in rows],
+        'last_seq': rows[-1].seq if rows else after
     })
 
 @chat_bp.route('/api/chat/conversation/<int:conv_id>', methods=['DELETE'])
@@ -575,21 +649,46 @@ def delete_conversation(conv_id):
     if not conv:
         return jsonify({'error': 'not found'}), 404
 
+    delete_messages(conv.id)
+    forget_summary('conversation', conv.id)
     db.session.delete(conv)
     db.session.commit()
     return jsonify({'deleted': True})
 
+@chat_bp.route('/api/chat/blobs/<name>')
+def get_blob(name):
+    if 'user_id' not in session:
+        return jsonify({'error': 'unauthorized'}), 401
+
+    path = blob_store.path(name)
+    if path is None or not os.path.exists(path):
+        return jsonify({'error': 'not found'}), 404
+
+    mime = blob_mime(name)
+    resp = send_file(
+        os.path.abspath(path),
+        mimetype=mime,
+        as_attachment=mime not in SAFE_INLINE_TYPES,
+        etag=name.split('.', 1)[0],
+        conditional=True,
+        max_age=31536000
+    )
+    resp.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    resp.headers['X-Content-Type-Options'] = 'nosniff'
+    return resp
+
 @chat_bp.route('/api/chat/models')
 def get_models():
     if 'user_id' not in session:
         return jsonify({'error': 'unauthorized'}), 401
-        
-    try:
-        with open(os.path.join(current_app.root_path, 'available_models.json'), 'r') as f:
-            models_data = json.load(f)
-        return jsonify(models_data)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    
+    body, etag = catalog.payload()
+    if not body:
+        return jsonify({'error': catalog.error or 'model catalog unavailable'}), 500
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
 
 def ensure_membership(room, user_id):
@@ -621,20 +720,21 @@ def start_collab_ai_response(room, sender, prompt_text):
 
             history = CollabMessage.query.filter_by(room_id=room.id).order_by(CollabMessage.created_at.asc()).all()
             system_content = room.system_prompt or 'You are in a shared room. Keep answers concise, mention findings clearly, and assume multiple humans see the transcript.'
-            upstream_messages = [
-                {
-                    'role': 'system',
-                    'content': system_content
-                }
-            ]
-            for msg in history:
-                role = 'assistant' if msg.role == 'assistant' else 'user'
-                upstream_messages.append({'role': role, 'content': msg.content})
 
             final_model = route_request(prompt_text or 'Collaborative chat', False, upstream_key, upstream_url)
             if not final_model:
                 final_model = DEFAULT_PRECISE_MODEL
 
+            context_messages, context_info = assemble_context(
+                [{'role': 'assistant' if msg.role == 'assistant' else 'user', 'content': msg.content} for msg in history],
+                [msg.id for msg in history],
+                'room',
+                room.id,
+                models=[final_model],
+                system=[{'role': 'system', 'content': system_content}]
+            )
+            upstream_messages = layout_prompt(context_messages, model=final_model)
+
             try:
                 stream_resp = execute_completion(final_model, upstream_messages, upstream_key, upstream_url, stream=True)
             except UpstreamError as exc:
@@ -644,64 +744,83 @@ def start_collab_ai_response(room, sender, prompt_text):
                 broadcast_room_event(room.code, {'type': 'error', 'message': str(exc)})
                 return
 
-            accumulated = ''
+            provider_id = stream_resp.provider_id
+            accumulated = []
             usage_prompt = 0
             usage_response = 0
             usage_total = 0
+            usage_cached = 0
+            usage_seen = False
+            idle_since = None
+            aborted = False
             broadcast_room_event(room.code, {'type': 'ai_start', 'model': final_model})
 
-            for line in stream_resp.iter_lines():
-                if not line:
-                    continue
-                chunk_str = line.decode('utf-8') if isinstance(line, (bytes, bytearray)) else str(line)
-                if not chunk_str.startswith('data: '):
-                    continue
-                payload = chunk_str[6:]
-                if payload.strip() == '[DONE]':
-                    break
-                try:
-                    data = json.loads(payload)
-                except Exception:
-                    continue
-                if 'choices' in data and data['choices']:
-                    delta = data['choices'][0].get('delta', {})
-                    text_part = delta.get('content', '')
-                    if text_part:
-                        accumulated += text_part
-                        broadcast_room_event(room.code, {'type': 'ai_delta', 'content': text_part})
-                if 'usage' in data:
-                    usage_prompt = data['usage'].get('prompt_tokens', 0)
-                    usage_response = data['usage'].get('completion_tokens', 0)
-                    usage_total = data['usage'].get('total_tokens', 0)
+            try:
+                for events in iter_batches(stream_resp):
+                    for kind, value in events:
+                        if kind == 'content':
+                            accumulated.append(value)
+                            broadcast_room_event(room.code, {'type': 'ai_delta', 'content': value})
+                        elif kind == 'usage':
+                            usage_prompt, usage_response, usage_total = extract_tokens({'usage': value})
+                            usage_cached = extract_cached_tokens({'usage': value})
+                            usage_seen = True
+                        elif kind == 'error':
+                            broadcast_room_event(room.code, {'type': 'error', 'message': value})
+                            return
+                    if room_has_subscribers(room.code):
+                        idle_since = None
+                    elif idle_since is None:
+                        idle_since = time.monotonic()
+                    elif (time.monotonic() - idle_since) * 1000 >= COLLAB_IDLE_ABORT_MS:
+                        aborted = True
+                        break
+            except Exception as exc:
+                broadcast_room_event(room.code, {'type': 'error', 'message': str(exc)})
+                return
+            finally:
+                stream_resp.close()
 
+            accumulated = ''.join(accumulated)
             if not accumulated.strip():
-                broadcast_room_event(room.code, {'type': 'error', 'message': 'Empty response from model'})
+                if not aborted:
+                    broadcast_room_event(room.code, {'type': 'error', 'message': 'Empty response from model'})
                 return
 
+            meta = {'request_tokens': usage_prompt, 'response_tokens': usage_response}
+            if aborted:
+                note_abort('collab', len(accumulated))
+                if not usage_seen:
+                    usage_prompt = context_info['estimated_tokens']
+                    usage_response = estimate_tokens(accumulated)
+                    usage_total = usage_prompt + usage_response
+                    meta = {'request_tokens': usage_prompt, 'response_tokens': usage_response, 'usage_estimated': True}
+                meta['aborted'] = True
+
             assistant_msg = CollabMessage(
                 room_id=room.id,
                 user_id=None,
                 role='assistant',
                 content=accumulated,
                 model=final_model,
-                meta={'request_tokens': usage_prompt, 'response_tokens': usage_response}
+                meta=meta
             )
             db.session.add(assistant_msg)
             room.updated_at = datetime.utcnow()
 
             cost = calculate_cost(final_model, usage_prompt, usage_response)
-            ul = UsageLog(
-                provider_key_id=provider_id,
-                user_key_id=sender_key_id,
+            log_usage(
+                provider_id,
+                sender_key_id,
                 request_tokens=usage_prompt,
                 response_tokens=usage_response,
                 total_tokens=usage_total,
                 model=final_model,
-                cost=cost
+                cost=cost,
+                cached_tokens=usage_cached
             )
             if sender_user and sender_user.user_key:
                 sender_user.user_key.last_used_at = datetime.utcnow()
-            db.session.add(ul)
             db.session.commit()
 
             broadcast_room_event(room.code, {'type': 'message', 'message': serialize_collab_message(assistant_msg)})
@@ -786,6 +905,7 @@ def leave_collab_room(room_code):
     remaining = CollabMembership.query.filter_by(room_id=room.id).count()
     if remaining == 0:
         CollabMessage.query.filter_by(room_id=room.id).delete()
+        forget_summary('room', room.id)
         db.session.delete(room)
         db.session.commit()
         broadcast_room_event(room.code, {'type': 'room_deleted'})
@@ -834,6 +954,7 @@ def clear_collab_chat(room_code):
         return jsonify({'error': 'not a member'}), 403
 
     CollabMessage.query.filter_by(room_id=room.id).delete()
+    forget_summary('room', room.id)
     room.updated_at = datetime.utcnow()
     db.session.commit()
 
@@ -872,13 +993,18 @@ def collab_room_stream(room_code):
 
     def event_stream():
         try:
-            yield f"data: {json.dumps({'type': 'ready'})}\n\n"
+            yield sse_frame({'type': 'ready'})
             while True:
                 try:
-                    event = queue_obj.get(timeout=20)
-                    yield f"data: {json.dumps(event)}\n\n"
+                    frames = [sse_frame(queue_obj.get(timeout=20))]
+                    while len(frames) < 64:
+                        try:
+                            frames.append(sse_frame(queue_obj.get_nowait()))
+                        except Empty:
+                            break
+                    yield b''.join(frames)
                 except Empty:
-                    yield 'data: {"type":"ping"}\n\n'
+                    yield b'data: {"type":"ping"}\n\n'
         finally:
             unsubscribe_room(room.code, queue_obj)
 
@@ -907,13 +1033,8 @@ def post_collab_message(room_code):
         return jsonify({'error': 'message required'}), 400
 
     user_key = user.user_key
-    now = datetime.utcnow()
-    if user_key and user_key.rate_limit_enabled and user_key.rate_limit_value > 0:
-        period_seconds = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}.get(user_key.rate_limit_period, 60)
-        start_time = now - timedelta(seconds=period_seconds)
-        count = db.session.query(func.count(UsageLog.id)).filter(UsageLog.user_key_id == user_key.id, UsageLog.ts >= start_time).scalar() or 0
-        if count >= user_key.rate_limit_value:
-            return jsonify({'error': 'rate_limit_exceeded'}), 429
+    if user_key and check_key_limits(user_key, tokens=False):
+        return jsonify({'error': 'rate_limit_exceeded'}), 429
 
     msg = CollabMessage(room_id=room.id, user_id=user.id, role='user', content=content, meta={})
     db.session.add(msg)
@@ -927,87 +1048,11 @@ def post_collab_message(room_code):
     return jsonify({'message': payload})
 
 def get_upstream_config():
-    upstream_key_env = os.getenv('UPSTREAM_API_KEY', '')
-    if upstream_key_env:
-        upstream_key = upstream_key_env
-        provider_id = 1
-    else:
-        provider = ProviderKey.query.filter_by(enabled=True).first()
-        if not provider:
-            raise Exception('No upstream provider configured')
-        upstream_key = provider.api_key
-        provider_id = provider.id
-    
-    upstream_url = os.getenv('UPSTREAM_URL', 'https://ai.hackclub.com/proxy/v1').rstrip('/')
-    return upstream_key, provider_id, upstream_url
-
-def load_available_models():
-    try:
-        models_path = os.path.join(current_app.root_path, 'available_models.json')
-        with open(models_path, 'r') as f:
-            data = json.load(f)
-        models = data.get('data', [])
-        model_list = []
-        for model in models:
-            model_id = model.get('id', '')
-            name = model.get('name', '')
-            description = model.get('description', '')
-            modality = model.get('architecture', {}).get('modality', '')
-            model_list.append({
-                'id': model_id,
-                'name': name,
-                'description': description,
-                'modality': modality
-            })
-        return model_list
-    except Exception as e:
-        current_app.logger.warning('Failed to load available models: %s', e)
-        return []
+    slot = scheduler.pick()
+    return slot.api_key, slot.id, upstream_base_url()
 
 def route_request(message, has_files, upstream_key, upstream_url):
-    try:
-        available = load_available_models()
-        if not available:
-            return 'google/gemini-2.5-flash'
-        
-        models_text = "Available models:\n"
-        for idx, m in enumerate(available, 1):
-            models_text += f"{idx}. {m['id']} - {m['name']}\n   Modality: {m['modality']}\n"
-        
-        router_prompt = (
-            "You are an intelligent model router. Based on the user's request and available models, "
-            "select the BEST model for the task.\n\n"
-            f"{models_text}\n\n"
-            "Selection Rules:\n"
-            "1. If user asks to generate/create/draw images: choose image-capable models (check modality for 'image' in output).\n"
-            "2. If user uploads files/images: choose multimodal models with 'image' in modality.\n"
-            "3. For coding/complex reasoning: prefer models with strong reasoning capabilities.\n"
-            "4. For general chat: prefer fast, efficient models.\n"
-            "5. For video/document analysis: prefer models with 'video' or 'file' in input modalities.\n\n"
-            "Return ONLY the model ID (e.g., 'google/gemini-3-pro-preview'), nothing else."
-        )
-        
-        resp = requests.post(
-            f"{upstream_url}/chat/completions",
-            headers={'Authorization': f'Bearer {upstream_key}', 'Content-Type': 'application/json'},
-            data=json.dumps({
-                'model': 'google/gemini-2.5-flash',
-                'messages': [
-                    {'role': 'system', 'content': router_prompt},
-                    {'role': 'user', 'content': f"Request: {message[:500]}\nUser has uploaded files: {has_files}"}
-                ],
-                'temperature': 0.0
-            }),
-            timeout=10
-        )
-        if resp.status_code == 200:
-            model = resp.json()['choices'][0]['message']['content'].strip()
-            if model:
-                return model
-    except Exception as e:
-        current_app.logger.warning('Model routing failed: %s', e)
-    
-    return 'google/gemini-2.5-flash'
+    return router.route(message, has_files, upstream_key, upstream_url)
 
 @chat_bp.post('/api/chat/message')
 def send_message():
@@ -1030,12 +1075,17 @@ def send_message():
     
     if mode == 'ultimate' and not user.ultimate_enabled:
         return jsonify({'error': 'ultimate_not_allowed'}), 403
-    web_context = []
     
     if not message and not attachments:
         return jsonify({'error': 'message or attachments required'}), 400
 
-    if use_web_search and message:
+    preflight = Preflight()
+    user_key = user.user_key
+    if preflight.run('quota', check_key_limits, user_key, tokens=False):
+        return jsonify({'error': 'rate_limit_exceeded'}), 429
+
+    search_web = use_web_search and bool(message)
+    if search_web:
         now = datetime.utcnow()
         if user.web_search_reset is None or user.web_search_reset <= now:
             first_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -1045,27 +1095,40 @@ def send_message():
                 next_month = first_of_month.replace(month=now.month + 1)
             user.web_search_reset = next_month
             user.web_search_count = 0
-            db.session.commit()
         limit = WEB_SEARCH_LIMIT_ULTIMATE if user.ultimate_enabled else WEB_SEARCH_LIMIT_NORMAL
         if user.web_search_count >= limit:
             return jsonify({'error': 'web_search_limit_exceeded', 'limit': limit}), 429
-        try:
-            web_context = gather_web_context(message)
-            user.web_search_count += 1
+
+    try:
+        upstream_key, provider_id, upstream_url = get_upstream_config()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    if search_web:
+        preflight.submit('web', gather_web_context, message, fallback=[])
+    if mode in ('general', 'manual') and (not requested_model or requested_model == 'AI'):
+        preflight.submit('route', route_request, message or "Image analysis", bool(attachments), upstream_key, upstream_url, fallback=router.default_model())
+
+    with preflight.stage('conversation'):
+        if conv_id:
+            conv = Conversation.query.filter_by(id=conv_id, user_id=user_id).first()
+        else:
+            title = message[:30] if message else "New Chat"
+            conv = Conversation(user_id=user_id, title=title, messages=[])
+            db.session.add(conv)
             db.session.commit()
-        except Exception:
-            web_context = []
-        
-    if conv_id:
-        conv = Conversation.query.filter_by(id=conv_id, user_id=user_id).first()
-        if not conv:
-            return jsonify({'error': 'conversation not found'}), 404
-    else:
-        title = message[:30] if message else "New Chat"
-        conv = Conversation(user_id=user_id, title=title, messages=[])
-        db.session.add(conv)
+    if not conv:
+        return jsonify({'error': 'conversation not found'}), 404
+
+    web_context = preflight.result('web') or []
+    routed_model = preflight.result('route')
+    if preflight.outcomes.get('web') == 'ok':
+        user.web_search_count += 1
+    if search_web:
         db.session.commit()
+    preflight.finish()
     
+    attachments = [blob_store.externalize(att) for att in attachments]
     user_content = message
     if attachments:
         user_content = [{"type": "text", "text": message or ""}]
@@ -1075,25 +1138,26 @@ def send_message():
                 "image_url": {"url": att}
             })
     
-    messages = list(conv.messages)
-    messages.append({'role': 'user', 'content': user_content, 'images': attachments if attachments else None})
-    
-    user_key = user.user_key
-    now = datetime.utcnow()
-    
-    if user_key.rate_limit_enabled and user_key.rate_limit_value > 0:
-        period_seconds = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}.get(user_key.rate_limit_period, 60)
-        start_time = now - timedelta(seconds=period_seconds)
-        count = db.session.query(func.count(UsageLog.id)).filter(UsageLog.user_key_id == user_key.id, UsageLog.ts >= start_time).scalar() or 0
-        if count >= user_key.rate_limit_value:
-            return jsonify({'error': 'rate_limit_exceeded'}), 429
-
-    try:
-        upstream_key, provider_id, upstream_url = get_upstream_config()
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    rows = load_rows(conv.id)
+    messages = [to_message(row) for row in rows]
+    message_keys = [row.seq for row in rows]
+    user_message = {'role': 'user', 'content': user_content, 'images': attachments if attachments else None}
+    messages.append(user_message)
+    message_keys.append(None)
+
+    if mode in ('general', 'manual'):
+        final_model = routed_model or requested_model
+    elif mode == 'precise':
+        final_model = DEFAULT_PRECISE_MODEL
+    elif mode == 'turbo':
+        final_model = DEFAULT_TURBO_MODEL
+    else:
+        final_model = DEFAULT_PRECISE_MODEL
 
-    context_message = None
+    context_models = resolve_ultimate_models() + [resolve_fusion_model()] if mode == 'ultimate' else [final_model]
+    context_messages, context_info = assemble_context(messages, message_keys, 'conversation', conv.id, models=context_models)
+    
+    volatile = []
     if web_context:
         snippets = []
         for idx, item in enumerate(web_context, start=1):
@@ -1101,78 +1165,58 @@ def send_message():
             url = item.get('url') or ''
             content = item.get('content') or ''
             snippets.append(f"[{idx}] {title} ({url}): {content}")
-        context_message = {
-            'role': 'system',
-            'content': 'Use the following fresh web results to ground your answer. Cite the matching bracket number in your response when relevant.\n' + '\n\n'.join(snippets)
-        }
+        volatile.append('Use the following fresh web results to ground your answer. Cite the matching bracket number in your response when relevant.\n' + '\n\n'.join(snippets))
 
     upstream_messages = []
-    for m in messages:
+    for m in context_messages:
         content = m.get('content')
         if isinstance(content, list):
             valid_content = []
             for part in content:
-                if part.get('type') == 'image_url' and part.get('image_url', {}).get('url', '').startswith('data:'):
-                    valid_content.append(part)
+                if part.get('type') == 'image_url':
+                    url = blob_store.inline(part.get('image_url', {}).get('url', ''))
+                    if url.startswith('data:'):
+                        valid_content.append(dict(part, image_url=dict(part['image_url'], url=url)))
                 elif part.get('type') == 'text':
                     valid_content.append(part)
             upstream_messages.append({'role': m['role'], 'content': valid_content})
         else:
             upstream_messages.append({'role': m['role'], 'content': content})
 
-    if context_message:
-        upstream_messages.insert(0, context_message)
+    upstream_messages = layout_prompt(upstream_messages, volatile, model=None if mode == 'ultimate' else final_model)
 
     meta = {'mode': mode}
-    
-    if mode == 'general':
-        if requested_model and requested_model != 'AI':
-            final_model = requested_model
-        else:
-            final_model = route_request(message or "Image analysis", bool(attachments), upstream_key, upstream_url)
-    elif mode == 'precise':
-        final_model = DEFAULT_PRECISE_MODEL
-    elif mode == 'turbo':
-        final_model = DEFAULT_TURBO_MODEL
-    elif mode == 'manual':
-        if requested_model and requested_model != 'AI':
-            final_model = requested_model
-        else:
-            final_model = route_request(message or "Image analysis", bool(attachments), upstream_key, upstream_url)
-    else:
-        final_model = DEFAULT_PRECISE_MODEL
+    if context_info.get('summarized_messages'):
+        meta['context'] = context_info
 
-    if mode == 'ultimate' or not use_stream:
+    if not use_stream:
         response_images = []
         assistant_msg_content = ''
         usage_prompt = 0
         usage_response = 0
         usage_total = 0
+        usage_cached = 0
         try:
             if mode == 'ultimate':
-                ensemble = run_ultimate_ensemble(upstream_messages, messages, upstream_key, upstream_url, message or '', web_context)
+                ensemble = run_ultimate_ensemble(upstream_messages, messages, upstream_key, upstream_url, message or '', web_context, user_key.id)
                 assistant_msg_content = ensemble['content']
                 response_images = ensemble['images']
                 final_model = ensemble['model']
                 usage_prompt = ensemble['usage']['prompt']
                 usage_response = ensemble['usage']['response']
                 usage_total = ensemble['usage']['total']
-                meta['ultimate_candidates'] = [
-                    {
-                        'model': item['model'],
-                        'excerpt': trim_text(item['content'], 1200)
-                    }
-                    for item in ensemble['candidates']
-                ]
-                meta['aggregator_model'] = ensemble['aggregator_model']
+                usage_cached = ensemble['usage']['cached']
+                describe_ensemble(meta, ensemble)
             else:
-                assistant_msg_content, response_images, resp_data = execute_completion(final_model, upstream_messages, upstream_key, upstream_url)
+                assistant_msg_content, response_images, resp_data, provider_id = execute_completion(final_model, upstream_messages, upstream_key, upstream_url)
                 usage_prompt, usage_response, usage_total = extract_tokens(resp_data)
+                usage_cached = extract_cached_tokens(resp_data)
         except UpstreamError as exc:
             return jsonify({'error': 'Upstream error', 'details': str(exc)}), exc.status_code
         except Exception as exc:
             return jsonify({'error': str(exc)}), 500
 
+        response_images = blob_store.externalize(response_images or [])
         assistant_message_obj = {
             'role': 'assistant',
             'content': assistant_msg_content or '',
@@ -1189,25 +1233,25 @@ def send_message():
         if meta:
             assistant_message_obj['meta'] = meta
 
-        messages.append(assistant_message_obj)
-        conv.messages = messages
+        append_messages(conv.id, [user_message, assistant_message_obj])
         conv.updated_at = datetime.utcnow()
 
-        cost = calculate_cost(final_model, usage_prompt, usage_response)
-        ul = UsageLog(
-            provider_key_id=provider_id,
-            user_key_id=user_key.id,
-            request_tokens=usage_prompt,
-            response_tokens=usage_response,
-            total_tokens=usage_total,
-            model=final_model,
-            cost=cost
-        )
-        db.session.add(ul)
+        if mode != 'ultimate':
+            cost = calculate_cost(final_model, usage_prompt, usage_response)
+            log_usage(
+                provider_id,
+                user_key.id,
+                request_tokens=usage_prompt,
+                response_tokens=usage_response,
+                total_tokens=usage_total,
+                model=final_model,
+                cost=cost,
+                cached_tokens=usage_cached
+            )
         user_key.last_used_at = datetime.utcnow()
         db.session.commit()
         
-        return jsonify({
+        resp = jsonify({
             'conversation_id': conv.id,
             'message': assistant_msg_content,
             'images': response_images,
@@ -1217,98 +1261,175 @@ def send_message():
             'meta': meta,
             'mode': mode
         })
+        resp.headers['Server-Timing'] = preflight.server_timing()
+        return resp
     
-    def generate_stream():
-        try:
-            stream_resp = execute_completion(final_model, upstream_messages, upstream_key, upstream_url, stream=True)
-            
-            initial_data = {
-                'conversation_id': conv.id,
-                'model': final_model,
-                'title': conv.title,
-                'sources': web_context,
-                'meta': meta,
-                'mode': mode,
-                'images': []
-            }
-            yield f"data: {json.dumps({'type': 'start', 'data': initial_data})}\n\n"
-            
-            accumulated_content = ''
-            response_images = []
-            usage_prompt = 0
-            usage_response = 0
-            usage_total = 0
-            
-            for line in stream_resp.iter_lines():
-                if line:
-                    line_str = line.decode('utf-8')
-                    if line_str.startswith('data: '):
-                        chunk_data = line_str[6:]
-                        if chunk_data.strip() == '[DONE]':
-                            break
-                        try:
-                            chunk = json.loads(chunk_data)
-                            if 'choices' in chunk and len(chunk['choices']) > 0:
-                                choice = chunk['choices'][0]
-                                delta = choice.get('delta', {})
-                                content = delta.get('content', '')
-                                if content:
-                                    accumulated_content += content
-                                    yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-                                
-                                if 'images' in choice and isinstance(choice['images'], list):
-                                    response_images.extend(choice['images'])
-                                elif 'image_url' in choice:
-                                    response_images.append(choice['image_url'])
-                            
-                            if 'usage' in chunk:
-                                usage_prompt = chunk['usage'].get('prompt_tokens', 0)
-                                usage_response = chunk['usage'].get('completion_tokens', 0)
-                                usage_total = chunk['usage'].get('total_tokens', 0)
-                        except json.JSONDecodeError:
-                            pass
-            
-            assistant_message_obj = {
-                'role': 'assistant',
-                'content': accumulated_content,
-                'model': final_model
+    app = current_app._get_current_object()
+    generation = generations.create(user_id)
+    conv_id = conv.id
+    conv_title = conv.title
+    user_key_id = user_key.id
+
+    def produce():
+        with app.app_context():
+            state = {
+                'provider_id': provider_id,
+                'model': 'ultimate-ensemble' if mode == 'ultimate' else final_model,
+                'images': [],
+                'usage': None,
+                'totals': None,
+                'saved': False
             }
-            if response_images:
-                assistant_message_obj['images'] = response_images
-                yield f"data: {json.dumps({'type': 'images', 'images': response_images})}\n\n"
-            if web_context:
-                assistant_message_obj['sources'] = web_context
-            
-            meta['request_tokens'] = usage_prompt
-            meta['response_tokens'] = usage_response
-            
-            if meta:
-                assistant_message_obj['meta'] = meta
+            stream_resp = None
+
+            def persist(aborted=False):
+                state['saved'] = True
+                text = generation.text
+                usage = {'usage': state['usage']} if state['usage'] else None
+                if state['totals']:
+                    totals = state['totals']
+                    usage_prompt, usage_response, usage_total, usage_cached = totals['prompt'], totals['response'], totals['total'], totals['cached']
+                elif usage:
+                    usage_prompt, usage_response, usage_total = extract_tokens(usage)
+                    usage_cached = extract_cached_tokens(usage)
+                else:
+                    usage_prompt = context_info['estimated_tokens'] if aborted else 0
+                    usage_response = estimate_tokens(text) if aborted else 0
+                    usage_total = usage_prompt + usage_response
+                    usage_cached = 0
+                assistant_message_obj = {
+                    'role': 'assistant',
+                    'content': text,
+                    'model': state['model']
+                }
+                if state['images']:
+                    assistant_message_obj['images'] = state['images']
+                if web_context:
+                    assistant_message_obj['sources'] = web_context
+                
+                meta['request_tokens'] = usage_prompt
+                meta['response_tokens'] = usage_response
+                if aborted:
+                    meta['aborted'] = True
+                    if not usage and not state['totals']:
+                        meta['usage_estimated'] = True
+                
+                if meta:
+                    assistant_message_obj['meta'] = meta
+
+                if text or state['images'] or not aborted:
+                    append_messages(conv_id, [user_message, assistant_message_obj])
+                    Conversation.query.filter_by(id=conv_id).update({'updated_at': datetime.utcnow()})
+
+                if mode != 'ultimate':
+                    cost = calculate_cost(state['model'], usage_prompt, usage_response)
+                    log_usage(
+                        state['provider_id'],
+                        user_key_id,
+                        request_tokens=usage_prompt,
+                        response_tokens=usage_response,
+                        total_tokens=usage_total,
+                        model=state['model'],
+                        cost=cost,
+                        cached_tokens=usage_cached
+                    )
+                key_cache.touch(user_key_id)
+                db.session.commit()
+
+            def stopped():
+                return generation.idle_ms() >= STREAM_RESUME_GRACE_MS
 
-            messages.append(assistant_message_obj)
-            conv.messages = messages
-            conv.updated_at = datetime.utcnow()
+            try:
+                initial_data = {
+                    'conversation_id': conv_id,
+                    'generation_id': generation.id,
+                    'model': state['model'],
+                    'title': conv_title,
+                    'sources': web_context,
+                    'meta': meta,
+                    'mode': mode,
+                    'images': []
+                }
+                if mode == 'ultimate':
+                    generation.event({'type': 'start', 'data': initial_data})
+                    ensemble = run_ultimate_ensemble(upstream_messages, messages, upstream_key, upstream_url, message or '', web_context, user_key_id, sink=generation, should_stop=stopped)
+                    state['model'] = ensemble['model']
+                    state['totals'] = ensemble['usage']
+                    describe_ensemble(meta, ensemble)
+                    response_images = ensemble['images']
+                    if ensemble['aborted']:
+                        note_abort('chat', len(generation.text))
+                        persist(aborted=True)
+                        return
+                else:
+                    stream_resp = execute_completion(final_model, upstream_messages, upstream_key, upstream_url, stream=True)
+                    state['provider_id'] = stream_resp.provider_id
+                    generation.event({'type': 'start', 'data': initial_data})
+                    
+                    response_images = []
+                    for events in iter_batches(stream_resp):
+                        for kind, value in events:
+                            if kind == 'content':
+                                generation.content(value)
+                            elif kind == 'images':
+                                response_images.extend(value)
+                            elif kind == 'usage':
+                                state['usage'] = value
+                            elif kind == 'error':
+                                raise UpstreamError(value, 502)
+                        if stopped():
+                            stream_resp.close()
+                            note_abort('chat', len(generation.text))
+                            persist(aborted=True)
+                            return
+                        generation.tick()
+                    stream_resp.close()
+                
+                generation.flush()
+                if response_images:
+                    state['images'] = blob_store.externalize(response_images)
+                    generation.event({'type': 'images', 'images': state['images']})
 
-            cost = calculate_cost(final_model, usage_prompt, usage_response)
-            ul = UsageLog(
-                provider_key_id=provider_id,
-                user_key_id=user_key.id,
-                request_tokens=usage_prompt,
-                response_tokens=usage_response,
-                total_tokens=usage_total,
-                model=final_model,
-                cost=cost
-            )
-            db.session.add(ul)
-            user_key.last_used_at = datetime.utcnow()
-            db.session.commit()
-            
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
-            
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+                persist()
+                generation.event({'type': 'done'})
+                
+            except Exception as e:
+                if stream_resp is not None:
+                    stream_resp.close()
+                db.session.rollback()
+                if not state['saved'] and generation.text:
+                    try:
+                        persist(aborted=True)
+                    except Exception as exc:
+                        db.session.rollback()
+                        app.logger.warning('failed to save partial generation for conversation %s: %s', conv_id, exc)
+                generation.event({'type': 'error', 'error': str(e)})
+            finally:
+                generation.finish()
+
+    threading.Thread(target=produce, daemon=True).start()
     
-    return Response(stream_with_context(generate_stream()), mimetype='text/event-stream')
+    resp = Response(stream_with_context(generation.stream(0, disconnect_probe(request.environ))), mimetype='text/event-stream')
+    resp.headers['Server-Timing'] = preflight.server_timing()
+    resp.headers['X-Generation-Id'] = generation.id
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@chat_bp.get('/api/chat/stream/<gen_id>')
+def resume_stream(gen_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'unauthorized'}), 401
+    generation = generations.get(gen_id, session['user_id'])
+    if not generation:
+        return jsonify({'error': 'generation not found'}), 404
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        return jsonify({'error': 'invalid Last-Event-ID'}), 400
+    generations.note('resumed')
+    resp = Response(stream_with_context(generation.stream(after, disconnect_probe(request.environ))), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 @chat_bp.route('/admin/spending/total')
 def admin_total_spending():
@@ -1317,30 +1438,17 @@ def admin_total_spending():
     
     total_cost = 0.0
     
-    users = User.query.all()
-    for user in users:
-        conversations = Conversation.query.filter_by(user_id=user.id).all()
-        for conv in conversations:
-            messages = conv.messages or []
-            for msg in messages:
-                if isinstance(msg, dict) and msg.get('role') == 'assistant':
-                    model = msg.get('model')
-                    if not model:
-                        continue
-                    
-                    content = msg.get('content', '')
-                    meta = msg.get('meta', {})
-                    
-                    request_tokens = 0
-                    response_tokens = 0
-                    
-                    if isinstance(meta, dict):
-                        request_tokens = meta.get('request_tokens', 0)
-                        response_tokens = meta.get('response_tokens', 0)
-                    
-                    if request_tokens > 0 or response_tokens > 0:
-                        cost = calculate_cost(model, request_tokens, response_tokens)
-                        total_cost += cost
+    for model, meta in assistant_usage():
+        request_tokens = 0
+        response_tokens = 0
+        
+        if isinstance(meta, dict):
+            request_tokens = meta.get('request_tokens', 0)
+            response_tokens = meta.get('response_tokens', 0)
+        
+        if request_tokens > 0 or response_tokens > 0:
+            cost = calculate_cost(model, request_tokens, response_tokens)
+            total_cost += cost
     
     usage_logs_cost = db.session.query(func.sum(UsageLog.cost)).scalar() or 0.0
     total_cost += usage_logs_cost
@@ -1354,43 +1462,33 @@ def calculate_user_spending(user_id):
     total_completion_tokens = 0
     model_breakdown = {}
     
-    conversations = Conversation.query.filter_by(user_id=user_id).all()
-    for conv in conversations:
-        messages = conv.messages or []
-        for msg in messages:
-            if isinstance(msg, dict) and msg.get('role') == 'assistant':
-                model = msg.get('model')
-                if not model:
-                    continue
-                
-                meta = msg.get('meta', {})
-                
-                request_tokens = 0
-                response_tokens = 0
-                
-                if isinstance(meta, dict):
-                    request_tokens = meta.get('request_tokens', 0)
-                    response_tokens = meta.get('response_tokens', 0)
-                
-                if request_tokens > 0 or response_tokens > 0:
-                    cost = calculate_cost(model, request_tokens, response_tokens)
-                    total_cost += cost
-                    request_count += 1
-                    total_prompt_tokens += request_tokens
-                    total_completion_tokens += response_tokens
-                    
-                    if model not in model_breakdown:
-                        model_breakdown[model] = {
-                            'cost': 0.0,
-                            'requests': 0,
-                            'prompt_tokens': 0,
-                            'completion_tokens': 0
-                        }
-                    model_breakdown[model]['cost'] += cost
-                    model_breakdown[model]['requests'] += 1
-                    model_breakdown[model]['prompt_tokens'] += request_tokens
-                    model_breakdown[model]['completion_tokens'] += response_tokens
-    
+    for model, meta in assistant_usage(user_id):
+        request_tokens = 0
+        response_tokens = 0
+        
+        if isinstance(meta, dict):
+            request_tokens = meta.get('request_tokens', 0)
+            response_tokens = meta.get('response_tokens', 0)
+        
+        if request_tokens > 0 or response_tokens > 0:
+            cost = calculate_cost(model, request_tokens, response_tokens)
+            total_cost += cost
+            request_count += 1
+            total_prompt_tokens += request_tokens
+            total_completion_tokens += response_tokens
+            
+            if model not in model_breakdown:
+                model_breakdown[model] = {
+                    'cost': 0.0,
+                    'requests': 0,
+                    'prompt_tokens': 0,
+                    'completion_tokens': 0
+                }
+            model_breakdown[model]['cost'] += cost
+            model_breakdown[model]['requests'] += 1
+            model_breakdown[model]['prompt_tokens'] += request_tokens
+            model_breakdown[model]['completion_tokens'] += response_tokens
+
     return {
         'total_cost': round(total_cost, 2),
         'request_count': request_count,
@@ -1,68 +1,120 @@
 import os
-import json
 import time
-import requests
+import threading
 from datetime import datetime, timedelta
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, request, jsonify, make_response, Response, stream_with_context, current_app
 from sqlalchemy import func
-from .models import UsageLog, CorsSettings, UserKey, ProviderKey
-from .utils import extract_tokens
+from .models import UsageLog, CorsSettings, UserKey
+from .utils import extract_cached_tokens, extract_tokens, log_usage
+from .quota import quota, check_key_limits
+from .key_cache import key_cache
+from .providers import upstream_request, ProviderUnavailable
+from .sse_parser import SSEDecoder, event_data, loads
+from .response_cache import CACHE_HEADER, cache_bypassed, cache_key, cache_requested, cacheable, response_cache
 from . import db
 
 api_bp = Blueprint('api', __name__)
-_models_cache = {'items': [], 'fetched_at': 0}
-_models_hits = {}
-
-def _resolve_upstream_key():
-    upstream_key_env = os.getenv('UPSTREAM_API_KEY', '')
-    if upstream_key_env:
-        return upstream_key_env, 1
-    provider = ProviderKey.query.filter_by(enabled=True).first()
-    if not provider:
-        return '', 0
-    return provider.api_key, provider.id
+_models_cache = {
+    'items': [],
+    'ids': frozenset(),
+    'fetched_at': 0,
+    'refreshing': None,
+    'retry_at': 0,
+    'refreshes': 0,
+    'failures': 0,
+    'consecutive_failures': 0,
+    'last_error': None
+}
+_models_lock = threading.Lock()
+_cors_cache = {'settings': None}
+_cors_lock = threading.Lock()
+
+def _load_models():
+    r = upstream_request('/models', method='GET', timeout=30)
+    if r.status_code != 200:
+        raise RuntimeError(f'models request failed with {r.status_code}')
+    data = r.json() if 'application/json' in r.headers.get('Content-Type','') else {}
+    out = []
+    if isinstance(data, dict):
+        src = data.get('data') or data.get('models') or []
+        if isinstance(src, list):
+            for m in src:
+                if isinstance(m, dict):
+                    mid = m.get('id') or m.get('name') or None
+                    if mid:
+                        out.append(mid)
+                elif isinstance(m, str):
+                    out.append(m)
+    return out
+
+def _refresh_models(done):
+    try:
+        out = _load_models()
+        with _models_lock:
+            _models_cache['items'] = out
+            _models_cache['ids'] = frozenset(out)
+            _models_cache['fetched_at'] = time.time()
+            _models_cache['refreshes'] += 1
+            _models_cache['consecutive_failures'] = 0
+            _models_cache['last_error'] = None
+    except Exception as e:
+        with _models_lock:
+            _models_cache['failures'] += 1
+            _models_cache['consecutive_failures'] += 1
+            _models_cache['last_error'] = str(e)
+            _models_cache['retry_at'] = time.time() + min(2 ** _models_cache['consecutive_failures'], 60)
+    finally:
+        with _models_lock:
+            _models_cache['refreshing'] = None
+        done.set()
+
+def _refresh_models_in_app(app, done):
+    with app.app_context():
+        _refresh_models(done)
 
 def fetch_models(force=False):
     now = time.time()
     ttl = int(os.getenv('MODEL_CACHE_TTL', '300'))
-    if not force and _models_cache['items'] and now - _models_cache['fetched_at'] < ttl:
-        return _models_cache['items']
-    key, _pid = _resolve_upstream_key()
-    if not key:
-        return _models_cache['items']
-    url = os.getenv('UPSTREAM_URL', 'https://ai.hackclub.com/proxy/v1').rstrip('/') + '/models'
-    try:
-        r = requests.get(url, headers={'Authorization': f'Bearer {key}'}, timeout=30)
-        data = r.json() if 'application/json' in r.headers.get('Content-Type','') else {}
-        out = []
-        if isinstance(data, dict):
-            src = data.get('data') or data.get('models') or []
-            if isinstance(src, list):
-                for m in src:
-                    if isinstance(m, dict):
-                        mid = m.get('id') or m.get('name') or None
-                        if mid:
-                            out.append(mid)
-                    elif isinstance(m, str):
-                        out.append(m)
-        _models_cache['items'] = out
-        _models_cache['fetched_at'] = now
-    except Exception:
-        pass
+    with _models_lock:
+        items = _models_cache['items']
+        if not force and items and now - _models_cache['fetched_at'] < ttl:
+            return items
+        done = _models_cache['refreshing']
+        start = done is None and (force or now >= _models_cache['retry_at'])
+        if start:
+            done = _models_cache['refreshing'] = threading.Event()
+    if items and not force:
+        if start:
+            threading.Thread(target=_refresh_models_in_app, args=(current_app._get_current_object(), done), daemon=True).start()
+        return items
+    if start:
+        _refresh_models(done)
+    elif done is not None:
+        done.wait(float(os.getenv('MODEL_FETCH_WAIT', '10')))
     return _models_cache['items']
 
+def model_available(model_id):
+    return model_id in _models_cache['ids']
+
+def models_cache_stats():
+    with _models_lock:
+        fetched_at = _models_cache['fetched_at']
+        return {
+            'count': len(_models_cache['items']),
+            'age': round(time.time() - fetched_at, 1) if fetched_at else None,
+            'refreshing': _models_cache['refreshing'] is not None,
+            'refreshes': _models_cache['refreshes'],
+            'failures': _models_cache['failures'],
+            'consecutive_failures': _models_cache['consecutive_failures'],
+            'last_error': _models_cache['last_error']
+        }
+
 @api_bp.route('/models', methods=['GET'])
 def list_models():
     ip = request.headers.get('X-Forwarded-For', request.remote_addr) or 'x'
-    now = time.time()
-    window = now - 60
-    hits = _models_hits.get(ip, [])
-    hits = [h for h in hits if h > window]
     limit = int(os.getenv('MODELS_RATE_LIMIT_PER_MIN','30'))
-    if len(hits) >= limit:
+    if not quota.hit('models_ip', ip, 60, limit):
         return jsonify({'error': 'rate_limited'}), 429
-    hits.append(now)
-    _models_hits[ip] = hits
     refresh = request.args.get('refresh') == '1'
     items = fetch_models(force=refresh)
     response = make_response(jsonify({'models': items, 'count': len(items)}), 200)
@@ -90,24 +142,92 @@ def stats():
     response = make_response(jsonify({'keys': keys, 'requests': requests_count, 'tokens': tokens_sum, 'graph': graph}), 200)
     return apply_cors_headers(response)
 
-def apply_cors_headers(response):
+def _limit_response(user_key, exceeded):
+    if exceeded == 'rate_limit_exceeded':
+        return jsonify({'error': 'rate_limit_exceeded', 'message': f'Rate limit of {user_key.rate_limit_value} requests per {user_key.rate_limit_period} exceeded'}), 429
+    return jsonify({'error': 'token_limit_exceeded', 'message': f'Token limit of {user_key.token_limit_value} tokens per {user_key.token_limit_period} exceeded'}), 429
+
+def _load_cors_settings():
     settings = CorsSettings.query.first()
+    if not settings:
+        return None
+    origins = {o.strip().rstrip('/').lower() for o in (settings.allowed_origins or '').replace('\n', ',').split(',') if o.strip()}
+    return {
+        'wildcard': '*' in origins,
+        'origins': origins,
+        'methods': settings.allowed_methods,
+        'headers': settings.allowed_headers,
+        'credentials': bool(settings.allow_credentials),
+        'max_age': str(settings.max_age)
+    }
+
+def cached_cors_settings():
+    cached = _cors_cache['settings']
+    if cached is None:
+        with _cors_lock:
+            cached = _cors_cache['settings']
+            if cached is None:
+                cached = _load_cors_settings() or {}
+                _cors_cache['settings'] = cached
+    return cached
+
+def invalidate_cors_cache():
+    with _cors_lock:
+        _cors_cache['settings'] = None
+
+def _provider_response(exc):
+    if exc.status_code == 429:
+        return jsonify({'error': 'provider_limit_exceeded', 'message': str(exc)}), 429
+    return jsonify({'error': 'no_provider_configured', 'message': 'No upstream provider key configured'}), 500
+
+def _cache_lookup(endpoint, user_key_id, body):
+    if not cache_requested(request.headers) or not cacheable(endpoint, body):
+        return None, None, None
+    key = cache_key(endpoint, user_key_id, body)
+    if cache_bypassed(request.headers):
+        response_cache.note_bypass()
+        return key, None, 'BYPASS'
+    entry = response_cache.get(key)
+    if entry is None:
+        return key, None, 'MISS'
+    log_usage(entry['provider_id'], user_key_id, model=entry['model'], cache_hit=True)
+    response = make_response(entry['body'], 200, {'Content-Type': entry['content_type']})
+    response.headers[CACHE_HEADER] = 'HIT'
+    return key, apply_cors_headers(response), 'HIT'
+
+def _cache_mark(response, status):
+    response = make_response(response)
+    if status:
+        response.headers[CACHE_HEADER] = status
+    return response
+
+def _cache_store(key, status, response, provider_id, body, data, tokens):
+    if key is None:
+        return response
+    if response.status_code == 200:
+        model = (data.get('model') if isinstance(data, dict) else None) or body.get('model')
+        response_cache.put(key, response.get_data(), response.headers.get('Content-Type', 'application/json'), provider_id, model, tokens)
+    response.headers[CACHE_HEADER] = status
+    return response
+
+def apply_cors_headers(response):
+    settings = cached_cors_settings()
     if not settings:
         return response
     
     origin = request.headers.get('Origin')
-    allowed_origins = settings.allowed_origins.strip()
     
-    if allowed_origins == '*':
+    if settings['wildcard']:
         response.headers['Access-Control-Allow-Origin'] = '*'
-    elif origin and (origin in allowed_origins or allowed_origins == '*'):
+    elif origin and origin.rstrip('/').lower() in settings['origins']:
         response.headers['Access-Control-Allow-Origin'] = origin
-        if settings.allow_credentials:
+        response.vary.add('Origin')
+        if settings['credentials']:
             response.headers['Access-Control-Allow-Credentials'] = 'true'
     
-    response.headers['Access-Control-Allow-Methods'] = settings.allowed_methods
-    response.headers['Access-Control-Allow-Headers'] = settings.allowed_headers
-    response.headers['Access-Control-Max-Age'] = str(settings.max_age)
+    response.headers['Access-Control-Allow-Methods'] = settings['methods']
+    response.headers['Access-Control-Allow-Headers'] = settings['headers']
+    response.headers['Access-Control-Max-Age'] = settings['max_age']
     
     return response
 
@@ -122,53 +242,76 @@ def proxy_embeddings():
     if not auth.startswith('Bearer '):
         return jsonify({'error': 'missing_token'}), 401
     user_token = auth.split(' ', 1)[1]
-    user_key = UserKey.query.filter_by(key=user_token, enabled=True).first()
+    user_key = key_cache.authenticate(user_token)
     if not user_key:
         return jsonify({'error': 'unauthorized', 'message': 'Invalid or disabled API key'}), 401
-    now = datetime.utcnow()
-    if user_key.rate_limit_enabled and user_key.rate_limit_value > 0:
-        period_seconds = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800, 'month': 2592000}.get(user_key.rate_limit_period, 60)
-        start_time = now - timedelta(seconds=period_seconds)
-        count = db.session.query(func.count(UsageLog.id)).filter(UsageLog.user_key_id == user_key.id, UsageLog.ts >= start_time).scalar() or 0
-        if count >= user_key.rate_limit_value:
-            return jsonify({'error': 'rate_limit_exceeded', 'message': f'Rate limit of {user_key.rate_limit_value} requests per {user_key.rate_limit_period} exceeded'}), 429
-    if user_key.token_limit_enabled and user_key.token_limit_value > 0:
-        period_seconds = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800, 'month': 2592000}.get(user_key.token_limit_period, 86400)
-        start_time = now - timedelta(seconds=period_seconds)
-        token_count = db.session.query(func.coalesce(func.sum(UsageLog.total_tokens), 0)).filter(UsageLog.user_key_id == user_key.id, UsageLog.ts >= start_time).scalar() or 0
-        if token_count >= user_key.token_limit_value:
-            return jsonify({'error': 'token_limit_exceeded', 'message': f'Token limit of {user_key.token_limit_value} tokens per {user_key.token_limit_period} exceeded'}), 429
-    user_key.last_used_at = now
-    db.session.commit()
+    exceeded = check_key_limits(user_key)
+    if exceeded:
+        return _limit_response(user_key, exceeded)
+    key_cache.touch(user_key.id)
     body = request.get_json(force=True)
-    upstream_key, provider_id = _resolve_upstream_key()
-    if not upstream_key:
-        return jsonify({'error': 'no_provider_configured', 'message': 'No upstream provider key configured'}), 500
-    upstream = os.getenv('UPSTREAM_URL', 'https://ai.hackclub.com/proxy/v1').rstrip('/') + '/embeddings'
+    key, cached, cache_status = _cache_lookup('embeddings', user_key.id, body)
+    if cached is not None:
+        return cached
     try:
-        resp = requests.post(
-            upstream,
-            headers={'Authorization': f'Bearer {upstream_key}', 'Content-Type': 'application/json'},
-            data=json.dumps(body),
-            timeout=120,
-        )
+        resp = upstream_request('/embeddings', body, timeout=120)
+    except ProviderUnavailable as e:
+        return _cache_mark(_provider_response(e), cache_status)
     except Exception as e:
-        return jsonify({'error': 'upstream_error', 'message': str(e)}), 502
+        return _cache_mark((jsonify({'error': 'upstream_error', 'message': str(e)}), 502), cache_status)
+    provider_id = resp.provider_id
     ct = resp.headers.get('Content-Type', '')
     if 'application/json' in ct:
         data = resp.json()
         pt, rt, tt = extract_tokens(data)
-        ul = UsageLog(provider_key_id=provider_id, user_key_id=user_key.id, request_tokens=pt, response_tokens=rt, total_tokens=tt)
-        db.session.add(ul)
-        db.session.commit()
+        log_usage(provider_id, user_key.id, request_tokens=pt, response_tokens=rt, total_tokens=tt, cached_tokens=extract_cached_tokens(data))
         response = make_response(jsonify(data), resp.status_code)
+        response = _cache_store(key, cache_status, response, provider_id, body, data, tt)
         return apply_cors_headers(response)
-    ul = UsageLog(provider_key_id=provider_id, user_key_id=user_key.id)
-    db.session.add(ul)
-    db.session.commit()
-    response = make_response(resp.content, resp.status_code, {'Content-Type': ct})
+    log_usage(provider_id, user_key.id)
+    response = _cache_mark(make_response(resp.content, resp.status_code, {'Content-Type': ct}), cache_status)
     return apply_cors_headers(response)
 
+def _event_usage(raw):
+    if b'"usage"' not in raw:
+        return None
+    data = event_data(raw)
+    if not data:
+        return None
+    try:
+        chunk = loads(data)
+    except ValueError:
+        return None
+    if isinstance(chunk, dict) and chunk.get('usage'):
+        return chunk
+    return None
+
+def _relay_stream(resp, provider_id, user_key_id, hide_usage):
+    usage = (0, 0, 0)
+    cached = 0
+    decoder = SSEDecoder()
+    try:
+        for chunk in resp.iter_content(chunk_size=None):
+            out = []
+            for raw in decoder.feed(chunk):
+                data = _event_usage(raw)
+                if data is not None:
+                    usage = extract_tokens(data)
+                    cached = extract_cached_tokens(data)
+                    if hide_usage and not data.get('choices'):
+                        continue
+                out.append(raw)
+                out.append(b'\n\n')
+            if out:
+                yield b''.join(out)
+        rest = decoder.close()
+        if rest:
+            yield rest[0] + b'\n\n'
+    finally:
+        resp.close()
+        pt, rt, tt = usage
+        log_usage(provider_id, user_key_id, request_tokens=pt, response_tokens=rt, total_tokens=tt, cached_tokens=cached)
+
 @api_bp.route('/api/proxy/chat/completions', methods=['OPTIONS'])
 def proxy_chat_options():
     response = make_response('', 204)
@@ -182,65 +325,64 @@ def proxy_chat():
     
     user_token = auth.split(' ', 1)[1]
     
-    user_key = UserKey.query.filter_by(key=user_token, enabled=True).first()
+    user_key = key_cache.authenticate(user_token)
     if not user_key:
         return jsonify({'error': 'unauthorized', 'message': 'Invalid or disabled API key'}), 401
     
-    now = datetime.utcnow()
-    
-    if user_key.rate_limit_enabled and user_key.rate_limit_value > 0:
-        period_seconds = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800, 'month': 2592000}.get(user_key.rate_limit_period, 60)
-        start_time = now - timedelta(seconds=period_seconds)
-        count = db.session.query(func.count(UsageLog.id)).filter(UsageLog.user_key_id == user_key.id, UsageLog.ts >= start_time).scalar() or 0
-        if count >= user_key.rate_limit_value:
-            return jsonify({'error': 'rate_limit_exceeded', 'message': f'Rate limit of {user_key.rate_limit_value} requests per {user_key.rate_limit_period} exceeded'}), 429
+    exceeded = check_key_limits(user_key)
+    if exceeded:
+        return _limit_response(user_key, exceeded)
     
-    if user_key.token_limit_enabled and user_key.token_limit_value > 0:
-        period_seconds = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800, 'month': 2592000}.get(user_key.token_limit_period, 86400)
-        start_time = now - timedelta(seconds=period_seconds)
-        token_count = db.session.query(func.coalesce(func.sum(UsageLog.total_tokens), 0)).filter(UsageLog.user_key_id == user_key.id, UsageLog.ts >= start_time).scalar() or 0
-        if token_count >= user_key.token_limit_value:
-            return jsonify({'error': 'token_limit_exceeded', 'message': f'Token limit of {user_key.token_limit_value} tokens per {user_key.token_limit_period} exceeded'}), 429
-    
-    user_key.last_used_at = now
-    db.session.commit()
+    key_cache.touch(user_key.id)
     
     body = request.get_json(force=True)
     
-    upstream_key, provider_id = _resolve_upstream_key()
-    if not upstream_key:
-        return jsonify({'error': 'no_provider_configured', 'message': 'No upstream provider key configured'}), 500
     models = fetch_models()
+    stream = False
+    hide_usage = False
     if isinstance(body, dict):
         chosen = body.get('model')
-        if not chosen or (models and chosen not in models):
+        if not chosen or (models and not model_available(chosen)):
             if models:
                 body['model'] = models[0]
+        stream = bool(body.get('stream'))
+        if stream:
+            options = body.get('stream_options') if isinstance(body.get('stream_options'), dict) else {}
+            hide_usage = not options.get('include_usage')
+            body['stream_options'] = {**options, 'include_usage': True}
     
-    upstream = os.getenv('UPSTREAM_URL', 'https://ai.hackclub.com/proxy/v1').rstrip('/') + '/chat/completions'
+    key, cached, cache_status = _cache_lookup('chat', user_key.id, body)
+    if cached is not None:
+        return cached
     
     try:
-        resp = requests.post(
-            upstream,
-            headers={'Authorization': f'Bearer {upstream_key}', 'Content-Type': 'application/json'},
-            data=json.dumps(body),
-            timeout=120,
-        )
+        resp = upstream_request('/chat/completions', body, timeout=120, stream=stream)
+    except ProviderUnavailable as e:
+        return _cache_mark(_provider_response(e), cache_status)
     except Exception as e:
-        return jsonify({'error': 'upstream_error', 'message': str(e)}), 502
+        return _cache_mark((jsonify({'error': 'upstream_error', 'message': str(e)}), 502), cache_status)
+    provider_id = resp.provider_id
     
     ct = resp.headers.get('Content-Type', '')
+    if stream and resp.status_code == 200 and 'text/event-stream' in ct:
+        relay = _relay_stream(resp, provider_id, user_key.id, hide_usage)
+        response = Response(stream_with_context(relay), status=resp.status_code, content_type=ct)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return apply_cors_headers(response)
+    
+    try:
+        content = resp.content
+    finally:
+        resp.close()
     if 'application/json' in ct:
         data = resp.json()
         pt, rt, tt = extract_tokens(data)
-        ul = UsageLog(provider_key_id=provider_id, user_key_id=user_key.id, request_tokens=pt, response_tokens=rt, total_tokens=tt)
-        db.session.add(ul)
-        db.session.commit()
+        log_usage(provider_id, user_key.id, request_tokens=pt, response_tokens=rt, total_tokens=tt, cached_tokens=extract_cached_tokens(data))
         response = make_response(jsonify(data), resp.status_code)
+        response = _cache_store(key, cache_status, response, provider_id, body, data, tt)
         return apply_cors_headers(response)
     
-    ul = UsageLog(provider_key_id=provider_id, user_key_id=user_key.id)
-    db.session.add(ul)
-    db.session.commit()
-    response = make_response(resp.content, resp.status_code, {'Content-Type': ct})
+    log_usage(provider_id, user_key.id)
+    response = _cache_mark(make_response(content, resp.status_code, {'Content-Type': ct}), cache_status)
     return apply_cors_headers(response)
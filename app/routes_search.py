@@ -1,6 +1,6 @@
 import os
 from flask import Blueprint, jsonify, send_from_directory, request, session, redirect, url_for
-import requests
+from .search_cache import search_cache, SearchError, SEARCH_ENDPOINTS
 
 search_bp = Blueprint('search', __name__)
 
@@ -15,22 +15,14 @@ def search_api(search_type):
     if 'user_id' not in session:
         return jsonify({'error': 'unauthorized'}), 401
     
-    api_key = os.getenv('SEARCH_API_KEY', '').strip()
-    if not api_key:
+    if not os.getenv('SEARCH_API_KEY', '').strip():
         return jsonify({'error': 'Search API not configured'}), 500
     
     query = request.args.get('q', '').strip()
     if not query:
         return jsonify({'error': 'Query parameter required'}), 400
     
-    endpoint_map = {
-        'web': '/res/v1/web/search',
-        'images': '/res/v1/images/search',
-        'videos': '/res/v1/videos/search',
-        'news': '/res/v1/news/search'
-    }
-    
-    if search_type not in endpoint_map:
+    if search_type not in SEARCH_ENDPOINTS:
         return jsonify({'error': 'Invalid search type'}), 400
     
     params = {'q': query}
@@ -56,17 +48,12 @@ def search_api(search_type):
         if request.args.get('freshness'):
             params['freshness'] = request.args.get('freshness')
     
-    headers = {'Authorization': f'Bearer {api_key}'}
-    
     try:
-        resp = requests.get(
-            f'https://search.hackclub.com{endpoint_map[search_type]}',
-            params=params,
-            headers=headers,
-            timeout=10
-        )
-        if resp.status_code != 200:
-            return jsonify({'error': f'Search API error: {resp.status_code}'}), resp.status_code
-        return jsonify(resp.json())
+        data, cached = search_cache.search(search_type, params)
+    except SearchError as e:
+        return jsonify({'error': str(e)}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    resp = jsonify(data)
+    resp.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+    return resp
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import http_client
+
+SEARCH_BASE_URL = os.getenv('SEARCH_BASE_URL', 'https://search.hackclub.com').rstrip('/')
+SEARCH_ENDPOINTS = {
+    'web': '/res/v1/web/search',
+    'images': '/res/v1/images/search',
+    'videos': '/res/v1/videos/search',
+    'news': '/res/v1/news/search'
+}
+DEFAULT_TTLS = {'web': 900, 'images': 3600, 'videos': 1800, 'news': 120}
+KEY_FIELDS = ('q', 'count', 'offset', 'country', 'freshness', 'safesearch')
+MAX_OFFSET = 9
+
+
+class SearchError(Exception):
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _key(search_type, params):
+    values = [search_type]
+    for field in KEY_FIELDS:
+        value = params.get(field)
+        if field == 'q' and value:
+            value = ' '.join(str(value).split())
+        values.append(None if value is None else str(value))
+    return tuple(values)
+
+
+class SearchCache:
+    def __init__(self, size=None):
+        self.size = size or int(os.getenv('SEARCH_CACHE_SIZE', '1000'))
+        self.ttls = {t: float(os.getenv(f'SEARCH_CACHE_TTL_{t.upper()}', str(ttl))) for t, ttl in DEFAULT_TTLS.items()}
+        self.prefetch_enabled = os.getenv('SEARCH_PREFETCH', '0').lower() in ('1', 'true', 'yes')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='search-prefetch')
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.prefetches = 0
+        self.errors = 0
+
+    def _cached(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _fetch(self, search_type, params, timeout):
+        api_key = os.getenv('SEARCH_API_KEY', '').strip()
+        if not api_key:
+            raise SearchError('Search API not configured', 500)
+        resp = http_client.get(
+            SEARCH_BASE_URL + SEARCH_ENDPOINTS[search_type],
+            params=params,
+            headers={'Authorization': f'Bearer {api_key}'},
+            timeout=timeout
+        )
+        if resp.status_code != 200:
+            raise SearchError(f'Search API error: {resp.status_code}', resp.status_code)
+        return resp.json()
+
+    def search(self, search_type, params, timeout=10, prefetch=None):
+        key = _key(search_type, params)
+        with self._lock:
+            data = self._cached(key, time.monotonic())
+            if data is not None:
+                self.hits += 1
+                cached = True
+            else:
+                future = self._inflight.get(key)
+                leader = future is None
+                if leader:
+                    future = self._inflight[key] = Future()
+                    self.misses += 1
+                else:
+                    self.coalesced += 1
+        if data is None:
+            if not leader:
+                return future.result(timeout=timeout + 1), True
+            try:
+                data = self._fetch(search_type, params, timeout)
+            except Exception as exc:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                    self.errors += 1
+                future.set_exception(exc)
+                raise
+            with self._lock:
+                self._entries[key] = (data, time.monotonic() + self.ttls.get(search_type, 300))
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                self._inflight.pop(key, None)
+            future.set_result(data)
+            cached = False
+        if prefetch if prefetch is not None else self.prefetch_enabled:
+            self._prefetch(search_type, params, timeout)
+        return data, cached
+
+    def _prefetch(self, search_type, params, timeout):
+        if 'offset' not in params or int(params['offset']) >= MAX_OFFSET:
+            return
+        following = dict(params, offset=int(params['offset']) + 1)
+        key = _key(search_type, following)
+        with self._lock:
+            if key in self._inflight or self._cached(key, time.monotonic()) is not None:
+                return
+            self.prefetches += 1
+
+        def run():
+            try:
+                self.search(search_type, following, timeout, prefetch=False)
+            except Exception:
+                pass
+
+        self._pool.submit(run)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'prefetches': self.prefetches,
+                'errors': self.errors,
+                'prefetch_enabled': self.prefetch_enabled
+            }
+
+
+search_cache = SearchCache()
@@ -0,0 +1,168 @@
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DONE = b'[DONE]'
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class SSEDecoder:
+    def __init__(self):
+        self._pending = []
+        self._tail_newline = False
+        self._cr = False
+
+    def _normalize(self, chunk):
+        if self._cr:
+            chunk = b'\r' + chunk
+            self._cr = False
+        if chunk.endswith(b'\r'):
+            chunk = chunk[:-1]
+            self._cr = True
+        return chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    def feed(self, chunk):
+        if not chunk:
+            return []
+        if self._cr or b'\r' in chunk:
+            chunk = self._normalize(chunk)
+        if self._pending:
+            if b'\n\n' not in chunk and not (self._tail_newline and chunk.startswith(b'\n')):
+                self._pending.append(chunk)
+                self._tail_newline = chunk.endswith(b'\n')
+                return []
+            self._pending.append(chunk)
+            chunk = b''.join(self._pending)
+            self._pending = []
+        events = chunk.split(b'\n\n')
+        rest = events.pop()
+        if rest:
+            self._pending.append(rest)
+            self._tail_newline = rest.endswith(b'\n')
+        return [event for event in events if event]
+
+    def close(self):
+        rest = b''.join(self._pending).strip(b'\n')
+        self._pending = []
+        return [rest] if rest else []
+
+
+def event_data(raw):
+    if raw.startswith(b':'):
+        return None
+    if b'\n' not in raw:
+        if not raw.startswith(b'data:'):
+            return None
+        data = raw[5:]
+        return data[1:] if data.startswith(b' ') else data
+    lines = []
+    for line in raw.split(b'\n'):
+        if line.startswith(b'data:'):
+            data = line[5:]
+            lines.append(data[1:] if data.startswith(b' ') else data)
+        elif line == b'data':
+            lines.append(b'')
+    return b'\n'.join(lines) if lines else None
+
+
+def event_name(raw):
+    for line in raw.split(b'\n'):
+        if line.startswith(b'event:'):
+            return line[6:].strip().decode('utf-8', 'replace')
+    return None
+
+
+def _error_message(error):
+    if isinstance(error, dict):
+        return str(error.get('message') or error)
+    return str(error)
+
+
+class StreamParser:
+    def __init__(self):
+        self.decoder = SSEDecoder()
+        self.done = False
+        self.events = 0
+        self.skipped = 0
+
+    def _parse(self, raw, out):
+        if raw.startswith(b'data: ') and b'\n' not in raw:
+            data = raw[6:]
+            named = False
+        else:
+            data = event_data(raw)
+            if data is None:
+                self.skipped += 1
+                return
+            named = b'event:' in raw
+        self.events += 1
+        if not data.startswith(b'{') and data.strip() == DONE:
+            self.done = True
+            out.append(('done', None))
+            return
+        try:
+            chunk = loads(data)
+        except ValueError:
+            self.skipped += 1
+            return
+        if not isinstance(chunk, dict):
+            return
+        if 'error' in chunk or named:
+            if chunk.get('error') or event_name(raw) == 'error':
+                out.append(('error', _error_message(chunk.get('error') or chunk)))
+        choices = chunk.get('choices')
+        if choices:
+            choice = choices[0]
+            delta = choice.get('delta') or {}
+            content = delta.get('content')
+            if content:
+                out.append(('content', content))
+            images = choice.get('images') or delta.get('images')
+            if isinstance(images, list):
+                out.append(('images', images))
+            elif choice.get('image_url'):
+                out.append(('images', [choice['image_url']]))
+        if 'usage' in chunk and chunk['usage']:
+            out.append(('usage', chunk['usage']))
+
+    def feed(self, chunk):
+        out = []
+        if self.done:
+            return out
+        for raw in self.decoder.feed(chunk):
+            self._parse(raw, out)
+            if self.done:
+                break
+        return out
+
+    def close(self):
+        out = []
+        if not self.done:
+            for raw in self.decoder.close():
+                self._parse(raw, out)
+        return out
+
+
+def iter_batches(resp):
+    parser = StreamParser()
+    for chunk in resp.iter_content(chunk_size=None):
+        events = parser.feed(chunk)
+        yield events
+        if parser.done:
+            return
+    events = parser.close()
+    if events:
+        yield events
+
+
+def iter_events(resp):
+    for events in iter_batches(resp):
+        for event in events:
+            yield event
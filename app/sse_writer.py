@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SSE_FLUSH_MS = float(os.getenv('SSE_FLUSH_MS', '30'))
+SSE_FLUSH_BYTES = int(os.getenv('SSE_FLUSH_BYTES', '256'))
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_lock = threading.Lock()
+_stats = {'streams': 0, 'deltas': 0, 'frames': 0, 'bytes': 0, 'aborted': {'chat': 0, 'collab': 0}, 'aborted_chars': 0}
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return _encoder.encode(payload).encode('utf-8')
+
+
+def sse_frame(payload):
+    return b'data: ' + dumps(payload) + b'\n\n'
+
+
+def disconnect_probe(environ):
+    check = environ.get('waitress.client_disconnected')
+    if check is None:
+        return lambda: False
+    return check
+
+
+def note_abort(source, chars=0):
+    with _lock:
+        _stats['aborted'][source] = _stats['aborted'].get(source, 0) + 1
+        _stats['aborted_chars'] += chars
+
+
+class StreamWriter:
+    def __init__(self, interval_ms=None, max_bytes=None, clock=time.monotonic):
+        self.interval = (interval_ms if interval_ms is not None else SSE_FLUSH_MS) / 1000.0
+        self.max_bytes = max_bytes if max_bytes is not None else SSE_FLUSH_BYTES
+        self.clock = clock
+        self.parts = []
+        self.pending = []
+        self.pending_size = 0
+        self.last_flush = None
+        self.deltas = 0
+        self.frames = 0
+        self.bytes = 0
+
+    @property
+    def text(self):
+        if len(self.parts) > 1:
+            self.parts[:] = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
+
+    def _emit(self, frame):
+        self.frames += 1
+        self.bytes += len(frame)
+        return frame
+
+    def event(self, payload):
+        pending = self.flush()
+        frame = self._emit(sse_frame(payload))
+        return pending + frame if pending else frame
+
+    def content(self, text):
+        if not text:
+            return None
+        self.parts.append(text)
+        self.pending.append(text)
+        self.pending_size += len(text) if text.isascii() else len(text.encode('utf-8'))
+        self.deltas += 1
+        if self.pending_size >= self.max_bytes:
+            return self.flush()
+        return self.tick()
+
+    def tick(self):
+        if not self.pending:
+            return None
+        if self.last_flush is None or self.clock() - self.last_flush >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.pending:
+            return None
+        text = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.last_flush = self.clock()
+        return self._emit(sse_frame({'type': 'content', 'content': text}))
+
+    def close(self):
+        with _lock:
+            _stats['streams'] += 1
+            _stats['deltas'] += self.deltas
+            _stats['frames'] += self.frames
+            _stats['bytes'] += self.bytes
+
+
+def sse_stats():
+    with _lock:
+        stats = dict(_stats, aborted=dict(_stats['aborted']))
+    stats['json_backend'] = JSON_BACKEND
+    stats['flush_ms'] = SSE_FLUSH_MS
+    stats['flush_bytes'] = SSE_FLUSH_BYTES
+    return stats
@@ -0,0 +1,141 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import insert
+
+from . import db
+from .models import UsageLog
+
+
+class UsageWriter:
+    def __init__(self, interval_ms=None, batch_size=None, max_queue=None):
+        self.interval = (interval_ms if interval_ms is not None else int(os.getenv('USAGE_FLUSH_INTERVAL_MS', '500'))) / 1000.0
+        self.batch_size = batch_size or int(os.getenv('USAGE_FLUSH_BATCH', '200'))
+        self.max_queue = max_queue or int(os.getenv('USAGE_QUEUE_MAX', '50000'))
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._queue = deque()
+        self._app = None
+        self._retries = 0
+        self.max_retries = 3
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_flush_ms = 0.0
+
+    def submit(self, row):
+        with self._cond:
+            self._queue.append(row)
+            while len(self._queue) > self.max_queue:
+                self._queue.popleft()
+                self.dropped += 1
+            depth = len(self._queue)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            if depth >= self.batch_size:
+                self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            rows = list(self._queue)
+            self._queue.clear()
+        return rows
+
+    def hold(self):
+        return self._flush_lock
+
+    def queued(self):
+        with self._cond:
+            return list(self._queue)
+
+    def _write(self, rows):
+        db.session.execute(insert(UsageLog), rows)
+        db.session.commit()
+
+    def _write_each(self, rows):
+        written = 0
+        for row in rows:
+            try:
+                self._write([row])
+                written += 1
+            except Exception:
+                db.session.rollback()
+                self.dropped += 1
+        return written
+
+    def flush(self):
+        with self._flush_lock:
+            rows = self._take()
+            if not rows:
+                return 0
+            started = time.perf_counter()
+            written = 0
+            error = None
+            for i in range(0, len(rows), self.batch_size):
+                chunk = rows[i:i + self.batch_size]
+                try:
+                    self._write(chunk)
+                except Exception as exc:
+                    db.session.rollback()
+                    self.failures += 1
+                    self._retries += 1
+                    error = exc
+                    if self._retries <= self.max_retries:
+                        with self._cond:
+                            self._queue.extendleft(reversed(rows[i:]))
+                        break
+                    self._retries = 0
+                    written += self._write_each(chunk)
+                    continue
+                self._retries = 0
+                written += len(chunk)
+                self.batches += 1
+            self.written += written
+            self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+            if error is not None:
+                raise error
+            return written
+
+    def _flush_in_app(self):
+        with self._app.app_context():
+            try:
+                self.flush()
+            except Exception as exc:
+                self._app.logger.warning('usage log flush failed: %s', exc)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if len(self._queue) < self.batch_size:
+                    self._cond.wait(self.interval)
+            self._flush_in_app()
+
+    def start(self, app):
+        if self._app is not None:
+            return
+        self._app = app
+        threading.Thread(target=self._loop, daemon=True).start()
+        atexit.register(self._flush_in_app)
+
+    def stats(self):
+        with self._cond:
+            depth = len(self._queue)
+        return {
+            'queue_depth': depth,
+            'max_depth': self.max_depth,
+            'written': self.written,
+            'batches': self.batches,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'last_flush_ms': self.last_flush_ms,
+            'interval_ms': int(self.interval * 1000),
+            'batch_size': self.batch_size
+        }
+
+
+usage_writer = UsageWriter()
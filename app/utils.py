@@ -1,13 +1,25 @@
 import datetime
 import os
 import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import requests
-from bs4 import BeautifulSoup
-from sqlalchemy import func
 
-from . import db
-from .models import ProviderKey, UsageLog
+from . import http_client
+from .page_cache import page_cache
+from .page_text import capped_chunks, extract_text, response_encoding, text_content_type
+from .prompt_layout import note_prompt_usage
+from .quota import record_usage
+from .search_cache import search_cache
+from .usage_writer import usage_writer
+
+WEB_CONTEXT_RESULTS = int(os.getenv('WEB_CONTEXT_RESULTS', '3'))
+WEB_CONTEXT_BUDGET_MS = float(os.getenv('WEB_CONTEXT_BUDGET_MS', '6000'))
+PAGE_TEXT_CHARS = int(os.getenv('PAGE_CACHE_TEXT_CHARS', '8000'))
+PAGE_FETCH_MAX_BYTES = int(os.getenv('PAGE_FETCH_MAX_BYTES', str(1024 * 1024)))
+
+_scrape_pool = ThreadPoolExecutor(max_workers=int(os.getenv('WEB_SCRAPE_WORKERS', '8')), thread_name_prefix='scrape')
 
 def generate_api_key():
     return 'sk_' + secrets.token_urlsafe(48)
@@ -17,29 +29,6 @@ def mask_key(k):
         return '****'
     return k[:4] + '****' + k[-4:]
 
-def today_range():
-    now = datetime.datetime.utcnow()
-    start = datetime.datetime(now.year, now.month, now.day)
-    end = start + datetime.timedelta(days=1)
-    return start, end
-
-def eligible_keys():
-    now = datetime.datetime.utcnow()
-    minute_ago = now - datetime.timedelta(seconds=60)
-    start, end = today_range()
-    rows = ProviderKey.query.filter_by(enabled=True).all()
-    out = []
-    for r in rows:
-        count_min = db.session.query(func.count(UsageLog.id)).filter(UsageLog.provider_key_id == r.id, UsageLog.ts >= minute_ago).scalar()
-        if r.rate_limit_per_min and count_min >= r.rate_limit_per_min:
-            continue
-        tokens_today = db.session.query(func.coalesce(func.sum(UsageLog.total_tokens), 0)).filter(UsageLog.provider_key_id == r.id, UsageLog.ts >= start, UsageLog.ts < end).scalar() or 0
-        if r.token_limit_per_day and tokens_today >= r.token_limit_per_day:
-            continue
-        out.append((r, count_min, tokens_today))
-    out.sort(key=lambda x: (x[1], x[2]))
-    return [x[0] for x in out]
-
 def extract_tokens(data):
     try:
         u = data.get('usage')
@@ -53,52 +42,104 @@ def extract_tokens(data):
         return 0, 0, 0
 
 
-def tavily_search(query, max_results=3):
-    api_key = os.getenv('SEARCH_API_KEY', '').strip()
-    if not api_key or not query:
+def extract_cached_tokens(data):
+    try:
+        u = data.get('usage') or {}
+        details = u.get('prompt_tokens_details') or {}
+        return int(details.get('cached_tokens') or u.get('cache_read_input_tokens') or 0)
+    except Exception:
+        return 0
+
+
+def log_usage(provider_key_id, user_key_id, request_tokens=0, response_tokens=0, total_tokens=0, model=None, cost=0.0, cached_tokens=0, cache_hit=False):
+    row = {
+        'provider_key_id': provider_key_id,
+        'user_key_id': user_key_id,
+        'ts': datetime.datetime.utcnow(),
+        'request_tokens': request_tokens or 0,
+        'response_tokens': response_tokens or 0,
+        'total_tokens': total_tokens or 0,
+        'model': model,
+        'cost': cost or 0.0,
+        'cached_tokens': cached_tokens or 0,
+        'cache_hit': bool(cache_hit)
+    }
+    record_usage(user_key_id, total_tokens, None if cache_hit else provider_key_id, row)
+    usage_writer.submit(row)
+    note_prompt_usage(request_tokens, cached_tokens)
+    return row
+
+
+def tavily_search(query, max_results=3, timeout=10):
+    if not os.getenv('SEARCH_API_KEY', '').strip() or not query:
         return []
     params = {
         'q': query,
         'count': min(max_results, 20)
     }
-    headers = {
-        'Authorization': f'Bearer {api_key}'
-    }
     try:
-        resp = requests.get('https://search.hackclub.com/res/v1/web/search', params=params, headers=headers, timeout=10)
-        if resp.status_code != 200:
-            return []
-        data = resp.json()
+        data, _ = search_cache.search('web', params, timeout=timeout, prefetch=False)
         web_results = data.get('web', {}).get('results', [])
         return [{'url': r.get('url'), 'title': r.get('title'), 'content': r.get('description')} for r in web_results]
     except Exception:
         return []
 
 
-def scrape_url(url, max_chars=1200):
+def _extract_page(url, timeout):
+    headers = {'User-Agent': 'DeakteriChatBot/1.0', 'Accept': 'text/html,application/xhtml+xml,text/plain;q=0.8'}
+    resp = http_client.get(url, headers=headers, timeout=timeout, stream=True)
+    try:
+        content_type = text_content_type(resp.headers.get('Content-Type'))
+        if resp.status_code != 200 or not content_type:
+            return None
+        return extract_text(
+            capped_chunks(resp, PAGE_FETCH_MAX_BYTES),
+            PAGE_TEXT_CHARS,
+            encoding=response_encoding(resp),
+            html=content_type != 'text/plain'
+        )
+    finally:
+        resp.close()
+
+
+def scrape_url(url, max_chars=1200, timeout=10):
     if not url:
         return ''
-    headers = {'User-Agent': 'DeakteriChatBot/1.0'}
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        content_type = resp.headers.get('Content-Type', '')
-        if resp.status_code != 200 or 'text' not in content_type:
+    hit, text = page_cache.get(url)
+    if not hit:
+        try:
+            text = _extract_page(url, timeout)
+        except requests.exceptions.Timeout:
             return ''
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        for tag in soup(['script', 'style', 'noscript']):
-            tag.extract()
-        text = ' '.join(chunk.strip() for chunk in soup.get_text(separator=' ', strip=True).split())
-        return text[:max_chars]
-    except Exception:
-        return ''
+        except Exception:
+            text = None
+        page_cache.put(url, text)
+    return (text or '')[:max_chars]
 
 
-def gather_web_context(query, limit=3):
-    results = tavily_search(query, max_results=limit)
+def gather_web_context(query, limit=None, budget_ms=None):
+    limit = limit or WEB_CONTEXT_RESULTS
+    budget = (budget_ms if budget_ms is not None else WEB_CONTEXT_BUDGET_MS) / 1000.0
+    deadline = time.monotonic() + budget
+    results = tavily_search(query, max_results=limit, timeout=min(10, budget))
+    pending = {}
+    for idx, item in enumerate(results[:limit]):
+        url = item.get('url')
+        if url:
+            remaining = max(deadline - time.monotonic(), 0.5)
+            pending[_scrape_pool.submit(scrape_url, url, timeout=min(10, remaining))] = idx
+    scraped = {}
+    if pending:
+        done, _ = wait(pending, timeout=max(deadline - time.monotonic(), 0))
+        for future in done:
+            try:
+                scraped[pending[future]] = future.result()
+            except Exception:
+                pass
     context = []
-    for item in results:
+    for idx, item in enumerate(results[:limit]):
         url = item.get('url')
-        content = scrape_url(url)
+        content = scraped.get(idx)
         snippet = content or item.get('content') or item.get('snippet') or ''
         if not snippet:
             continue
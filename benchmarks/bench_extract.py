@@ -0,0 +1,98 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+from app.page_text import PARSER_BACKEND, etree, extract_text
+
+CHUNK = 16384
+
+
+def synthetic_pages():
+    paragraph = '<p>The quick brown fox jumps over the lazy dog &amp; keeps running.</p>\n'
+    script = '<script>window.__STATE__ = {"items": [' + ','.join(str(i) for i in range(2000)) + ']};</script>\n'
+    pages = {}
+    for name, repeat in (('small', 40), ('medium', 2000), ('large', 40000)):
+        body = ''.join(script if i % 50 == 0 else paragraph for i in range(repeat))
+        pages[name] = f'<html><head><title>{name}</title><style>p{{margin:0}}</style></head><body>{body}</body></html>'.encode('utf-8')
+    return pages
+
+
+def load_pages(path):
+    pages = {}
+    for file in sorted(glob.glob(os.path.join(path, '*.htm*'))):
+        with open(file, 'rb') as f:
+            pages[os.path.basename(file)] = f.read()
+    return pages
+
+
+def baseline(raw, limit):
+    soup = BeautifulSoup(raw.decode('utf-8', errors='replace'), 'html.parser')
+    for tag in soup(['script', 'style', 'noscript']):
+        tag.extract()
+    text = ' '.join(chunk.strip() for chunk in soup.get_text(separator=' ', strip=True).split())
+    return text[:limit]
+
+
+def chunked(raw, cap, consumed):
+    for i in range(0, min(len(raw), cap), CHUNK):
+        chunk = raw[i:min(i + CHUNK, cap)]
+        consumed[0] += len(chunk)
+        yield chunk
+
+
+def streaming(backend, cap):
+    def run(raw, limit):
+        consumed = [0]
+        text = extract_text(chunked(raw, cap, consumed), limit, backend=backend)
+        run.consumed = consumed[0]
+        return text
+    run.consumed = 0
+    return run
+
+
+def measure(fn, raw, limit, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        text = fn(raw, limit)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, len(text), getattr(fn, 'consumed', len(raw))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare full-soup page extraction with the streaming extractor.')
+    parser.add_argument('corpus', nargs='?', help='directory of saved .html pages (synthetic pages when omitted)')
+    parser.add_argument('--limit', type=int, default=1200, help='characters of text to keep')
+    parser.add_argument('--max-bytes', type=int, default=1024 * 1024, help='byte cap for the streaming fetch')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pages = load_pages(args.corpus) if args.corpus else synthetic_pages()
+    if not pages:
+        sys.exit(f'no .html pages found in {args.corpus}')
+
+    runners = [('bs4 html.parser (full)', baseline), ('stream html.parser', streaming('html.parser', args.max_bytes))]
+    if etree is not None:
+        runners.append(('stream lxml', streaming('lxml', args.max_bytes)))
+    print(f'default backend: {PARSER_BACKEND}, limit: {args.limit} chars, cap: {args.max_bytes} bytes\n')
+    print(f'{"page":<28}{"size":>10}  {"extractor":<24}{"ms":>10}{"chars":>8}{"read":>12}')
+    totals = {}
+    for name, raw in pages.items():
+        for label, fn in runners:
+            ms, chars, consumed = measure(fn, raw, args.limit, args.repeat)
+            totals[label] = totals.get(label, 0) + ms
+            print(f'{name[:27]:<28}{len(raw):>10}  {label:<24}{ms:>10.2f}{chars:>8}{consumed:>12}')
+    print()
+    for label, ms in totals.items():
+        print(f'{label:<24} total {ms:>10.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.sse_writer import JSON_BACKEND, StreamWriter
+
+
+def make_deltas(count, seed=7):
+    rng = random.Random(seed)
+    words = ['the', 'model', 'streams', 'tokens', 'quickly', 'ő', 'árvíztűrő', '```', 'def', '\n', '**', 'x', 'résumé']
+    return [(' ' if rng.random() < 0.7 else '') + rng.choice(words) for _ in range(count)]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def baseline(deltas, rate):
+    out = []
+    accumulated = ''
+    for delta in deltas:
+        accumulated += delta
+        out.append(f"data: {json.dumps({'type': 'content', 'content': delta})}\n\n")
+    return out, accumulated
+
+
+def coalesced(interval_ms, max_bytes):
+    def run(deltas, rate):
+        clock = FakeClock()
+        writer = StreamWriter(interval_ms=interval_ms, max_bytes=max_bytes, clock=clock)
+        step = 1.0 / rate if rate else 0.0
+        out = []
+        for delta in deltas:
+            clock.now += step
+            frame = writer.content(delta)
+            if frame:
+                out.append(frame)
+        frame = writer.flush()
+        if frame:
+            out.append(frame)
+        return out, writer.text
+    return run
+
+
+def measure(fn, deltas, rate, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        frames, text = fn(deltas, rate)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    size = sum(len(f) for f in frames)
+    return best, len(frames), size, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-delta SSE framing with the coalescing stream writer.')
+    parser.add_argument('--tokens', type=int, default=20000)
+    parser.add_argument('--rates', default='50,200,1000,0', help='upstream tokens/s to simulate, 0 for unthrottled')
+    parser.add_argument('--interval-ms', type=float, default=30)
+    parser.add_argument('--max-bytes', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    deltas = make_deltas(args.tokens)
+    runners = [('per-delta json.dumps', baseline), (f'writer {args.interval_ms:g}ms/{args.max_bytes}B', coalesced(args.interval_ms, args.max_bytes))]
+    print(f'json backend: {JSON_BACKEND}, tokens: {args.tokens}\n')
+    print(f'{"tok/s":>8}  {"writer":<26}{"frames":>8}{"frames/s":>10}{"bytes":>10}{"cpu us/tok":>12}')
+    for rate in (int(r) for r in args.rates.split(',')):
+        expected = None
+        for label, fn in runners:
+            cpu, frames, size, text = measure(fn, deltas, rate, args.repeat)
+            if expected is None:
+                expected = text
+            elif text != expected:
+                sys.exit(f'{label} produced different text')
+            per_second = f'{frames / (args.tokens / rate):.1f}' if rate else '-'
+            print(f'{rate or "max":>8}  {label:<26}{frames:>8}{per_second:>10}{size:>10}{cpu / args.tokens * 1e6:>12.3f}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.sse_parser import SSEDecoder, StreamParser, orjson
+
+
+def make_stream(events, keepalive_every, seed=11):
+    rng = random.Random(seed)
+    words = ['the', 'model', 'streams', 'tokens', 'ő', 'árvíztűrő', '```', 'def', '\n', 'x']
+    out = []
+    text = []
+    for i in range(events):
+        if keepalive_every and i % keepalive_every == 0:
+            out.append(b': OPENROUTER PROCESSING\n\n')
+        delta = ' ' + rng.choice(words)
+        text.append(delta)
+        chunk = {'id': 'gen-1', 'object': 'chat.completion.chunk', 'model': 'm', 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': delta}, 'finish_reason': None}]}
+        out.append(b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n')
+    out.append(b'data: ' + json.dumps({'choices': [], 'usage': {'prompt_tokens': 10, 'completion_tokens': events, 'total_tokens': events + 10}}).encode() + b'\n\n')
+    out.append(b'data: [DONE]\n\n')
+    return b''.join(out), ''.join(text)
+
+
+def split_chunks(raw, min_size, max_size, seed=3):
+    rng = random.Random(seed)
+    chunks = []
+    i = 0
+    while i < len(raw):
+        size = rng.randint(min_size, max_size)
+        chunks.append(raw[i:i + size])
+        i += size
+    return chunks
+
+
+def iter_lines(chunks):
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def baseline(chunks):
+    text = []
+    for line in iter_lines(chunks):
+        if line:
+            line_str = line.decode('utf-8')
+            if line_str.startswith('data: '):
+                chunk_data = line_str[6:]
+                if chunk_data.strip() == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(chunk_data)
+                    if 'choices' in chunk and len(chunk['choices']) > 0:
+                        content = chunk['choices'][0].get('delta', {}).get('content', '')
+                        if content:
+                            text.append(content)
+                except json.JSONDecodeError:
+                    pass
+    return ''.join(text)
+
+
+def parser(chunks):
+    stream = StreamParser()
+    text = []
+    for chunk in chunks:
+        for kind, value in stream.feed(chunk):
+            if kind == 'content':
+                text.append(value)
+        if stream.done:
+            break
+    return ''.join(text)
+
+
+def framing_only(chunks):
+    decoder = SSEDecoder()
+    count = 0
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+    return count
+
+
+def measure(fn, chunks, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(chunks)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser_args = argparse.ArgumentParser(description='Micro-benchmark the incremental SSE parser against line-based parsing.')
+    parser_args.add_argument('--events', type=int, default=20000)
+    parser_args.add_argument('--keepalive-every', type=int, default=20)
+    parser_args.add_argument('--repeat', type=int, default=5)
+    args = parser_args.parse_args()
+
+    raw, expected = make_stream(args.events, args.keepalive_every)
+    print(f'json backend: {"orjson" if orjson is not None else "json"}, events: {args.events}, stream: {len(raw)} bytes\n')
+    print(f'{"chunking":<18}{"parser":<22}{"ms":>9}{"MB/s":>9}{"us/event":>10}')
+    for label, lo, hi in (('tcp-like 1-4 KiB', 1024, 4096), ('tiny 16-64 B', 16, 64), ('one event/chunk', 0, 0)):
+        chunks = split_chunks(raw, lo, hi) if hi else [c + b'\n\n' for c in raw.split(b'\n\n') if c]
+        for name, fn in (('iter_lines + json', baseline), ('StreamParser', parser), ('SSEDecoder framing', framing_only)):
+            elapsed, result = measure(fn, chunks, args.repeat)
+            if isinstance(result, str) and result != expected:
+                sys.exit(f'{name} produced different text with {label} chunks')
+            mb = len(raw) / elapsed / 1e6
+            print(f'{label:<18}{name:<22}{elapsed * 1000:>9.2f}{mb:>9.1f}{elapsed / args.events * 1e6:>10.3f}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
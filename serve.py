@@ -1,4 +1,6 @@
 import os
+import signal
+import sys
 from waitress import serve
 from wsgi import app
 
@@ -6,4 +8,6 @@ if __name__ == '__main__':
     host = os.getenv('HOST', '0.0.0.0')
     port = int(os.getenv('PORT', '5000'))
     threads = int(os.getenv('THREADS', '4'))
-    serve(app, host=host, port=port, threads=threads)
+    lookahead = int(os.getenv('CHANNEL_REQUEST_LOOKAHEAD', '1'))
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    serve(app, host=host, port=port, threads=threads, channel_request_lookahead=lookahead)
@@ -7,6 +7,7 @@ let modeControl = 'smart';
 let chatNameCache = {};
 
 const MODE_ORDER = ['general', 'precise', 'turbo', 'ultimate'];
+const STREAM_RESUME_ATTEMPTS = 5;
 
 function configureMarked() {
     marked.setOptions({
@@ -708,7 +709,7 @@ async function sendMessage() {
     }
     
     const isImageModel = finalModel && (finalModel.includes('image') || finalModel.includes('dall-e'));
-    const useStream = mode !== 'ultimate' && !isImageModel;
+    const useStream = !isImageModel;
 
     if (!useStream) {
         const loadingId = 'loading-' + Date.now();
@@ -802,151 +803,205 @@ async function sendMessage() {
                 return;
             }
 
-            const reader = res.body.getReader();
-            const decoder = new TextDecoder();
             let accumulated = '';
             let streamData = {};
             let streamImages = [];
             let lastWordCount = 0;
-
-            while (true) {
-                const { done, value } = await reader.read();
-                if (done) break;
-
-                const chunk = decoder.decode(value, { stream: true });
-                const lines = chunk.split('\n');
-
-                for (const line of lines) {
-                    if (line.startsWith('data: ')) {
-                        const jsonStr = line.slice(6);
-                        if (jsonStr.trim()) {
-                            try {
-                                const data = JSON.parse(jsonStr);
+            let generationId = null;
+            let lastEventId = null;
+            let finished = false;
+            let resumeAttempts = 0;
+            let body = res.body;
+            let ensembleCandidates = {};
+            let fusionModel = null;
+
+            while (!finished) {
+                if (body) {
+                    const reader = body.getReader();
+                    const decoder = new TextDecoder();
+                    let pendingLine = '';
+                    let eventId = null;
+                    try {
+                        while (true) {
+                            const { done, value } = await reader.read();
+                            if (done) break;
+
+                            const chunk = pendingLine + decoder.decode(value, { stream: true });
+                            const lines = chunk.split('\n');
+                            pendingLine = lines.pop();
+
+                            for (const line of lines) {
+                                if (line.startsWith('id: ')) {
+                                    eventId = line.slice(4).trim();
+                                } else if (line.startsWith('data: ')) {
+                                    const jsonStr = line.slice(6);
+                                    if (jsonStr.trim()) {
+                                        try {
+                                            const data = JSON.parse(jsonStr);
                                 
-                                if (data.type === 'start') {
-                                    streamData = data.data;
-                                    if (!currentConversationId) {
-                                        currentConversationId = streamData.conversation_id;
-                                    }
-                                    if (streamData.images && streamData.images.length > 0) {
-                                        streamImages = streamData.images;
-                                    }
-                                } else if (data.type === 'content') {
-                                    accumulated += data.content;
-                                    const htmlContent = marked.parse(accumulated);
+                                            if (data.type === 'start') {
+                                                streamData = data.data;
+                                                generationId = streamData.generation_id || null;
+                                                if (!currentConversationId) {
+                                                    currentConversationId = streamData.conversation_id;
+                                                }
+                                                if (streamData.images && streamData.images.length > 0) {
+                                                    streamImages = streamData.images;
+                                                }
+                                            } else if (data.type === 'content' || data.type === 'snapshot') {
+                                                if (data.type === 'snapshot') {
+                                                    accumulated = data.content;
+                                                    lastWordCount = 0;
+                                                } else {
+                                                    accumulated += data.content;
+                                                }
+                                                const htmlContent = marked.parse(accumulated);
                                     
-                                    const tempDiv = document.createElement('div');
-                                    tempDiv.innerHTML = htmlContent;
-                                    const textContent = tempDiv.textContent || '';
-                                    const words = textContent.trim().split(/\s+/);
-                                    const currentWordCount = words.length;
+                                                const tempDiv = document.createElement('div');
+                                                tempDiv.innerHTML = htmlContent;
+                                                const textContent = tempDiv.textContent || '';
+                                                const words = textContent.trim().split(/\s+/);
+                                                const currentWordCount = words.length;
                                     
-                                    if (currentWordCount > lastWordCount) {
-                                        content.innerHTML = htmlContent + '<span class="word-cursor"></span>';
-                                        content.querySelectorAll('pre code').forEach((block) => {
-                                            hljs.highlightElement(block);
-                                        });
+                                                if (currentWordCount > lastWordCount) {
+                                                    content.innerHTML = htmlContent + '<span class="word-cursor"></span>';
+                                                    content.querySelectorAll('pre code').forEach((block) => {
+                                                        hljs.highlightElement(block);
+                                                    });
                                         
-                                        const newWords = content.querySelectorAll('p, li, h1, h2, h3, h4, h5, h6, td, th');
-                                        newWords.forEach(el => {
-                                            if (!el.classList.contains('word-animated')) {
-                                                el.classList.add('word-animated');
-                                            }
-                                        });
+                                                    const newWords = content.querySelectorAll('p, li, h1, h2, h3, h4, h5, h6, td, th');
+                                                    newWords.forEach(el => {
+                                                        if (!el.classList.contains('word-animated')) {
+                                                            el.classList.add('word-animated');
+                                                        }
+                                                    });
                                         
-                                        lastWordCount = currentWordCount;
-                                        scrollToBottom();
-                                    }
-                                } else if (data.type === 'images') {
-                                    if (data.images && data.images.length > 0) {
-                                        streamImages = data.images;
-                                    }
-                                } else if (data.type === 'done') {
-                                    const htmlContent = marked.parse(accumulated);
-                                    content.innerHTML = htmlContent;
-                                    content.querySelectorAll('pre code').forEach((block) => {
-                                        hljs.highlightElement(block);
-                                    });
-                                    renderMathInElement(content, {
-                                        delimiters: [
-                                            {left: '$$', right: '$$', display: true},
-                                            {left: '\\[', right: '\\]', display: true},
-                                            {left: '\\(', right: '\\)', display: false}
-                                        ],
-                                        throwOnError: false
-                                    });
-
-                                    if (streamImages && streamImages.length > 0) {
-                                        let imgsHtml = '<div class="message-images">';
-                                        streamImages.forEach(img => {
-                                            let url = img;
-                                            if (typeof img === 'object') {
-                                                url = img.url || img.image_url || '';
-                                                if (typeof url === 'object') url = url.url;
-                                            }
+                                                    lastWordCount = currentWordCount;
+                                                    scrollToBottom();
+                                                }
+                                            } else if (data.type === 'candidate' || data.type === 'fusion') {
+                                                if (data.type === 'candidate') {
+                                                    ensembleCandidates[data.model] = data;
+                                                } else {
+                                                    fusionModel = data.model;
+                                                }
+                                                if (!accumulated) {
+                                                    renderEnsembleProgress(content, ensembleCandidates, fusionModel);
+                                                    scrollToBottom();
+                                                }
+                                            } else if (data.type === 'images') {
+                                                if (data.images && data.images.length > 0) {
+                                                    streamImages = data.images;
+                                                }
+                                            } else if (data.type === 'done') {
+                                                finished = true;
+                                                const htmlContent = marked.parse(accumulated);
+                                                content.innerHTML = htmlContent;
+                                                content.querySelectorAll('pre code').forEach((block) => {
+                                                    hljs.highlightElement(block);
+                                                });
+                                                renderMathInElement(content, {
+                                                    delimiters: [
+                                                        {left: '$$', right: '$$', display: true},
+                                                        {left: '\\[', right: '\\]', display: true},
+                                                        {left: '\\(', right: '\\)', display: false}
+                                                    ],
+                                                    throwOnError: false
+                                                });
+
+                                                if (streamImages && streamImages.length > 0) {
+                                                    let imgsHtml = '<div class="message-images">';
+                                                    streamImages.forEach(img => {
+                                                        let url = img;
+                                                        if (typeof img === 'object') {
+                                                            url = img.url || img.image_url || '';
+                                                            if (typeof url === 'object') url = url.url;
+                                                        }
                                             
-                                            if (url) {
-                                                const filename = 'image.png';
-                                                imgsHtml += `
-                                                    <a class="img-link" href="${url}" target="_blank" download="${filename}">
-                                                        <img src="${url}" alt="Generated Image">
-                                                        <span class="img-download">⬇</span>
-                                                    </a>
-                                                `;
+                                                        if (url) {
+                                                            const filename = 'image.png';
+                                                            imgsHtml += `
+                                                                <a class="img-link" href="${url}" target="_blank" download="${filename}">
+                                                                    <img src="${url}" alt="Generated Image">
+                                                                    <span class="img-download">⬇</span>
+                                                                </a>
+                                                            `;
+                                                        }
+                                                    });
+                                                    imgsHtml += '</div>';
+                                                    content.innerHTML += imgsHtml;
+                                                }
+
+                                                if (streamData.sources && streamData.sources.length) {
+                                                    const sourcesDiv = document.createElement('div');
+                                                    sourcesDiv.className = 'message-sources';
+                                                    const sourcesHeader = '<div class="sources-header"><svg width="12" height="12" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><circle cx="11" cy="11" r="8"/><path d="m21 21-4.35-4.35"/></svg> Web források</div>';
+                                                    sourcesDiv.innerHTML = sourcesHeader + streamData.sources.map((src, idx) => {
+                                                        const title = src.title || src.url || `Forrás ${idx + 1}`;
+                                                        const href = src.url || '#';
+                                                        return `<div class="source-item">[${idx + 1}] <a href="${href}" target="_blank" rel="noopener">${title}</a></div>`;
+                                                    }).join('');
+                                                    content.appendChild(sourcesDiv);
+                                                }
+
+                                                const metaRow = document.createElement('div');
+                                                metaRow.className = 'message-meta';
+                                                const modelSpan = document.createElement('span');
+                                                modelSpan.className = 'message-model';
+                                                let modelLabel = streamData.model ? `Model: ${streamData.model}` : '';
+                                                const modeLabel = streamData.meta && streamData.meta.mode ? MODE_DISPLAY[streamData.meta.mode] : null;
+                                                if (modeLabel) {
+                                                    modelLabel = modelLabel ? `${modelLabel} • ${modeLabel}` : modeLabel;
+                                                }
+                                                modelSpan.textContent = modelLabel;
+                                                const actions = document.createElement('div');
+                                                actions.className = 'message-actions';
+                                                const copyBtn = document.createElement('button');
+                                                copyBtn.className = 'copy-btn';
+                                                copyBtn.setAttribute('title', 'Szöveg másolása');
+                                                const copyIcon = '<svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><rect x="9" y="9" width="13" height="13" rx="2" ry="2"/><path d="M5 15H4a2 2 0 0 1-2-2V4a2 2 0 0 1 2-2h9a2 2 0 0 1 2 2v1"/></svg>';
+                                                copyBtn.dataset.icon = copyIcon;
+                                                copyBtn.innerHTML = copyIcon;
+                                                copyBtn.addEventListener('click', () => copyMessageText(copyBtn, accumulated));
+                                                actions.appendChild(copyBtn);
+                                                metaRow.appendChild(modelSpan);
+                                                metaRow.appendChild(actions);
+                                                content.appendChild(metaRow);
+                                    
+                                                loadHistory();
+                                                scrollToBottom();
+                                            } else if (data.type === 'error') {
+                                                finished = true;
+                                                streamDiv.remove();
+                                                appendMessage('assistant', 'Hiba: ' + data.error, null, null, null, null);
                                             }
-                                        });
-                                        imgsHtml += '</div>';
-                                        content.innerHTML += imgsHtml;
+                                        } catch (e) {
+                                            console.error('Parse error:', e);
+                                        }
+                                        if (eventId) lastEventId = eventId;
                                     }
-
-                                    if (streamData.sources && streamData.sources.length) {
-                                        const sourcesDiv = document.createElement('div');
-                                        sourcesDiv.className = 'message-sources';
-                                        const sourcesHeader = '<div class="sources-header"><svg width="12" height="12" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><circle cx="11" cy="11" r="8"/><path d="m21 21-4.35-4.35"/></svg> Web források</div>';
-                                        sourcesDiv.innerHTML = sourcesHeader + streamData.sources.map((src, idx) => {
-                                            const title = src.title || src.url || `Forrás ${idx + 1}`;
-                                            const href = src.url || '#';
-                                            return `<div class="source-item">[${idx + 1}] <a href="${href}" target="_blank" rel="noopener">${title}</a></div>`;
-                                        }).join('');
-                                        content.appendChild(sourcesDiv);
-                                    }
-
-                                    const metaRow = document.createElement('div');
-                                    metaRow.className = 'message-meta';
-                                    const modelSpan = document.createElement('span');
-                                    modelSpan.className = 'message-model';
-                                    let modelLabel = streamData.model ? `Model: ${streamData.model}` : '';
-                                    const modeLabel = streamData.meta && streamData.meta.mode ? MODE_DISPLAY[streamData.meta.mode] : null;
-                                    if (modeLabel) {
-                                        modelLabel = modelLabel ? `${modelLabel} • ${modeLabel}` : modeLabel;
-                                    }
-                                    modelSpan.textContent = modelLabel;
-                                    const actions = document.createElement('div');
-                                    actions.className = 'message-actions';
-                                    const copyBtn = document.createElement('button');
-                                    copyBtn.className = 'copy-btn';
-                                    copyBtn.setAttribute('title', 'Szöveg másolása');
-                                    const copyIcon = '<svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><rect x="9" y="9" width="13" height="13" rx="2" ry="2"/><path d="M5 15H4a2 2 0 0 1-2-2V4a2 2 0 0 1 2-2h9a2 2 0 0 1 2 2v1"/></svg>';
-                                    copyBtn.dataset.icon = copyIcon;
-                                    copyBtn.innerHTML = copyIcon;
-                                    copyBtn.addEventListener('click', () => copyMessageText(copyBtn, accumulated));
-                                    actions.appendChild(copyBtn);
-                                    metaRow.appendChild(modelSpan);
-                                    metaRow.appendChild(actions);
-                                    content.appendChild(metaRow);
-                                    
-                                    loadHistory();
-                                    scrollToBottom();
-                                } else if (data.type === 'error') {
-                                    streamDiv.remove();
-                                    appendMessage('assistant', 'Hiba: ' + data.error, null, null, null, null);
                                 }
-                            } catch (e) {
-                                console.error('Parse error:', e);
                             }
                         }
+                    } catch (err) {
+                        if (!generationId) throw err;
                     }
                 }
+                if (finished || !generationId || resumeAttempts >= STREAM_RESUME_ATTEMPTS) break;
+                resumeAttempts += 1;
+                await new Promise(resolve => setTimeout(resolve, 500 * resumeAttempts));
+                body = null;
+                try {
+                    const resumed = await fetch(`/api/chat/stream/${generationId}`, {
+                        headers: lastEventId ? { 'Last-Event-ID': lastEventId } : {}
+                    });
+                    if (resumed.status === 404) break;
+                    if (resumed.ok) body = resumed.body;
+                } catch {}
+            }
+
+            if (!finished) {
+                throw new Error('stream interrupted');
             }
         } catch (err) {
             streamDiv.remove();
@@ -963,6 +1018,38 @@ function scrollToBottom() {
     container.scrollTop = container.scrollHeight;
 }
 
+const ENSEMBLE_STATUS = {
+    running: 'fut...',
+    done: 'kész',
+    failed: 'hiba',
+    timeout: 'időtúllépés',
+    cancelled: 'leállítva'
+};
+
+function renderEnsembleProgress(target, candidates, fusionModel) {
+    const list = document.createElement('div');
+    list.className = 'ultimate-breakdown-list';
+    Object.values(candidates).forEach(item => {
+        const row = document.createElement('div');
+        row.className = 'ultimate-breakdown-item';
+        const name = document.createElement('strong');
+        name.textContent = item.model;
+        row.appendChild(name);
+        const chars = item.chars ? ` (${item.chars} karakter)` : '';
+        row.appendChild(document.createTextNode(` ${ENSEMBLE_STATUS[item.status] || item.status}${chars}`));
+        list.appendChild(row);
+    });
+    if (fusionModel) {
+        const row = document.createElement('div');
+        row.className = 'ultimate-breakdown-item';
+        row.textContent = `Egyesítés: ${fusionModel}...`;
+        list.appendChild(row);
+    }
+    target.innerHTML = '';
+    target.appendChild(list);
+    target.insertAdjacentHTML('beforeend', '<span class="word-cursor"></span>');
+}
+
 function appendLoading(id, isWebSearching = false) {
     const container = document.getElementById('chat-messages');
     const div = document.createElement('div');